@@ -3,25 +3,111 @@
 # *************************************************************************************************
 
 # Bibliotecas
+import atexit
+import bisect
+import cProfile
+import gzip
+import hashlib
+import hmac
 import io
+import json
+import mimetypes
 import os
+import pickle
+import pstats
 import re
+import tempfile
+import threading
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
-from time import time
+from functools import wraps
+from itertools import islice
+from time import sleep, time
 
+import numpy as np
 import pandas as pd
-from flask import (Flask, jsonify, render_template, request, send_file,
-                   send_from_directory)
+import xlsxwriter
+from flask import (Flask, Response, g, jsonify, render_template, request,
+                   send_from_directory, stream_with_context)
+from pandas.api.types import union_categoricals
+from pypdf import PdfWriter
 from reportlab.lib.pagesizes import landscape, letter
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfgen import canvas
 from werkzeug.utils import secure_filename
 
+try:
+    import brotli
+except ImportError:  # brotli é opcional; sem ele, apenas gzip
+    brotli = None
+
 app = Flask(__name__)
 
 # Configurações
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['ALLOWED_EXTENSIONS'] = {'csv', 'xlsx'}
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB
+# A leitura em blocos mantém em memória apenas as solicitações em espera,
+# o que permite arquivos bem maiores que o limite original de 16MB
+app.config['MAX_CONTENT_LENGTH'] = 256 * 1024 * 1024  # 256MB
+app.config['LEITURA_CHUNK_LINHAS'] = 100_000
+app.config['EXPORTACAO_BLOCO_LINHAS'] = 50_000
+app.config['TAMANHO_BLOCO_ENVIO'] = 64 * 1024  # bytes por bloco enviado
+# Bytes por bloco copiados do arquivo recebido para a pasta de envios
+app.config['TAMANHO_BLOCO_RECEBIMENTO'] = 1024 * 1024
+app.config['CATALOGO_OCI'] = os.path.join(
+    app.root_path, 'db', 'agrupamentos_oci.json'
+)
+app.config['CACHE_FOLDER'] = 'cache'
+app.config['ANALISES_MAX_MEMORIA'] = 8  # análises mantidas em memória
+app.config['ANALISES_TTL'] = 60 * 60  # segundos
+# Grava as análises em disco, compartilhadas entre os workers
+app.config['ANALISES_DISCO'] = True
+app.config['ANALISES_MAX_BYTES'] = 512 * 1024 * 1024  # 512MB
+app.config['CACHE_RESULTADOS_MAX_BYTES'] = 512 * 1024 * 1024  # 512MB
+# Arquivos a partir deste tamanho são analisados em segundo plano
+app.config['ANALISE_ASSINCRONA_MIN_BYTES'] = 2 * 1024 * 1024  # 2MB
+# Os pools de processos existem em cada worker do gunicorn: com W workers,
+# até W * (ANALISE + LEITURA + PDF) processos. Por isso os padrões são
+# pequenos, e um pool sem uso por POOL_OCIOSO_SEGUNDOS é encerrado
+app.config['ANALISE_PROCESSOS'] = 2
+app.config['POOL_OCIOSO_SEGUNDOS'] = 5 * 60
+# Cada conexão SSE de /progress dura no máximo esta janela (ocupa um
+# worker síncrono enquanto aberta); o navegador reconecta sozinho depois
+# de PROGRESSO_RECONEXAO_MS e continua do último estado recebido
+app.config['PROGRESSO_JANELA'] = 45  # segundos
+app.config['PROGRESSO_RECONEXAO_MS'] = 1000
+# Processos de leitura dos envios com vários arquivos
+app.config['LEITURA_PROCESSOS'] = min(os.cpu_count() or 1, 2)
+# Janelas de linhas do relatório servidas por /report_lines
+app.config['RELATORIO_LINHAS_PAGINA'] = 200
+app.config['RELATORIO_MAX_LINHAS_PAGINA'] = 2000
+app.config['RELATORIO_VISOES_CACHE'] = 32
+# Compressão das respostas JSON/texto e dos arquivos estáticos
+app.config['COMPRESSAO_MIN_BYTES'] = 1024
+app.config['COMPRESSAO_NIVEL_GZIP'] = 6
+app.config['COMPRESSAO_NIVEL_BROTLI'] = 5
+# Métricas de cada processo, somadas pelo /metrics
+app.config['METRICAS_FOLDER'] = os.path.join(
+    app.config['CACHE_FOLDER'], 'metricas'
+)
+app.config['METRICAS_INTERVALO'] = 5  # segundos entre gravações do retrato
+# Perfilamento sob demanda (?perfil=1 com o cabeçalho X-Perfil-Token);
+# desligado enquanto o token não for configurado
+app.config['PERFIL_TOKEN'] = os.environ.get('OCI_PERFIL_TOKEN', '')
+app.config['PERFIS_FOLDER'] = os.path.join(
+    app.config['CACHE_FOLDER'], 'perfis'
+)
+app.config['PERFIS_MAX'] = 50  # perfis mantidos em disco
+app.config['PERFIL_FUNCOES'] = 30  # funções listadas no resumo
+# PDFs com mais páginas que isso são desenhados em partes, em paralelo
+# (só compensa com mais de um processador, pela concatenação no final)
+app.config['PDF_PAGINAS_POR_PARTE'] = 1000
+app.config['PDF_PROCESSOS'] = min(os.cpu_count() or 1, 2)
 
 # Colunas obrigatórias
 REQUIRED_COLUMNS = [
@@ -41,1241 +127,2889 @@ REQUIRED_COLUMNS = [
     'CNES_EXECUTANTE',
 ]
 
-# Definição dos agrupamentos (seu dicionário completo de agrupamentos aqui)
-agrupamentos = {
-    '0901010014': {
-        'nome': 'OCI AVALIAÇÃO DIAGNÓSTICA INICIAL DE CÂNCER DE MAMA',
-        'itens_obrigatorios': [
-            {'codigo': '0204030030', 'descricao': 'MAMOGRAFIA'},
-            {
-                'codigo': '0301010307',
-                'descricao': 'TELECONSULTA MÉDICA NA ATENÇÃO ESPECIALIZADA',
-            },
-            {
-                'codigo': '0301010072',
-                'descricao': 'CONSULTA MEDICA EM ATENÇÃO ESPECIALIZADA',
+# Colunas de baixa cardinalidade mantidas como categóricas na leitura
+COLUNAS_COMPACTAS = [
+    'CNES_SOLICITANTE',
+    'CNES_REGULADOR',
+    'CNES_EXECUTANTE',
+    'CODIGO_SIGTAP',
+    'CBO',
+    'CID10',
+    'CODIGO_MODALIDADE_ASSISTENCIAL',
+    'CODIGO_CARTER_SOLICITACAO',
+    'STATUS',
+]
+
+# Colunas dos relatórios estruturados (XLSX)
+COLUNAS_AGRUPAMENTOS = [
+    'AGRUPAMENTO_OCI',
+    'DESCRICAO_OCI',
+    'DOCUMENTO_PACIENTE',
+    'DATA_SOLICITACAO',
+    'CNES_SOLICITANTE',
+    'ITEM OBG/FAC (X)',
+    'CID10',
+    'CODIGO_SIGTAP',
+    'DESCRICAO_SIGTAP',
+    'CBO',
+]
+
+# Colunas enviadas como dicionário na resposta colunar
+COLUNAS_DICIONARIO = ['AGRUPAMENTO_OCI', 'DESCRICAO_OCI', 'DESCRICAO_SIGTAP']
+
+# Coluna com o arquivo de origem de cada solicitação (envio com vários
+# arquivos); quando presente, acompanha as tabelas do resultado
+COLUNA_ORIGEM = 'ARQUIVO_ORIGEM'
+
+COLUNAS_NAO_AGRUPADOS = [
+    'DOCUMENTO_PACIENTE',
+    'DATA_SOLICITACAO',
+    'CNES_SOLICITANTE',
+    'CID10',
+    'CODIGO_SIGTAP',
+    'DESCRICAO_SIGTAP',
+    'CBO',
+]
+
+
+def formatar_codigo_oci(codigo):
+    return f'{codigo[:2]}.{codigo[2:4]}.{codigo[4:6]}.{codigo[6:]}'
+
+
+# Catálogo compilado: índice inteiro dos códigos SIGTAP e máscaras de bits
+# com os itens obrigatórios de cada OCI, montado uma única vez na importação
+def compilar_catalogo(agrupamentos):
+    codigos = []
+    indice_codigos = {}
+    descricoes = {}
+    for agrupamento in agrupamentos.values():
+        for item in (
+            agrupamento['itens_obrigatorios']
+            + agrupamento['itens_facultativos']
+        ):
+            if item['codigo'] not in indice_codigos:
+                indice_codigos[item['codigo']] = len(codigos)
+                codigos.append(item['codigo'])
+                descricoes[item['codigo']] = item['descricao']
+
+    ocis = list(agrupamentos.keys())
+    obrigatorios = np.zeros((len(ocis), len(codigos)), dtype=bool)
+    itens = []
+    for i, (codigo, agrupamento) in enumerate(agrupamentos.items()):
+        for item in agrupamento['itens_obrigatorios']:
+            obrigatorios[i, indice_codigos[item['codigo']]] = True
+
+        # Tabela explodida (OCI, código, OBG/FAC, descrição) na ordem do
+        # catálogo, usada na junção com os registros dos pacientes
+        for tipo, chave in (
+            ('OBG', 'itens_obrigatorios'),
+            ('FAC', 'itens_facultativos'),
+        ):
+            for item in agrupamento[chave]:
+                itens.append(
+                    {
+                        'ORDEM_OCI': i,
+                        'ORDEM_ITEM': len(itens),
+                        'AGRUPAMENTO_OCI': formatar_codigo_oci(codigo),
+                        'DESCRICAO_OCI': agrupamento['nome'],
+                        'ITEM OBG/FAC (X)': tipo,
+                        'CODIGO_SIGTAP': item['codigo'],
+                        'DESCRICAO_SIGTAP': item['descricao'],
+                    }
+                )
+
+    return {
+        'agrupamentos': agrupamentos,
+        'codigos': codigos,
+        'indice_codigos': indice_codigos,
+        'descricoes': descricoes,
+        'ocis': ocis,
+        'mascaras_obrigatorios': np.packbits(obrigatorios, axis=1),
+        'itens': pd.DataFrame(itens),
+    }
+
+
+# Grava em arquivo temporário e renomeia (escrita atômica), para que outros
+# processos nunca leiam um arquivo pela metade
+def gravar_pickle_atomico(caminho, objeto):
+    pasta = os.path.dirname(caminho)
+    os.makedirs(pasta, exist_ok=True)
+    descritor, temporario = tempfile.mkstemp(dir=pasta, suffix='.tmp')
+    try:
+        with os.fdopen(descritor, 'wb') as arquivo:
+            pickle.dump(objeto, arquivo, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporario, caminho)
+    except BaseException:
+        try:
+            os.remove(temporario)
+        except OSError:
+            pass
+        raise
+
+
+# Catálogo de OCIs carregado de arquivo externo (db/agrupamentos_oci.json).
+# A forma compilada fica em cache binário, identificado pelo hash do
+# arquivo, e é trocada atomicamente quando o arquivo muda
+_catalogo_atual = None
+_catalogo_assinatura = None
+_catalogo_lock = threading.Lock()
+
+
+def carregar_catalogo(caminho):
+    with open(caminho, 'rb') as arquivo:
+        conteudo = arquivo.read()
+    versao = hashlib.sha256(conteudo).hexdigest()
+
+    cache = os.path.join(
+        app.config['CACHE_FOLDER'], f'catalogo_{versao[:16]}.pkl'
+    )
+    try:
+        with open(cache, 'rb') as arquivo:
+            catalogo = pickle.load(arquivo)
+        if catalogo.get('versao') == versao:
+            return catalogo
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        pass
+
+    catalogo = compilar_catalogo(json.loads(conteudo.decode('utf-8')))
+    catalogo['versao'] = versao
+
+    try:
+        gravar_pickle_atomico(cache, catalogo)
+    except OSError as e:
+        app.logger.warning(f'Cache do catálogo não gravado: {str(e)}')
+
+    return catalogo
+
+
+def obter_catalogo():
+    global _catalogo_atual, _catalogo_assinatura
+
+    # Verificação barata (stat) a cada chamada; só recompila quando o
+    # arquivo realmente mudou
+    caminho = app.config['CATALOGO_OCI']
+    estado = os.stat(caminho)
+    assinatura = (estado.st_mtime_ns, estado.st_size)
+    if _catalogo_atual is not None and assinatura == _catalogo_assinatura:
+        return _catalogo_atual
+
+    with _catalogo_lock:
+        if _catalogo_atual is None or assinatura != _catalogo_assinatura:
+            try:
+                _catalogo_atual = carregar_catalogo(caminho)
+            except (OSError, ValueError, KeyError) as e:
+                if _catalogo_atual is None:
+                    raise
+                app.logger.error(
+                    f'Erro ao recarregar catálogo de OCIs: {str(e)}'
+                )
+            _catalogo_assinatura = assinatura
+        return _catalogo_atual
+
+
+# Quantidade de pacientes testados por bloco no casamento vetorizado
+TAMANHO_BLOCO_PACIENTES = 65536
+
+
+def casar_pacientes(df, catalogo):
+    # Casa todos os pacientes com todas as OCIs em uma única passada:
+    # monta a matriz paciente x código SIGTAP como bitset e compara com a
+    # máscara de itens obrigatórios de cada OCI. Retorna os pares
+    # (OCI, paciente) casados
+    ocis = catalogo['ocis']
+    mascaras = catalogo['mascaras_obrigatorios']
+
+    # Pacientes em ordem do texto do documento (mesma ordem do relatório,
+    # mesmo quando o documento está guardado como inteiro)
+    idx_pacientes, pacientes = pd.factorize(df['DOCUMENTO_PACIENTE'])
+    ordem = np.argsort(pacientes.astype(str).to_numpy(), kind='stable')
+    posicoes = np.empty_like(ordem)
+    posicoes[ordem] = np.arange(len(ordem))
+    idx_pacientes = posicoes[idx_pacientes]
+    pacientes = pacientes.to_numpy()[ordem]
+    idx_codigos = (
+        df['CODIGO_SIGTAP']
+        .map(catalogo['indice_codigos'])
+        .to_numpy(dtype=float, na_value=np.nan)
+    )
+    validos = ~np.isnan(idx_codigos)
+
+    presenca = np.zeros(
+        (len(pacientes), len(catalogo['codigos'])), dtype=bool
+    )
+    presenca[
+        idx_pacientes[validos], idx_codigos[validos].astype(np.intp)
+    ] = True
+    bits = np.packbits(presenca, axis=1)
+    del presenca
+
+    casados = np.zeros((len(pacientes), len(ocis)), dtype=bool)
+    for inicio in range(0, len(pacientes), TAMANHO_BLOCO_PACIENTES):
+        bloco = bits[inicio : inicio + TAMANHO_BLOCO_PACIENTES]
+        casados[inicio : inicio + TAMANHO_BLOCO_PACIENTES] = (
+            (bloco[:, None, :] & mascaras[None, :, :]) == mascaras[None, :, :]
+        ).all(axis=2)
+
+    # Pares (OCI, paciente) casados, ordenados por OCI e por paciente
+    ordem_oci, ordem_paciente = np.nonzero(casados.T)
+    return pd.DataFrame(
+        {
+            'ORDEM_OCI': ordem_oci,
+            'ORDEM_PACIENTE': ordem_paciente,
+            'DOCUMENTO_PACIENTE': pacientes[ordem_paciente],
+        }
+    )
+
+
+def allowed_file(filename):
+    return (
+        '.' in filename
+        and filename.rsplit('.', 1)[1].lower()
+        in app.config['ALLOWED_EXTENSIONS']
+    )
+
+
+def preencher_vazios(df):
+    # Preenche apenas as colunas de texto: datas (NaT) e documentos
+    # numéricos mantêm o tipo. Colunas categóricas precisam ter '' entre as
+    # categorias para o fillna
+    colunas_texto = df.select_dtypes(['object', 'category']).columns
+    for col in df.select_dtypes('category').columns:
+        if '' not in df[col].cat.categories:
+            df[col] = df[col].cat.add_categories('')
+    return df.fillna({col: '' for col in colunas_texto})
+
+
+def compactar_colunas(df):
+    for col in COLUNAS_COMPACTAS:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    return df
+
+
+def concatenar_blocos(blocos):
+    # Concatena os blocos lidos preservando as colunas categóricas (o
+    # pd.concat volta para object quando as categorias diferem)
+    compactas = list(blocos[0].select_dtypes('category').columns)
+    df = pd.concat(
+        [bloco.drop(columns=compactas) for bloco in blocos],
+        ignore_index=True,
+    )
+    for col in compactas:
+        df[col] = union_categoricals([bloco[col] for bloco in blocos])
+    return df[blocos[0].columns]
+
+
+def abrir_arquivo(origem):
+    # origem: caminho do arquivo recebido (gravado na pasta de envios) ou o
+    # conteúdo em bytes. Retorna o arquivo aberto e o tamanho em bytes
+    if isinstance(origem, (bytes, bytearray)):
+        return io.BytesIO(origem), len(origem)
+    return open(origem, 'rb'), os.path.getsize(origem)
+
+
+def ler_arquivo(origem, nome_arquivo, progresso=None):
+    # Leitura em blocos apenas das colunas obrigatórias, descartando já em
+    # cada bloco as solicitações que não estão em espera (STATUS != 1)
+    def filtrar_bloco(bloco):
+        faltando = [col for col in REQUIRED_COLUMNS if col not in bloco]
+        if faltando:
+            raise ColunasFaltando(faltando)
+        bloco = bloco[bloco['STATUS'] == '1'].fillna('')
+        return compactar_colunas(bloco)
+
+    buffer, tamanho = abrir_arquivo(origem)
+    with buffer:
+        if not nome_arquivo.endswith('.csv'):  # XLSX
+            df = pd.read_excel(
+                buffer, dtype=str, usecols=lambda col: col in REQUIRED_COLUMNS
+            )
+            if progresso:
+                progresso('leitura', len(df), len(df))
+            return filtrar_bloco(df).reset_index(drop=True)
+
+        blocos = []
+        linhas_lidas = 0
+        leitor = pd.read_csv(
+            buffer,
+            encoding='utf-8',
+            sep=';',
+            dtype=str,
+            usecols=lambda col: col in REQUIRED_COLUMNS,
+            chunksize=app.config['LEITURA_CHUNK_LINHAS'],
+        )
+        with leitor:
+            for bloco in leitor:
+                linhas_lidas += len(bloco)
+                blocos.append(filtrar_bloco(bloco))
+                if progresso:
+                    # Total estimado pela fração de bytes já consumida
+                    lidos = max(buffer.tell(), 1)
+                    progresso(
+                        'leitura',
+                        linhas_lidas,
+                        max(linhas_lidas, linhas_lidas * tamanho // lidos),
+                    )
+
+        if not blocos:  # Arquivo só com cabeçalho
+            buffer.seek(0)
+            cabecalho = pd.read_csv(buffer, encoding='utf-8', sep=';', nrows=0)
+            blocos.append(filtrar_bloco(cabecalho.astype(str)))
+    return concatenar_blocos(blocos)
+
+
+# Formatos de data aceitos, na ordem de preferência em caso de empate
+FORMATOS_DATA = [
+    '%d/%m/%Y',
+    '%Y-%m-%d',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d %H:%M:%S.%f',
+    '%d/%m/%Y %H:%M:%S',
+    '%d/%m/%Y %H:%M',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S.%f',
+    '%d-%m-%Y',
+    '%Y%m%d',
+]
+TAMANHO_AMOSTRA_DATAS = 200
+# Fuso no fim de um horário ISO (Z, +00:00, -0300); a data fica a do texto
+FUSO_HORARIO = r'(?<=\d)(?:Z|[+-]\d{2}:?\d{2})$'
+
+
+def detectar_formatos_data(valores):
+    # Ordena os formatos pelo número de acertos em uma amostra dos valores
+    # (ordenação estável: empates mantêm a ordem de FORMATOS_DATA)
+    amostra = valores[:TAMANHO_AMOSTRA_DATAS]
+    acertos = {
+        formato: pd.to_datetime(amostra, format=formato, errors='coerce')
+        .notna()
+        .sum()
+        for formato in FORMATOS_DATA
+    }
+    return sorted(FORMATOS_DATA, key=lambda formato: -acertos[formato])
+
+
+def converter_datas(valores):
+    # Converte valores (distintos) de data com formato explícito: primeiro o
+    # formato detectado na amostra e, para o que sobrar (arquivos com
+    # formatos misturados), os demais. O que nenhum formato fixo aceita
+    # (ano com dois dígitos, fuso horário etc.) passa pela inferência valor
+    # a valor do pandas, com o dia antes do mês. Retorna as datas e a
+    # máscara dos valores preenchidos que não puderam ser convertidos
+    valores = pd.Series(valores, dtype=object).fillna('').astype(str)
+    valores = valores.str.strip()
+    datas = pd.Series(pd.NaT, index=valores.index, dtype='datetime64[ns]')
+    pendentes = (valores != '').to_numpy()
+
+    for formato in detectar_formatos_data(valores[pendentes]):
+        if not pendentes.any():
+            break
+        convertidas = pd.to_datetime(
+            valores[pendentes], format=formato, errors='coerce'
+        )
+        convertidas = convertidas[convertidas.notna()]
+        datas[convertidas.index] = convertidas
+        pendentes[convertidas.index] = False
+
+    if pendentes.any():
+        restantes = valores[pendentes].str.replace(
+            FUSO_HORARIO, '', regex=True
+        )
+        convertidas = pd.to_datetime(
+            restantes, format='mixed', dayfirst=True, errors='coerce'
+        )
+        convertidas = convertidas[convertidas.notna()]
+        datas[convertidas.index] = convertidas
+        pendentes[convertidas.index] = False
+
+    return datas, pendentes
+
+
+def converter_documentos(serie):
+    codigos, unicos = pd.factorize(serie)
+    unicos = pd.Series(unicos, dtype=object)
+    if (
+        len(unicos) == 0
+        or (codigos < 0).any()
+        or not unicos.str.fullmatch(r'[1-9]\d{0,17}').all()
+    ):
+        return serie
+    return pd.Series(
+        unicos.astype('int64').to_numpy()[codigos], index=serie.index
+    )
+
+
+def formatar_texto(serie):
+    # Texto exibido nos relatórios para uma coluna tipada
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        codigos, unicos = pd.factorize(serie)
+        textos = np.append(
+            pd.DatetimeIndex(unicos).strftime('%d/%m/%Y').to_numpy(), ''
+        )
+        return pd.Series(textos[codigos], index=serie.index, dtype=object)
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        return serie.astype(str)
+    if pd.api.types.is_integer_dtype(serie):
+        return serie.astype(str).astype(object)
+    return serie.fillna('').astype(str)
+
+
+def formatar_tabela(df):
+    return pd.DataFrame(
+        {col: formatar_texto(df[col]) for col in df.columns},
+        index=df.index,
+    )
+
+
+def normalizar_codigos(serie, tamanho):
+    # Aplica zfill apenas aos valores numéricos, validando e completando só
+    # os valores distintos da coluna e remapeando para as linhas. Retorna a
+    # coluna categórica e a quantidade de linhas com valor não numérico
+    codigos, unicos = pd.factorize(serie)
+    unicos = pd.Series(np.asarray(unicos, dtype=object)).astype(str)
+    numericos = unicos.str.fullmatch(r'\d+')
+    normalizados = unicos.where(~numericos, unicos.str.zfill(tamanho))
+
+    # Valores distintos podem coincidir após o zfill (ex.: 123 e 0000123)
+    novos, categorias = pd.factorize(np.append(normalizados.to_numpy(), ''))
+    coluna = pd.Series(
+        pd.Categorical.from_codes(novos[codigos], categorias),
+        index=serie.index,
+    )
+    nao_numericos = ((~numericos) & (unicos != '')).to_numpy()
+    return coluna, int(
+        np.count_nonzero(np.append(nao_numericos, False)[codigos])
+    )
+
+
+def formatar_dados(df, progresso=None):
+    # CNES - 7 dígitos e CODIGO_SIGTAP - 10 dígitos
+    tamanhos = {
+        'CNES_SOLICITANTE': 7,
+        'CNES_REGULADOR': 7,
+        'CNES_EXECUTANTE': 7,
+        'CODIGO_SIGTAP': 10,
+    }
+    codigos_nao_numericos = {}
+    for col, tamanho in tamanhos.items():
+        if col in df.columns:
+            df[col], codigos_nao_numericos[col] = normalizar_codigos(
+                df[col], tamanho
+            )
+    df.attrs['codigos_nao_numericos'] = codigos_nao_numericos
+
+    if progresso:
+        progresso('formatacao', len(df) // 2, len(df))
+
+    # Conversão de datas: converte apenas os valores distintos, com formato
+    # explícito detectado por amostra, e remapeia para a coluna. As datas
+    # ficam como datetime64; o texto dd/mm/aaaa só é gerado na exportação
+    date_cols = ['DATA_SOLICITACAO', 'DATA_AUTORIZACAO', 'DATA_EXECUCAO']
+    datas_invalidas = {}
+    for col in date_cols:
+        if col in df.columns:
+            codigos, unicos = pd.factorize(df[col])
+            datas, invalidas = converter_datas(unicos)
+            df[col] = np.append(
+                datas.to_numpy(), np.datetime64('NaT', 'ns')
+            )[codigos]
+            datas_invalidas[col] = int(
+                np.count_nonzero(np.append(invalidas, False)[codigos])
+            )
+    df.attrs['datas_invalidas'] = datas_invalidas
+
+    # Documento do paciente como int64 quando todos os valores são números
+    # sem zero à esquerda (o texto original é recuperado sem perdas)
+    if 'DOCUMENTO_PACIENTE' in df.columns:
+        df['DOCUMENTO_PACIENTE'] = converter_documentos(
+            df['DOCUMENTO_PACIENTE']
+        )
+
+    if progresso:
+        progresso('formatacao', len(df), len(df))
+
+    return df
+
+
+def casar_itens(df, catalogo, linhas):
+    # Casamento dos pacientes de df com as OCIs e junção dos pares com a
+    # tabela explodida do catálogo e com os registros: cada linha é um item
+    # OBG/FAC de um paciente casado. linhas é a posição de cada registro de
+    # df na tabela completa de solicitações
+    pares = casar_pacientes(df, catalogo)
+    colunas_origem = [COLUNA_ORIGEM] if COLUNA_ORIGEM in df else []
+    registros = df[
+        [
+            'DOCUMENTO_PACIENTE',
+            'CODIGO_SIGTAP',
+            'DATA_SOLICITACAO',
+            'CNES_SOLICITANTE',
+            'CID10',
+            'CBO',
+        ]
+        + colunas_origem
+    ].assign(ORDEM_LINHA=linhas)
+    itens_casados = pares.merge(catalogo['itens'], on='ORDEM_OCI').merge(
+        registros, on=['DOCUMENTO_PACIENTE', 'CODIGO_SIGTAP']
+    )
+    return pares, itens_casados
+
+
+def solicitacoes_nao_agrupadas(df, catalogo):
+    # Descrição SIGTAP por consulta direta ao mapa código -> descrição
+    return df.assign(
+        DESCRICAO_SIGTAP=df['CODIGO_SIGTAP']
+        .map(catalogo['descricoes'])
+        .fillna('Código não faz parte de um item de OCI')
+    )
+
+
+def analisar_dados(df, progresso=None):
+    try:
+        # Filtra apenas registros com STATUS == 1 (Em Espera)
+        df = df[df['STATUS'] == '1'].copy()
+
+        # Preenche NaN com string vazia
+        df = preencher_vazios(df)
+
+        total_solicitacoes = len(df)
+        total_pacientes = len(df['DOCUMENTO_PACIENTE'].unique())
+        if progresso:
+            progresso('casamento', 0, total_solicitacoes)
+
+        # Casamento de todos os pacientes com todas as OCIs de uma só vez
+        catalogo = obter_catalogo()
+        pares, itens_casados = casar_itens(df, catalogo, np.arange(len(df)))
+        pacientes_em_agrupamentos = set(pares['DOCUMENTO_PACIENTE'])
+        agrupamentos_encontrados = pares['ORDEM_OCI'].nunique()
+        if progresso:
+            progresso('casamento', total_solicitacoes, total_solicitacoes)
+
+        itens_casados = itens_casados.sort_values(
+            ['ORDEM_OCI', 'ORDEM_PACIENTE', 'ORDEM_ITEM', 'ORDEM_LINHA']
+        )
+        colunas_origem = [COLUNA_ORIGEM] if COLUNA_ORIGEM in df else []
+        relatorio_agrupamentos = itens_casados[
+            COLUNAS_AGRUPAMENTOS + colunas_origem
+        ].reset_index(drop=True)
+
+        if progresso:
+            progresso('relatorio', len(itens_casados), total_solicitacoes)
+
+        # Pacientes não agrupados
+        restantes = ~df['DOCUMENTO_PACIENTE'].isin(
+            pacientes_em_agrupamentos
+        ).to_numpy()
+        relatorio_nao_agrupados = solicitacoes_nao_agrupadas(
+            df[restantes], catalogo
+        )[COLUNAS_NAO_AGRUPADOS + colunas_origem].reset_index(drop=True)
+
+        if progresso:
+            progresso('relatorio', total_solicitacoes, total_solicitacoes)
+
+        # O texto do relatório não é montado aqui: é gerado sob demanda a
+        # partir das tabelas (ver gerar_linhas_relatorio)
+        return {
+            'relatorio_agrupamentos': relatorio_agrupamentos,
+            'relatorio_nao_agrupados': relatorio_nao_agrupados,
+            'total_pacientes': total_pacientes,
+            'pacientes_agrupados': len(pacientes_em_agrupamentos),
+            'agrupamentos_encontrados': agrupamentos_encontrados,
+            'total_solicitacoes': total_solicitacoes,
+            'gerado_em': datetime.now(),
+            # Estado para a reanálise incremental (reanalisar_incremental):
+            # as solicitações em espera e, para cada linha das tabelas, as
+            # chaves de ordenação e a posição da solicitação de origem
+            'base_incremental': {
+                'solicitacoes': df,
+                'ordem_agrupamentos': itens_casados[
+                    ['ORDEM_OCI', 'ORDEM_ITEM', 'ORDEM_LINHA']
+                ].reset_index(drop=True),
+                'linhas_nao_agrupados': np.flatnonzero(restantes),
+                'versao_catalogo': catalogo['versao'],
             },
-        ],
-        'itens_facultativos': [
+        }
+
+    except Exception as e:
+        app.logger.error(f'Erro na análise de dados: {str(e)}')
+        raise e
+
+
+# Reanálise incremental: aplica a uma análise armazenada um arquivo de
+# alterações (colunas do arquivo de filas + OPERACAO), identificadas pelo
+# IDENTIFICADOR_LOCAL:
+#   INCLUIR  nova solicitação (substitui a de mesmo identificador)
+#   EXCLUIR  remove a solicitação
+#   STATUS   muda o STATUS; fora de espera remove, e a volta para espera
+#            (STATUS 1) de uma solicitação que não estava na fila a inclui
+# Solicitações incluídas entram no fim da fila. Só os pacientes afetados
+# são casados de novo; o resultado é igual ao da análise completa da fila
+# atualizada
+OPERACOES_DELTA = ['INCLUIR', 'EXCLUIR', 'STATUS']
+
+
+def ler_delta(origem, nome_arquivo):
+    buffer, _ = abrir_arquivo(origem)
+    with buffer:
+        if nome_arquivo.endswith('.csv'):
+            delta = pd.read_csv(buffer, encoding='utf-8', sep=';', dtype=str)
+        else:  # XLSX
+            delta = pd.read_excel(buffer, dtype=str)
+
+    faltando = [
+        col
+        for col in ('IDENTIFICADOR_LOCAL', 'OPERACAO', 'STATUS')
+        if col not in delta
+    ]
+    if faltando:
+        raise ColunasFaltando(faltando, nome_arquivo)
+
+    delta = delta.fillna('')
+    delta['OPERACAO'] = delta['OPERACAO'].str.strip().str.upper()
+    invalidas = sorted(set(delta['OPERACAO']) - set(OPERACOES_DELTA))
+    if invalidas:
+        raise ValueError(
+            f'Operações inválidas no arquivo de alterações: {invalidas}'
+        )
+    return delta
+
+
+def reanalisar_incremental(resultado, delta, nome_arquivo):
+    base = resultado['base_incremental']
+    df_base = base['solicitacoes']
+    catalogo = obter_catalogo()
+
+    operacao = delta['OPERACAO']
+    em_espera = delta['STATUS'] == '1'
+    ids_base = df_base['IDENTIFICADOR_LOCAL']
+    ids_saida = delta.loc[
+        (operacao == 'INCLUIR')
+        | (operacao == 'EXCLUIR')
+        | ((operacao == 'STATUS') & ~em_espera),
+        'IDENTIFICADOR_LOCAL',
+    ]
+    entrada = ((operacao == 'INCLUIR') & em_espera) | (
+        (operacao == 'STATUS')
+        & em_espera
+        & ~delta['IDENTIFICADOR_LOCAL'].isin(ids_base)
+    )
+    removidas = ids_base.isin(ids_saida).to_numpy()
+
+    # Solicitações que entram na fila, normalizadas como na leitura
+    novos = delta[entrada]
+    faltando = [col for col in REQUIRED_COLUMNS if col not in novos]
+    if faltando and len(novos):
+        raise ColunasFaltando(faltando, nome_arquivo)
+    novos = formatar_dados(
+        compactar_colunas(
+            novos.reindex(columns=REQUIRED_COLUMNS).reset_index(drop=True)
+        )
+    )
+    if COLUNA_ORIGEM in df_base:
+        novos[COLUNA_ORIGEM] = pd.Categorical([nome_arquivo] * len(novos))
+    novos = preencher_vazios(novos)
+
+    # Tabelas anteriores; documentos em texto se a base ou as inclusões
+    # precisarem
+    agrupamentos = resultado['relatorio_agrupamentos'].copy()
+    nao_agrupados = resultado['relatorio_nao_agrupados'].copy()
+    df_base = df_base.copy()
+    blocos = [df_base] + ([novos] if len(novos) else [])
+    harmonizar_documentos(blocos + [agrupamentos, nao_agrupados])
+
+    mantidas = ~removidas
+    df_atual = concatenar_blocos([blocos[0][mantidas]] + blocos[1:])
+    alteracoes = {
+        'incluidas': len(novos),
+        'removidas': int(removidas.sum()),
+        'datas_invalidas': novos.attrs['datas_invalidas'],
+        'codigos_nao_numericos': novos.attrs['codigos_nao_numericos'],
+    }
+    if base['versao_catalogo'] != catalogo['versao']:
+        # Catálogo mudou desde a análise: todos os casamentos mudam
+        resultado = analisar_dados(df_atual)
+        alteracoes['pacientes_recalculados'] = resultado['total_pacientes']
+        resultado['alteracoes'] = alteracoes
+        return resultado
+
+    # Posição de cada solicitação mantida na fila atualizada
+    nova_posicao = np.cumsum(mantidas) - 1
+
+    afetados = pd.unique(
+        pd.concat(
+            [
+                df_base.loc[removidas, 'DOCUMENTO_PACIENTE'],
+                novos['DOCUMENTO_PACIENTE'],
+            ],
+            ignore_index=True,
+        )
+    )
+    selecao = df_atual['DOCUMENTO_PACIENTE'].isin(afetados).to_numpy()
+    linhas_afetadas = np.flatnonzero(selecao)
+    df_afetados = df_atual[selecao]
+
+    # Casamento apenas dos pacientes afetados
+    pares, itens_casados = casar_itens(df_afetados, catalogo, linhas_afetadas)
+    colunas_origem = [COLUNA_ORIGEM] if COLUNA_ORIGEM in df_atual else []
+
+    # Agrupamentos: linhas anteriores dos demais pacientes + linhas novas,
+    # na ordem da análise completa (OCI, documento, item, posição na fila)
+    ordem = base['ordem_agrupamentos']
+    manter = ~agrupamentos['DOCUMENTO_PACIENTE'].isin(afetados).to_numpy()
+    ordem_mantida = ordem[manter].assign(
+        ORDEM_LINHA=nova_posicao[ordem['ORDEM_LINHA'].to_numpy()[manter]]
+    )
+    colunas = COLUNAS_AGRUPAMENTOS + colunas_origem
+    combinados = concatenar_blocos(
+        [agrupamentos[manter], itens_casados[colunas]]
+    )
+    ordem_combinada = pd.concat(
+        [ordem_mantida, itens_casados[list(ordem.columns)]],
+        ignore_index=True,
+    )
+    codigos, documentos = pd.factorize(combinados['DOCUMENTO_PACIENTE'])
+    posto = np.empty(len(documentos), dtype=np.int64)
+    posto[np.argsort(documentos.astype(str).to_numpy(), kind='stable')] = (
+        np.arange(len(documentos))
+    )
+    indices = np.lexsort(
+        (
+            ordem_combinada['ORDEM_LINHA'].to_numpy(),
+            ordem_combinada['ORDEM_ITEM'].to_numpy(),
+            posto[codigos],
+            ordem_combinada['ORDEM_OCI'].to_numpy(),
+        )
+    )
+    relatorio_agrupamentos = combinados.iloc[indices].reset_index(drop=True)
+    ordem_agrupamentos = ordem_combinada.iloc[indices].reset_index(drop=True)
+
+    # Não agrupados: linhas anteriores dos demais pacientes + solicitações
+    # dos afetados que seguem sem conjunto, na ordem da fila
+    linhas_anteriores = base['linhas_nao_agrupados']
+    manter = ~nao_agrupados['DOCUMENTO_PACIENTE'].isin(afetados).to_numpy()
+    restantes = ~df_afetados['DOCUMENTO_PACIENTE'].isin(
+        set(pares['DOCUMENTO_PACIENTE'])
+    ).to_numpy()
+    combinados = concatenar_blocos(
+        [
+            nao_agrupados[manter],
+            solicitacoes_nao_agrupadas(df_afetados[restantes], catalogo)[
+                COLUNAS_NAO_AGRUPADOS + colunas_origem
+            ],
+        ]
+    )
+    linhas = np.concatenate(
+        [
+            nova_posicao[linhas_anteriores[manter]],
+            linhas_afetadas[restantes],
+        ]
+    )
+    indices = np.argsort(linhas, kind='stable')
+    relatorio_nao_agrupados = combinados.iloc[indices].reset_index(drop=True)
+
+    # Sem as solicitações removidas, os documentos podem voltar a caber em
+    # int64, como na leitura da fila atualizada
+    if not pd.api.types.is_integer_dtype(df_atual['DOCUMENTO_PACIENTE']):
+        documentos = converter_documentos(df_atual['DOCUMENTO_PACIENTE'])
+        if pd.api.types.is_integer_dtype(documentos):
+            df_atual['DOCUMENTO_PACIENTE'] = documentos
+            for tabela in (relatorio_agrupamentos, relatorio_nao_agrupados):
+                tabela['DOCUMENTO_PACIENTE'] = tabela[
+                    'DOCUMENTO_PACIENTE'
+                ].astype('int64')
+
+    return {
+        'relatorio_agrupamentos': relatorio_agrupamentos,
+        'relatorio_nao_agrupados': relatorio_nao_agrupados,
+        'total_pacientes': df_atual['DOCUMENTO_PACIENTE'].nunique(),
+        'pacientes_agrupados': relatorio_agrupamentos[
+            'DOCUMENTO_PACIENTE'
+        ].nunique(),
+        'agrupamentos_encontrados': relatorio_agrupamentos[
+            'AGRUPAMENTO_OCI'
+        ].nunique(),
+        'total_solicitacoes': len(df_atual),
+        'gerado_em': datetime.now(),
+        'base_incremental': {
+            'solicitacoes': df_atual,
+            'ordem_agrupamentos': ordem_agrupamentos,
+            'linhas_nao_agrupados': linhas[indices],
+            'versao_catalogo': catalogo['versao'],
+        },
+        'alteracoes': dict(alteracoes, pacientes_recalculados=len(afetados)),
+    }
+
+
+# Texto do relatório como visão sob demanda das tabelas estruturadas: cada
+# linha é descrita por um tipo e pela linha da tabela de origem, e só as
+# linhas pedidas são formatadas
+(
+    LINHA_CABECALHO,
+    LINHA_SEPARADOR,
+    LINHA_TITULO,
+    LINHA_PACIENTE,
+    LINHA_ITEM,
+    LINHA_MARCADOR,
+    LINHA_NAO_AGRUPADO,
+    LINHA_RODAPE,
+) = range(8)
+
+TEXTO_CABECALHO = (
+    "*********************    FORAM ENCONTRADOS {} CONJUNTOS DE OCI'S    "
+    '***********************\n'
+)
+TEXTO_MARCADOR = (
+    '\n********************    PACIENTES QUE NÃO ESTÃO EM NENHUM CONJUNTO  '
+    '***********************'
+)
+
+
+def posicoes_relatorio(resultado):
+    # Posição, no texto do relatório, de cada linha de item das tabelas
+    # estruturadas e das linhas de contexto do seu grupo. O texto segue a
+    # ordem de relatorio_agrupamentos: cabeçalho geral; por OCI, separador e
+    # título; por paciente, a linha do paciente e seus itens; depois o
+    # marcador, uma linha por solicitação não agrupada e o rodapé
+    agrupamentos = resultado['relatorio_agrupamentos']
+    total = len(agrupamentos)
+    oci = agrupamentos['AGRUPAMENTO_OCI'].to_numpy()
+    documento = agrupamentos['DOCUMENTO_PACIENTE'].to_numpy()
+    nova_oci = np.ones(total, dtype=bool)
+    nova_oci[1:] = oci[1:] != oci[:-1]
+    novo_paciente = nova_oci.copy()
+    novo_paciente[1:] |= documento[1:] != documento[:-1]
+
+    item = (
+        1
+        + np.arange(total)
+        + 2 * np.cumsum(nova_oci)
+        + np.cumsum(novo_paciente)
+    )
+    paciente = (item[novo_paciente] - 1)[np.cumsum(novo_paciente) - 1]
+    separador = (item[nova_oci] - 3)[np.cumsum(nova_oci) - 1]
+    marcador = 1 + total + 2 * int(nova_oci.sum()) + int(novo_paciente.sum())
+    nao_agrupados = marcador + 1 + np.arange(
+        len(resultado['relatorio_nao_agrupados'])
+    )
+    return item, paciente, separador, marcador, nao_agrupados
+
+
+def mapa_relatorio(resultado):
+    # Tipo e linha da tabela de origem de cada linha do texto. Linhas de
+    # contexto apontam para uma linha qualquer do seu grupo
+    item, paciente, separador, marcador, nao_agrupados = posicoes_relatorio(
+        resultado
+    )
+    total = marcador + len(nao_agrupados) + 2
+    tipos = np.empty(total, dtype=np.int8)
+    origem = np.zeros(total, dtype=np.int64)
+    linhas_tabela = np.arange(len(item))
+
+    tipos[0] = LINHA_CABECALHO
+    for posicoes, tipo in (
+        (separador, LINHA_SEPARADOR),
+        (separador + 1, LINHA_TITULO),
+        (paciente, LINHA_PACIENTE),
+        (item, LINHA_ITEM),
+    ):
+        tipos[posicoes] = tipo
+        origem[posicoes] = linhas_tabela
+    tipos[marcador] = LINHA_MARCADOR
+    tipos[nao_agrupados] = LINHA_NAO_AGRUPADO
+    origem[nao_agrupados] = np.arange(len(nao_agrupados))
+    tipos[-1] = LINHA_RODAPE
+    return tipos, origem
+
+
+def formatar_linhas_relatorio(resultado, tipos, origem):
+    # Formata, em bloco por tipo, apenas as linhas indicadas
+    linhas = np.empty(len(tipos), dtype=object)
+
+    def selecionar(tipo, tabela):
+        selecao = tipos == tipo
+        if not selecao.any():
+            return selecao, None
+        return selecao, resultado[tabela].iloc[origem[selecao]]
+
+    linhas[tipos == LINHA_CABECALHO] = TEXTO_CABECALHO.format(
+        resultado['agrupamentos_encontrados']
+    )
+    linhas[tipos == LINHA_SEPARADOR] = '_' * 89
+    linhas[tipos == LINHA_MARCADOR] = TEXTO_MARCADOR
+    linhas[tipos == LINHA_RODAPE] = '\n{:%d/%m/%Y %H:%M:%S}'.format(
+        resultado['gerado_em']
+    )
+
+    selecao, df = selecionar(LINHA_TITULO, 'relatorio_agrupamentos')
+    if df is not None:
+        linhas[selecao] = (
+            df['AGRUPAMENTO_OCI'] + ' - ' + df['DESCRICAO_OCI'] + '\n'
+        ).to_numpy()
+
+    selecao, df = selecionar(LINHA_PACIENTE, 'relatorio_agrupamentos')
+    if df is not None:
+        linhas[selecao] = (
+            '--- ' + formatar_texto(df['DOCUMENTO_PACIENTE'])
+        ).to_numpy()
+
+    selecao, df = selecionar(LINHA_ITEM, 'relatorio_agrupamentos')
+    if df is not None:
+        linhas[selecao] = (
+            '-------- '
+            + df['ITEM OBG/FAC (X)']
+            + '\tCNES_SOLC '
+            + formatar_texto(df['CNES_SOLICITANTE'])
+            + '\tCID-'
+            + formatar_texto(df['CID10'])
+            + '\tDT_SOLC-'
+            + formatar_texto(df['DATA_SOLICITACAO'])
+            + '\t'
+            + formatar_texto(df['CODIGO_SIGTAP'])
+            + ' - '
+            + df['DESCRICAO_SIGTAP']
+        ).to_numpy()
+
+    selecao, df = selecionar(LINHA_NAO_AGRUPADO, 'relatorio_nao_agrupados')
+    if df is not None:
+        linhas[selecao] = (
+            '- CNES_SOLC '
+            + formatar_texto(df['CNES_SOLICITANTE'])
+            + '\tCID '
+            + formatar_texto(df['CID10'])
+            + '\tCNS/CPF_PAC '
+            + formatar_texto(df['DOCUMENTO_PACIENTE'])
+            + '\tDT_SOLC '
+            + formatar_texto(df['DATA_SOLICITACAO'])
+            + '\t'
+            + formatar_texto(df['CODIGO_SIGTAP'])
+            + ' - '
+            + df['DESCRICAO_SIGTAP']
+        ).to_numpy()
+
+    return linhas.tolist()
+
+
+def linhas_relatorio(resultado, posicoes, mapa=None):
+    # Linhas do texto nas posições indicadas (janela ou resultado de filtro)
+    tipos, origem = mapa if mapa is not None else mapa_relatorio(resultado)
+    return formatar_linhas_relatorio(
+        resultado, tipos[posicoes], origem[posicoes]
+    )
+
+
+def gerar_linhas_relatorio(resultado, inicio=0, fim=None, mapa=None):
+    # Gera o texto do relatório (ou o trecho inicio..fim) em blocos
+    tipos, origem = mapa if mapa is not None else mapa_relatorio(resultado)
+    fim = len(tipos) if fim is None else min(fim, len(tipos))
+    bloco = app.config['EXPORTACAO_BLOCO_LINHAS']
+    for posicao in range(inicio, fim, bloco):
+        final = min(posicao + bloco, fim)
+        yield from formatar_linhas_relatorio(
+            resultado, tipos[posicao:final], origem[posicao:final]
+        )
+
+
+# Colunas da tabela de não agrupados no PDF: coluna, título e largura (pt)
+PDF_COLUNAS_NAO_AGRUPADOS = [
+    ('DOCUMENTO_PACIENTE', 'Documento', 95),
+    ('DATA_SOLICITACAO', 'Data Solicitação', 70),
+    ('CNES_SOLICITANTE', 'CNES Solicitante', 70),
+    ('CID10', 'CID10', 40),
+    ('CODIGO_SIGTAP', 'SIGTAP', 60),
+    ('DESCRICAO_SIGTAP', 'Descrição SIGTAP', 352),
+    ('CBO', 'CBO', 45),
+]
+PDF_FONTE_TABELA = ('Courier', 8)
+PDF_TITULO_NAO_AGRUPADOS = 'PACIENTES QUE NÃO ESTÃO EM NENHUM CONJUNTO'
+
+PDF_LOGO = os.path.join(
+    app.root_path, 'static', 'img', 'agora-tem-especialistas.png'
+)
+_logo_pdf = None
+
+
+def obter_logo_pdf():
+    # Decodifica o logo uma única vez por processo
+    global _logo_pdf
+    if _logo_pdf is None:
+        try:
+            _logo_pdf = ImageReader(PDF_LOGO)
+            _logo_pdf.getRGBData()
+        except Exception:
+            _logo_pdf = False  # Ignora o logo se a imagem não existir
+    return _logo_pdf or None
+
+
+def desenhar_paginas_pdf(
+    caminho, paginas, primeira_pagina, tempo_processamento, data_hora
+):
+    # Desenha as páginas já paginadas em um arquivo PDF, numeradas a partir
+    # de primeira_pagina. Cada página é ('texto', linhas) ou ('tabela',
+    # linhas da tabela de não agrupados)
+    c = canvas.Canvas(caminho, pagesize=landscape(letter))
+    width, height = landscape(letter)
+    margem_esquerda = 30
+    linha_altura = 12
+
+    # O logo entra no documento uma vez, como form XObject, e cada página
+    # apenas o referencia
+    logo = obter_logo_pdf()
+    if logo is not None:
+        c.beginForm('logo')
+        c.drawImage(
+            logo, margem_esquerda, height - 80, width=100, height=50
+        )
+        c.endForm()
+
+    for pagina, (tipo, linhas) in enumerate(paginas, primeira_pagina):
+        # Cabeçalho
+        if logo is not None:
+            c.doForm('logo')
+        c.setFont('Helvetica-Bold', 16)
+        c.drawString(
+            margem_esquerda + 120,
+            height - 60,
+            'Relatório de Análise de Filas OCI',
+        )
+        c.setFont('Helvetica', 10)
+        fonte_atual = ('Helvetica', 10)
+        c.drawString(
+            margem_esquerda + 120, height - 80, f'Gerado em: {data_hora}'
+        )
+        c.drawString(
+            margem_esquerda + 120,
+            height - 95,
+            f'Tempo de processamento: {tempo_processamento} segundos',
+        )
+        c.drawRightString(
+            width - margem_esquerda, height - 95, f'Página {pagina}'
+        )
+        c.line(
+            margem_esquerda,
+            height - 105,
+            width - margem_esquerda,
+            height - 105,
+        )
+
+        y = height - 120
+        if tipo == 'tabela':
+            desenhar_tabela_pdf(c, linhas, margem_esquerda, y, linha_altura)
+            c.showPage()
+            continue
+
+        # Conteúdo; a fonte só é trocada quando muda de uma linha para outra
+        for linha in linhas:
+            if linha.startswith('---'):
+                fonte = ('Courier', 8)
+            else:
+                fonte = ('Helvetica-Bold', 9)
+            if fonte != fonte_atual:
+                c.setFont(*fonte)
+                fonte_atual = fonte
+
+            # Limita para evitar overflow
+            c.drawString(margem_esquerda, y, linha[:200])
+            y -= linha_altura
+
+        c.showPage()
+
+    c.save()
+
+
+def desenhar_tabela_pdf(c, linhas, margem_esquerda, y, linha_altura):
+    # Título da seção e cabeçalho da tabela, repetidos em cada página
+    c.setFont('Helvetica-Bold', 9)
+    c.drawString(margem_esquerda, y, PDF_TITULO_NAO_AGRUPADOS)
+    y -= linha_altura
+
+    posicoes = []
+    x = margem_esquerda
+    c.setFont('Helvetica-Bold', 8)
+    for _, titulo, largura in PDF_COLUNAS_NAO_AGRUPADOS:
+        c.drawString(x, y, titulo)
+        posicoes.append(x)
+        x += largura
+    c.line(margem_esquerda, y - 3, x, y - 3)
+    y -= linha_altura
+
+    # As células já chegam cortadas na largura de cada coluna
+    c.setFont(*PDF_FONTE_TABELA)
+    for linha in linhas:
+        for x, valor in zip(posicoes, linha):
+            c.drawString(x, y, valor)
+        y -= linha_altura
+
+
+def linhas_tabela_pdf(df):
+    # Linhas da tabela de não agrupados com as células cortadas para caber
+    # na coluna; vetorizado por coluna, um bloco de linhas por vez
+    nome_fonte, tamanho_fonte = PDF_FONTE_TABELA
+    largura_caractere = pdfmetrics.stringWidth('0', nome_fonte, tamanho_fonte)
+    limites = [
+        (coluna, int(largura // largura_caractere) - 1)
+        for coluna, _, largura in PDF_COLUNAS_NAO_AGRUPADOS
+    ]
+    bloco = app.config['EXPORTACAO_BLOCO_LINHAS']
+    for inicio in range(0, len(df), bloco):
+        parte = df.iloc[inicio:inicio + bloco]
+        yield from zip(
+            *(
+                formatar_texto(parte[coluna])
+                .str.slice(0, max_caracteres)
+                .tolist()
+                for coluna, max_caracteres in limites
+            )
+        )
+
+
+def linhas_por_pagina_pdf(linhas_reservadas=0):
+    # Mesma paginação do layout original: até 50 linhas por página, limitadas
+    # pelo espaço entre o cabeçalho e a margem inferior, descontadas as
+    # linhas reservadas para títulos repetidos em cada página
+    height = landscape(letter)[1]
+    linha_altura = 12
+    max_linhas_por_pagina = 50
+    return min(
+        max_linhas_por_pagina, int((height - 120 - 50) // linha_altura) + 1
+    ) - linhas_reservadas
+
+
+def paginar_linhas(linhas, linhas_reservadas=0):
+    # Agrupa as linhas (qualquer iterável) em páginas, sob demanda
+    linhas = iter(linhas)
+    linhas_por_pagina = linhas_por_pagina_pdf(linhas_reservadas)
+    while True:
+        pagina = list(islice(linhas, linhas_por_pagina))
+        if not pagina:
+            return
+        yield pagina
+
+
+def paginas_pdf(resultado, incluir_nao_agrupados):
+    # Páginas do PDF geradas sob demanda a partir do texto do relatório (só
+    # até o marcador dos não agrupados) e, opcionalmente, da tabela dos
+    # pacientes fora de conjuntos. Retorna o total de páginas, calculado
+    # sem formatar nada, e o gerador
+    marcador = posicoes_relatorio(resultado)[3]
+    nao_agrupados = resultado['relatorio_nao_agrupados']
+    incluir_tabela = incluir_nao_agrupados and not nao_agrupados.empty
+    total = -(-marcador // linhas_por_pagina_pdf())
+    if incluir_tabela:
+        total += -(-len(nao_agrupados) // linhas_por_pagina_pdf(2))
+
+    def gerar():
+        for linhas in paginar_linhas(
+            gerar_linhas_relatorio(resultado, fim=marcador)
+        ):
+            yield ('texto', linhas)
+        if incluir_tabela:
+            for linhas in paginar_linhas(
+                linhas_tabela_pdf(nao_agrupados), linhas_reservadas=2
+            ):
+                yield ('tabela', linhas)
+
+    return total, gerar()
+
+
+def gerar_pdf(resultado, incluir_nao_agrupados=False):
+    # Texto dos agrupamentos e, opcionalmente, a tabela paginada dos
+    # pacientes fora de conjuntos. As páginas são formatadas sob demanda:
+    # em memória ficam só as da parte sendo desenhada (ou enviadas aos
+    # processos do pool)
+    tempo_processamento = resultado['resumo']['tempo_processamento']
+    data_hora = datetime.now().strftime('%d/%m/%Y %H:%M:%S')
+    total_paginas, paginas = paginas_pdf(resultado, incluir_nao_agrupados)
+
+    # Arquivo temporário em disco em vez de buffer em memória
+    descritor, caminho = tempfile.mkstemp(suffix='.pdf')
+    os.close(descritor)
+    paginas_por_parte = app.config['PDF_PAGINAS_POR_PARTE']
+    processos = app.config['PDF_PROCESSOS']
+    try:
+        if total_paginas <= paginas_por_parte or processos < 2:
+            desenhar_paginas_pdf(
+                caminho, paginas, 1, tempo_processamento, data_hora
+            )
+            return caminho
+
+        # Relatórios grandes: as partes são desenhadas em paralelo, cada uma
+        # em seu próprio arquivo, e depois concatenadas na ordem. No máximo
+        # uma parte por processo fica pendente, para não formatar todas as
+        # páginas de uma vez
+        partes = []
+        try:
+            pendentes = deque()
+            primeira_pagina = 1
+            while True:
+                parte_paginas = list(islice(paginas, paginas_por_parte))
+                if not parte_paginas:
+                    break
+                if len(pendentes) >= processos:
+                    pendentes.popleft().result()
+                descritor, parte = tempfile.mkstemp(suffix='.pdf')
+                os.close(descritor)
+                partes.append(parte)
+                pendentes.append(
+                    submeter(
+                        'PDF_PROCESSOS',
+                        desenhar_paginas_pdf,
+                        parte,
+                        parte_paginas,
+                        primeira_pagina,
+                        tempo_processamento,
+                        data_hora,
+                    )
+                )
+                primeira_pagina += len(parte_paginas)
+                del parte_paginas
+            for futuro in pendentes:
+                futuro.result()
+
+            writer = PdfWriter()
+            for parte in partes:
+                writer.append(parte, import_outline=False)
+            writer.write(caminho)
+        finally:
+            for parte in partes:
+                os.remove(parte)
+        return caminho
+    except Exception:
+        os.remove(caminho)
+        raise
+
+
+def escrever_aba_xlsx(workbook, nome, df, formato_cabecalho):
+    worksheet = workbook.add_worksheet(nome)
+
+    # Cabeçalho
+    worksheet.write_row(0, 0, list(df.columns), formato_cabecalho)
+    larguras = np.array([len(coluna) for coluna in df.columns])
+
+    # Linhas escritas em ordem, bloco a bloco (modo constant_memory): só o
+    # texto do bloco atual existe em memória
+    bloco_linhas = app.config['EXPORTACAO_BLOCO_LINHAS']
+    linha = 1
+    for inicio in range(0, len(df), bloco_linhas):
+        texto = formatar_tabela(df.iloc[inicio : inicio + bloco_linhas])
+        larguras = np.maximum(
+            larguras,
+            [texto[coluna].str.len().max() for coluna in texto.columns],
+        )
+        for valores in texto.itertuples(index=False, name=None):
+            worksheet.write_row(linha, 0, valores)
+            linha += 1
+
+    # Ajusta largura das colunas
+    for col_num, largura in enumerate(larguras):
+        worksheet.set_column(col_num, col_num, min(int(largura) + 2, 50))
+
+    # Congela cabeçalho
+    worksheet.freeze_panes(1, 0)
+
+
+def gerar_xlsx(resultado):
+    df_agrupamentos = resultado['relatorio_agrupamentos']
+    df_nao_agrupados = resultado['relatorio_nao_agrupados']
+
+    # Ordena os dados (documento do paciente pela sua forma em texto)
+    if not df_agrupamentos.empty:
+        df_agrupamentos = df_agrupamentos.sort_values(
+            by=[
+                'AGRUPAMENTO_OCI',
+                'DOCUMENTO_PACIENTE',
+                'ITEM OBG/FAC (X)',
+                'CODIGO_SIGTAP',
+            ],
+            key=lambda coluna: (
+                formatar_texto(coluna)
+                if coluna.name == 'DOCUMENTO_PACIENTE'
+                else coluna
+            ),
+            kind='stable',
+        )
+
+    # Arquivo temporário em disco em vez de buffer em memória
+    descritor, caminho = tempfile.mkstemp(suffix='.xlsx')
+    os.close(descritor)
+    try:
+        workbook = xlsxwriter.Workbook(caminho, {'constant_memory': True})
+
+        # Formatação de cabeçalho (compartilhada pelas duas abas)
+        formato_cabecalho = workbook.add_format(
             {
-                'codigo': '0205020097',
-                'descricao': 'ULTRASSONOGRAFIA MAMARIA BILATERAL',
+                'bold': True,
+                'text_wrap': True,
+                'valign': 'top',
+                'fg_color': '#4472C4',
+                'font_color': 'white',
+                'border': 1,
             }
-        ],
-    },
-    '0901010090': {
-        'nome': 'OCI PROGRESSÃO DA AVALIAÇÃO DIAGNÓSTICA DE CÂNCER DE MAMA - I',
-        'itens_obrigatorios': [
-            {
-                'codigo': '0203010043',
-                'descricao': 'EXAME CITOPATOLOGICO DE MAMA',
-            },
-            {
-                'codigo': '0201010585',
-                'descricao': 'PUNÇÃO ASPIRATIVA DE MAMA POR AGULHA FINA',
-            },
-            {
-                'codigo': '0301010072',
-                'descricao': 'CONSULTA MEDICA EM ATENÇÃO ESPECIALIZADA',
-            },
-            {
-                'codigo': '0301010307',
-                'descricao': 'TELECONSULTA MÉDICA NA ATENÇÃO ESPECIALIZADA',
-            },
-        ],
-        'itens_facultativos': [
-            {
-                'codigo': '0201010569',
-                'descricao': 'BIOPSIA/EXERESE DE NÓDULO DE MAMA',
-            }
-        ],
-    },
-    '0901010103': {
-        'nome': 'OCI PROGRESSÃO DA AVALIAÇÃO DIAGNÓSTICA DE CÂNCER DE MAMA-II',
-        'itens_obrigatorios': [
-            {
-                'codigo': '0201010607',
-                'descricao': 'PUNÇÃO DE MAMA POR AGULHA GROSSA',
-            },
-            {
-                'codigo': '0203020065',
-                'descricao': 'EXAME ANATOMOPATOLOGICO DE MAMA - BIOPSIA',
-            },
-            {
-                'codigo': '0301010072',
-                'descricao': 'CONSULTA MEDICA EM ATENÇÃO ESPECIALIZADA',
-            },
-            {
-                'codigo': '0301010307',
-                'descricao': 'TELECONSULTA MÉDICA NA ATENÇÃO ESPECIALIZADA',
-            },
-        ],
-        'itens_facultativos': [
-            {
-                'codigo': '0201010569',
-                'descricao': 'BIOPSIA/EXERESE DE NÓDULO DE MAMA',
-            }
-        ],
-    },
-    '0901010057': {
-        'nome': 'OCI INVESTIGAÇÃO DIAGNÓSTICA DE CÂNCER DE COLO DE ÚTERO',
-        'itens_obrigatorios': [
-            {'codigo': '0201010666', 'descricao': 'BIOPSIA DO COLO UTERINO'},
-            {
-                'codigo': '0203020081',
-                'descricao': 'EXAME ANATOMO-PATOLOGICO DO COLO UTERINO - BIOPSIA',
-            },
-            {
-                'codigo': '0301010072',
-                'descricao': 'CONSULTA MEDICA EM ATENÇÃO ESPECIALIZADA',
-            },
-            {
-                'codigo': '0301010307',
-                'descricao': 'TELECONSULTA MÉDICA NA ATENÇÃO ESPECIALIZADA',
-            },
-        ],
-        'itens_facultativos': [
-            {'codigo': '0211040029', 'descricao': 'COLPOSCOPIA'}
-        ],
-    },
-    '0901010111': {
-        'nome': 'OCI AVALIAÇÃO DIAGNÓSTICA E TERAPÊUTICA DE CÂNCER DE COLO DO ÚTERO-I',
-        'itens_obrigatorios': [
-            {
-                'codigo': '0203020022',
-                'descricao': 'EXAME ANATOMO-PATOLOGICO DO COLO UTERINO - PECA CIRURGICA',
-            },
-            {
-                'codigo': '0409060089',
-                'descricao': 'EXCISÃO TIPO I DO COLO UTERINO',
-            },
-            {
-                'codigo': '0301010072',
-                'descricao': 'CONSULTA MEDICA EM ATENÇÃO ESPECIALIZADA',
-            },
-            {
-                'codigo': '0301010307',
-                'descricao': 'TELECONSULTA MÉDICA NA ATENÇÃO ESPECIALIZADA',
-            },
-        ],
-        'itens_facultativos': [
-            {'codigo': '0211040029', 'descricao': 'COLPOSCOPIA'}
-        ],
-    },
-    '0901010120': {
-        'nome': 'OCI AVALIAÇÃO DIAGNÓSTICA E TERAPÊUTICA DE CÂNCER DE COLO DO ÚTERO-II',
-        'itens_obrigatorios': [
-            {
-                'codigo': '0203020022',
-                'descricao': 'EXAME ANATOMO-PATOLOGICO DO COLO UTERINO - PECA CIRURGICA',
-            },
-            {
-                'codigo': '0409060305',
-                'descricao': 'EXCISÃO TIPO 2 DO COLO UTERINO',
-            },
-            {
-                'codigo': '0301010072',
-                'descricao': 'CONSULTA MEDICA EM ATENÇÃO ESPECIALIZADA',
-            },
-        ],
-        'itens_facultativos': [
-            {'codigo': '0211040029', 'descricao': 'COLPOSCOPIA'}
-        ],
-    },
-    '0901010049': {
-        'nome': 'OCI PROGRESSÃO DA AVALIAÇÃO DIAGNÓSTICA DE CÂNCER DE PRÓSTATA',
-        'itens_obrigatorios': [
-            {'codigo': '0201010410', 'descricao': 'BIÓPSIA DE PRÓSTATA'},
-            {
-                'codigo': '0203020030',
-                'descricao': 'EXAME ANATOMO-PATOLÓGICO PARA CONGELAMENTO / PARAFINA POR PEÇA CIRURGICA OU POR BIOPSIA (EXCETO COLO UTERINO E MAMA)',
-            },
-            {
-                'codigo': '0205020119',
-                'descricao': 'ULTRASSONOGRAFIA DE PROSTATA (VIA TRANSRETAL)',
-            },
-            {
-                'codigo': '0301010307',
-                'descricao': 'TELECONSULTA MÉDICA NA ATENÇÃO ESPECIALIZADA',
-            },
-            {
-                'codigo': '0301010072',
-                'descricao': 'CONSULTA MEDICA EM ATENÇÃO ESPECIALIZADA',
-            },
-        ],
-        'itens_facultativos': [],
-    },
-    '0901010073': {
-        'nome': 'OCI AVALIAÇÃO DIAGNÓSTICA DE CÂNCER GÁSTRICO',
-        'itens_obrigatorios': [
-            {
-                'codigo': '0209010037',
-                'descricao': 'ESOFAGOGASTRODUODENOSCOPIA',
-            },
-            {
-                'codigo': '0301010307',
-                'descricao': 'TELECONSULTA MÉDICA NA ATENÇÃO ESPECIALIZADA',
-            },
-            {
-                'codigo': '0301010072',
-                'descricao': 'CONSULTA MEDICA EM ATENÇÃO ESPECIALIZADA',
-            },
-        ],
-        'itens_facultativos': [
-            {
-                'codigo': '0203020030',
-                'descricao': 'EXAME ANATOMO-PATOLÓGICO PARA CONGELAMENTO / PARAFINA POR PEÇA CIRURGICA OU POR BIOPSIA (EXCETO COLO UTERINO E MAMA)',
-            }
-        ],
-    },
-    '0901010081': {
-        'nome': 'OCI AVALIAÇÃO DIAGNÓSTICA DE CÂNCER COLORRETAL',
-        'itens_obrigatorios': [
-            {'codigo': '0209010029', 'descricao': 'COLONOSCOPIA (COLOSCOPIA)'},
-            {
-                'codigo': '0301010072',
-                'descricao': 'CONSULTA MEDICA EM ATENÇÃO ESPECIALIZADA',
-            },
-            {
-                'codigo': '0301010307',
-                'descricao': 'TELECONSULTA MÉDICA NA ATENÇÃO ESPECIALIZADA',
-            },
-        ],
-        'itens_facultativos': [
-            {
-                'codigo': '0203020030',
-                'descricao': 'EXAME ANATOMO-PATOLÓGICO PARA CONGELAMENTO / PARAFINA POR PEÇA CIRURGICA OU POR BIOPSIA (EXCETO COLO UTERINO E MAMA)',
-            }
-        ],
-    },
-    '0902010018': {
-        'nome': 'OCI AVALIAÇÃO DE RISCO CIRÚRGICO',
-        'itens_obrigatorios': [
-            {'codigo': '0211020036', 'descricao': 'ELETROCARDIOGRAMA'},
-            {
-                'codigo': '0301010072',
-                'descricao': 'CONSULTA MEDICA EM ATENÇÃO ESPECIALIZADA',
-            },
-            {
-                'codigo': '0301010307',
-                'descricao': 'TELECONSULTA MÉDICA NA ATENÇÃO ESPECIALIZADA',
-            },
-        ],
-        'itens_facultativos': [
-            {'codigo': '0202010279', 'descricao': 'DOSAGEM DE COLESTEROL HDL'},
-            {'codigo': '0202010287', 'descricao': 'DOSAGEM DE COLESTEROL LDL'},
-            {
-                'codigo': '0202010295',
-                'descricao': 'DOSAGEM DE COLESTEROL TOTAL',
-            },
-            {'codigo': '0202010317', 'descricao': 'DOSAGEM DE CREATININA'},
-            {'codigo': '0202010473', 'descricao': 'DOSAGEM DE GLICOSE'},
-            {
-                'codigo': '0202010503',
-                'descricao': 'DOSAGEM DE HEMOGLOBINA GLICOSILADA',
-            },
-            {'codigo': '0202010600', 'descricao': 'DOSAGEM DE POTASSIO'},
-            {'codigo': '0202010635', 'descricao': 'DOSAGEM DE SODIO'},
-            {
-                'codigo': '0202010643',
-                'descricao': 'DOSAGEM DE TRANSAMINASE GLUTAMICO-OXALACETICA (TGO)',
-            },
-            {
-                'codigo': '0202010651',
-                'descricao': 'DOSAGEM DE TRANSAMINASE GLUTAMICO-PIRUVICA (TGP)',
-            },
-            {'codigo': '0202010678', 'descricao': 'DOSAGEM DE TRIGLICERIDEOS'},
-            {'codigo': '0202010694', 'descricao': 'DOSAGEM DE UREIA'},
-            {'codigo': '0202020380', 'descricao': 'HEMOGRAMA COMPLETO'},
-            {
-                'codigo': '0204030153',
-                'descricao': 'RADIOGRAFIA DE TORAX (PA E PERFIL)',
-            },
-        ],
-    },
-    '0902010026': {
-        'nome': 'OCI AVALIAÇÃO CARDIOLÓGICA',
-        'itens_obrigatorios': [
-            {
-                'codigo': '0204030153',
-                'descricao': 'RADIOGRAFIA DE TORAX (PA E PERFIL)',
-            },
-            {'codigo': '0211020036', 'descricao': 'ELETROCARDIOGRAMA'},
-            {
-                'codigo': '0301010072',
-                'descricao': 'CONSULTA MEDICA EM ATENÇÃO ESPECIALIZADA',
-            },
-            {
-                'codigo': '0301010307',
-                'descricao': 'TELECONSULTA MÉDICA NA ATENÇÃO ESPECIALIZADA',
-            },
-        ],
-        'itens_facultativos': [
-            {'codigo': '0202010279', 'descricao': 'DOSAGEM DE COLESTEROL HDL'},
-            {'codigo': '0202010287', 'descricao': 'DOSAGEM DE COLESTEROL LDL'},
-            {
-                'codigo': '0202010295',
-                'descricao': 'DOSAGEM DE COLESTEROL TOTAL',
-            },
-            {'codigo': '0202010317', 'descricao': 'DOSAGEM DE CREATININA'},
-            {'codigo': '0202010473', 'descricao': 'DOSAGEM DE GLICOSE'},
-            {
-                'codigo': '0202010503',
-                'descricao': 'DOSAGEM DE HEMOGLOBINA GLICOSILADA',
-            },
-            {'codigo': '0202010600', 'descricao': 'DOSAGEM DE POTASSIO'},
-            {'codigo': '0202010635', 'descricao': 'DOSAGEM DE SODIO'},
-            {
-                'codigo': '0202010643',
-                'descricao': 'DOSAGEM DE TRANSAMINASE GLUTAMICO-OXALACETICA (TGO)',
-            },
-            {
-                'codigo': '0202010651',
-                'descricao': 'DOSAGEM DE TRANSAMINASE GLUTAMICO-PIRUVICA (TGP)',
-            },
-            {'codigo': '0202010678', 'descricao': 'DOSAGEM DE TRIGLICERIDEOS'},
-            {'codigo': '0202010694', 'descricao': 'DOSAGEM DE UREIA'},
-            {'codigo': '0202020380', 'descricao': 'HEMOGRAMA COMPLETO'},
-            {
-                'codigo': '0205010032',
-                'descricao': 'ECOCARDIOGRAFIA TRANSTORACICA',
-            },
-        ],
-    },
-    '0902010034': {
-        'nome': 'OCI AVALIAÇÃO DIAGNÓSTICA INICIAL - SÍNDROME CORONARIANA CRÔNICA',
-        'itens_obrigatorios': [
-            {'codigo': '0211020036', 'descricao': 'ELETROCARDIOGRAMA'},
-            {
-                'codigo': '0211020060',
-                'descricao': 'TESTE DE ESFORCO / TESTE ERGOMETRICO',
-            },
-            {
-                'codigo': '0301010072',
-                'descricao': 'CONSULTA MEDICA EM ATENÇÃO ESPECIALIZADA',
-            },
-            {
-                'codigo': '0301010307',
-                'descricao': 'TELECONSULTA MÉDICA NA ATENÇÃO ESPECIALIZADA',
-            },
-        ],
-        'itens_facultativos': [
-            {'codigo': '0202010279', 'descricao': 'DOSAGEM DE COLESTEROL HDL'},
-            {'codigo': '0202010287', 'descricao': 'DOSAGEM DE COLESTEROL LDL'},
-            {
-                'codigo': '0202010295',
-                'descricao': 'DOSAGEM DE COLESTEROL TOTAL',
-            },
-            {'codigo': '0202010317', 'descricao': 'DOSAGEM DE CREATININA'},
-            {'codigo': '0202010473', 'descricao': 'DOSAGEM DE GLICOSE'},
-            {
-                'codigo': '0202010503',
-                'descricao': 'DOSAGEM DE HEMOGLOBINA GLICOSILADA',
-            },
-            {'codigo': '0202010600', 'descricao': 'DOSAGEM DE POTASSIO'},
-            {'codigo': '0202010635', 'descricao': 'DOSAGEM DE SODIO'},
-            {
-                'codigo': '0202010643',
-                'descricao': 'DOSAGEM DE TRANSAMINASE GLUTAMICO-OXALACETICA (TGO)',
-            },
-            {
-                'codigo': '0202010651',
-                'descricao': 'DOSAGEM DE TRANSAMINASE GLUTAMICO-PIRUVICA (TGP)',
-            },
-            {'codigo': '0202010678', 'descricao': 'DOSAGEM DE TRIGLICERIDEOS'},
-            {'codigo': '0202010694', 'descricao': 'DOSAGEM DE UREIA'},
-            {'codigo': '0202020380', 'descricao': 'HEMOGRAMA COMPLETO'},
-            {
-                'codigo': '0205010032',
-                'descricao': 'ECOCARDIOGRAFIA TRANSTORACICA',
-            },
-        ],
-    },
-    '0902010042': {
-        'nome': 'OCI PROGRESSÃO DA AVALIAÇÃO DIAGNÓSTICA I – SÍNDROME CORONARIANA CRÔNICA',
-        'itens_obrigatorios': [
-            {
-                'codigo': '0205010016',
-                'descricao': 'ECOCARDIOGRAFIA DE ESTRESSE',
-            },
-            {
-                'codigo': '0301010072',
-                'descricao': 'CONSULTA MEDICA EM ATENÇÃO ESPECIALIZADA',
-            },
-            {
-                'codigo': '0301010307',
-                'descricao': 'TELECONSULTA MÉDICA NA ATENÇÃO ESPECIALIZADA',
-            },
-        ],
-        'itens_facultativos': [],
-    },
-    '0902010050': {
-        'nome': 'OCI PROGRESSÃO DA AVALIAÇÃO DIAGNÓSTICA II – SÍNDROME CORONARIANA CRÔNICA',
-        'itens_obrigatorios': [
-            {
-                'codigo': '0208010025',
-                'descricao': 'CINTILOGRAFIA DE MIOCARDIO P/ AVALIACAO DA PERFUSAO EM SITUACAO DE ESTRESSE (MINIMO 3 PROJECOES)',
-            },
-            {
-                'codigo': '0208010033',
-                'descricao': 'CINTILOGRAFIA DE MIOCARDIO P/ AVALIACAO DA PERFUSAO EM SITUACAO DE REPOUSO (MINIMO 3 PROJECOES)',
-            },
-            {
-                'codigo': '0301010072',
-                'descricao': 'CONSULTA MEDICA EM ATENÇÃO ESPECIALIZADA',
-            },
-            {
-                'codigo': '0301010307',
-                'descricao': 'TELECONSULTA MÉDICA NA ATENÇÃO ESPECIALIZADA',
-            },
-        ],
-        'itens_facultativos': [],
-    },
-    '0902010069': {
-        'nome': 'OCI AVALIAÇÃO DIAGNÓSTICA - INSUFICIÊNCIA CARDÍACA',
-        'itens_obrigatorios': [
-            {
-                'codigo': '0202010791',
-                'descricao': 'DOSAGEM DE PEPTÍDEOS NATRIURÉTICOS TIPO B (BNP E NT-PROBNP)',
-            },
-            {'codigo': '0211020036', 'descricao': 'ELETROCARDIOGRAMA'},
-            {
-                'codigo': '0211020044',
-                'descricao': 'MONITORAMENTO PELO SISTEMA HOLTER 24 HS (3 CANAIS)',
-            },
-            {
-                'codigo': '0211020060',
-                'descricao': 'TESTE DE ESFORCO / TESTE ERGOMETRICO',
-            },
-            {
-                'codigo': '0301010072',
-                'descricao': 'CONSULTA MEDICA EM ATENÇÃO ESPECIALIZADA',
-            },
-            {
-                'codigo': '0301010307',
-                'descricao': 'TELECONSULTA MÉDICA NA ATENÇÃO ESPECIALIZADA',
-            },
-        ],
-        'itens_facultativos': [
-            {'codigo': '0202010279', 'descricao': 'DOSAGEM DE COLESTEROL HDL'},
-            {'codigo': '0202010287', 'descricao': 'DOSAGEM DE COLESTEROL LDL'},
-            {
-                'codigo': '0202010295',
-                'descricao': 'DOSAGEM DE COLESTEROL TOTAL',
-            },
-            {'codigo': '0202010317', 'descricao': 'DOSAGEM DE CREATININA'},
-            {'codigo': '0202010473', 'descricao': 'DOSAGEM DE GLICOSE'},
-            {
-                'codigo': '0202010503',
-                'descricao': 'DOSAGEM DE HEMOGLOBINA GLICOSILADA',
-            },
-            {'codigo': '0202010600', 'descricao': 'DOSAGEM DE POTASSIO'},
-            {'codigo': '0202010635', 'descricao': 'DOSAGEM DE SODIO'},
-            {
-                'codigo': '0202010643',
-                'descricao': 'DOSAGEM DE TRANSAMINASE GLUTAMICO-OXALACETICA (TGO)',
-            },
-            {
-                'codigo': '0202010651',
-                'descricao': 'DOSAGEM DE TRANSAMINASE GLUTAMICO-PIRUVICA (TGP)',
-            },
-            {'codigo': '0202010678', 'descricao': 'DOSAGEM DE TRIGLICERIDEOS'},
-            {'codigo': '0202010694', 'descricao': 'DOSAGEM DE UREIA'},
-            {'codigo': '0202020380', 'descricao': 'HEMOGRAMA COMPLETO'},
-            {
-                'codigo': '0205010032',
-                'descricao': 'ECOCARDIOGRAFIA TRANSTORACICA',
-            },
-        ],
-    },
-    '0903010011': {
-        'nome': 'OCI AVALIAÇÃO DIAGNÓSTICA EM ORTOPEDIA COM RECURSOS DE RADIOLOGIA',
-        'itens_obrigatorios': [
-            {
-                'codigo': '0301010072',
-                'descricao': 'CONSULTA MEDICA EM ATENÇÃO ESPECIALIZADA',
-            },
-            {
-                'codigo': '0301010307',
-                'descricao': 'TELECONSULTA MÉDICA NA ATENÇÃO ESPECIALIZADA',
-            },
-        ],
-        'itens_facultativos': [
-            {
-                'codigo': '0204020034',
-                'descricao': 'RADIOGRAFIA DE COLUNA CERVICAL (AP + LATERAL + TO + OBLIQUAS)',
-            },
-            {
-                'codigo': '0204020042',
-                'descricao': 'RADIOGRAFIA DE COLUNA CERVICAL (AP + LATERAL + TO / FLEXAO)',
-            },
-            {
-                'codigo': '0204020077',
-                'descricao': 'RADIOGRAFIA DE COLUNA LOMBO-SACRA (C/ OBLIQUAS)',
-            },
-            {
-                'codigo': '0204020085',
-                'descricao': 'RADIOGRAFIA DE COLUNA LOMBO-SACRA FUNCIONAL / DINAMICA',
-            },
-            {
-                'codigo': '0204020093',
-                'descricao': 'RADIOGRAFIA DE COLUNA TORACICA (AP + LATERAL)',
-            },
-            {
-                'codigo': '0204020107',
-                'descricao': 'RADIOGRAFIA DE COLUNA TORACO-LOMBAR',
-            },
-            {
-                'codigo': '0204020131',
-                'descricao': 'RADIOGRAFIA PANORAMICA DE COLUNA TOTAL- TELESPONDILOGRAFIA ( P/ ESCOLIOSE)',
-            },
-            {
-                'codigo': '0204040035',
-                'descricao': 'RADIOGRAFIA DE ARTICULACAO ESCAPULO-UMERAL',
-            },
-            {'codigo': '0204040078', 'descricao': 'RADIOGRAFIA DE COTOVELO'},
-            {'codigo': '0204040094', 'descricao': 'RADIOGRAFIA DE MAO'},
-            {
-                'codigo': '0204040116',
-                'descricao': 'RADIOGRAFIA DE ESCAPULA/OMBRO (TRES POSICOES)',
-            },
-            {
-                'codigo': '0204040124',
-                'descricao': 'RADIOGRAFIA DE PUNHO (AP + LATERAL + OBLIQUA)',
-            },
-            {
-                'codigo': '0204060060',
-                'descricao': 'RADIOGRAFIA DE ARTICULACAO COXO-FEMORAL',
-            },
-            {'codigo': '0204060095', 'descricao': 'RADIOGRAFIA DE BACIA'},
-            {'codigo': '0204060109', 'descricao': 'RADIOGRAFIA DE CALCANEO'},
-            {
-                'codigo': '0204060125',
-                'descricao': 'RADIOGRAFIA DE JOELHO (AP + LATERAL)',
-            },
-            {
-                'codigo': '0204060133',
-                'descricao': 'RADIOGRAFIA DE JOELHO OU PATELA (AP + LATERAL + AXIAL)',
-            },
-            {
-                'codigo': '0204060141',
-                'descricao': 'RADIOGRAFIA DE JOELHO OU PATELA (AP + LATERAL + OBLIQUA + 3 AXIAIS)',
-            },
-            {
-                'codigo': '0204060150',
-                'descricao': 'RADIOGRAFIA DE PE / DEDOS DO PE',
-            },
-            {
-                'codigo': '0204060176',
-                'descricao': 'RADIOGRAFIA PANORAMICA DE MEMBROS INFERIORES',
-            },
-        ],
-    },
-    '0903010020': {
-        'nome': 'OCI AVALIAÇÃO DIAGNÓSTICA EM ORTOPEDIA COM RECURSOS DE RADIOLOGIA E ULTRASSONOGRAFIA',
-        'itens_obrigatorios': [
-            {
-                'codigo': '0205020062',
-                'descricao': 'ULTRASSONOGRAFIA DE ARTICULACAO',
-            },
-            {
-                'codigo': '0301010072',
-                'descricao': 'CONSULTA MEDICA EM ATENÇÃO ESPECIALIZADA',
-            },
-            {
-                'codigo': '0301010307',
-                'descricao': 'TELECONSULTA MÉDICA NA ATENÇÃO ESPECIALIZADA',
-            },
-        ],
-        'itens_facultativos': [
-            {
-                'codigo': '0204020034',
-                'descricao': 'RADIOGRAFIA DE COLUNA CERVICAL (AP + LATERAL + TO + OBLIQUAS)',
-            },
-            {
-                'codigo': '0204020042',
-                'descricao': 'RADIOGRAFIA DE COLUNA CERVICAL (AP + LATERAL + TO / FLEXAO)',
-            },
-            {
-                'codigo': '0204020077',
-                'descricao': 'RADIOGRAFIA DE COLUNA LOMBO-SACRA (C/ OBLIQUAS)',
-            },
-            {
-                'codigo': '0204020085',
-                'descricao': 'RADIOGRAFIA DE COLUNA LOMBO-SACRA FUNCIONAL / DINAMICA',
-            },
-            {
-                'codigo': '0204020093',
-                'descricao': 'RADIOGRAFIA DE COLUNA TORACICA (AP + LATERAL)',
-            },
-            {
-                'codigo': '0204020107',
-                'descricao': 'RADIOGRAFIA DE COLUNA TORACO-LOMBAR',
-            },
-            {
-                'codigo': '0204020131',
-                'descricao': 'RADIOGRAFIA PANORAMICA DE COLUNA TOTAL- TELESPONDILOGRAFIA ( P/ ESCOLIOSE)',
-            },
-            {
-                'codigo': '0204040035',
-                'descricao': 'RADIOGRAFIA DE ARTICULACAO ESCAPULO-UMERAL',
-            },
-            {'codigo': '0204040078', 'descricao': 'RADIOGRAFIA DE COTOVELO'},
-            {'codigo': '0204040094', 'descricao': 'RADIOGRAFIA DE MAO'},
-            {
-                'codigo': '0204040116',
-                'descricao': 'RADIOGRAFIA DE ESCAPULA/OMBRO (TRES POSICOES)',
-            },
-            {
-                'codigo': '0204040124',
-                'descricao': 'RADIOGRAFIA DE PUNHO (AP + LATERAL + OBLIQUA)',
-            },
-            {
-                'codigo': '0204060060',
-                'descricao': 'RADIOGRAFIA DE ARTICULACAO COXO-FEMORAL',
-            },
-            {'codigo': '0204060095', 'descricao': 'RADIOGRAFIA DE BACIA'},
-            {'codigo': '0204060109', 'descricao': 'RADIOGRAFIA DE CALCANEO'},
-            {
-                'codigo': '0204060125',
-                'descricao': 'RADIOGRAFIA DE JOELHO (AP + LATERAL)',
-            },
-            {
-                'codigo': '0204060133',
-                'descricao': 'RADIOGRAFIA DE JOELHO OU PATELA (AP + LATERAL + AXIAL)',
-            },
-            {
-                'codigo': '0204060141',
-                'descricao': 'RADIOGRAFIA DE JOELHO OU PATELA (AP + LATERAL + OBLIQUA + 3 AXIAIS)',
-            },
-            {
-                'codigo': '0204060150',
-                'descricao': 'RADIOGRAFIA DE PE / DEDOS DO PE',
-            },
-            {
-                'codigo': '0204060176',
-                'descricao': 'RADIOGRAFIA PANORAMICA DE MEMBROS INFERIORES',
-            },
-        ],
-    },
-    '0903010046': {
-        'nome': 'OCI AVALIAÇÃO DIAGNÓSTICA EM ORTOPEDIA COM RECURSOS DE RADIOLOGIA E RESSONÂNCIA MAGNÉTICA',
-        'itens_obrigatorios': [
-            {
-                'codigo': '0301010072',
-                'descricao': 'CONSULTA MEDICA EM ATENÇÃO ESPECIALIZADA',
-            },
-            {
-                'codigo': '0301010307',
-                'descricao': 'TELECONSULTA MÉDICA NA ATENÇÃO ESPECIALIZADA',
-            },
-        ],
-        'itens_facultativos': [
-            {
-                'codigo': '0204020034',
-                'descricao': 'RADIOGRAFIA DE COLUNA CERVICAL (AP + LATERAL + TO + OBLIQUAS)',
-            },
-            {
-                'codigo': '0204020042',
-                'descricao': 'RADIOGRAFIA DE COLUNA CERVICAL (AP + LATERAL + TO / FLEXAO)',
-            },
-            {
-                'codigo': '0204020077',
-                'descricao': 'RADIOGRAFIA DE COLUNA LOMBO-SACRA (C/ OBLIQUAS)',
-            },
-            {
-                'codigo': '0204020085',
-                'descricao': 'RADIOGRAFIA DE COLUNA LOMBO-SACRA FUNCIONAL / DINAMICA',
-            },
-            {
-                'codigo': '0204020093',
-                'descricao': 'RADIOGRAFIA DE COLUNA TORACICA (AP + LATERAL)',
-            },
-            {
-                'codigo': '0204020107',
-                'descricao': 'RADIOGRAFIA DE COLUNA TORACO-LOMBAR',
-            },
-            {
-                'codigo': '0204020131',
-                'descricao': 'RADIOGRAFIA PANORAMICA DE COLUNA TOTAL- TELESPONDILOGRAFIA ( P/ ESCOLIOSE)',
-            },
-            {
-                'codigo': '0204040035',
-                'descricao': 'RADIOGRAFIA DE ARTICULACAO ESCAPULO-UMERAL',
-            },
-            {'codigo': '0204040078', 'descricao': 'RADIOGRAFIA DE COTOVELO'},
-            {'codigo': '0204040094', 'descricao': 'RADIOGRAFIA DE MAO'},
-            {
-                'codigo': '0204040116',
-                'descricao': 'RADIOGRAFIA DE ESCAPULA/OMBRO (TRES POSICOES)',
-            },
-            {
-                'codigo': '0204040124',
-                'descricao': 'RADIOGRAFIA DE PUNHO (AP + LATERAL + OBLIQUA)',
-            },
-            {
-                'codigo': '0204060060',
-                'descricao': 'RADIOGRAFIA DE ARTICULACAO COXO-FEMORAL',
-            },
-            {'codigo': '0204060095', 'descricao': 'RADIOGRAFIA DE BACIA'},
-            {'codigo': '0204060109', 'descricao': 'RADIOGRAFIA DE CALCANEO'},
-            {
-                'codigo': '0204060125',
-                'descricao': 'RADIOGRAFIA DE JOELHO (AP + LATERAL)',
-            },
-            {
-                'codigo': '0204060133',
-                'descricao': 'RADIOGRAFIA DE JOELHO OU PATELA (AP + LATERAL + AXIAL)',
-            },
-            {
-                'codigo': '0204060141',
-                'descricao': 'RADIOGRAFIA DE JOELHO OU PATELA (AP + LATERAL + OBLIQUA + 3 AXIAIS)',
-            },
-            {
-                'codigo': '0204060150',
-                'descricao': 'RADIOGRAFIA DE PE / DEDOS DO PE',
-            },
-            {
-                'codigo': '0204060176',
-                'descricao': 'RADIOGRAFIA PANORAMICA DE MEMBROS INFERIORES',
-            },
-            {
-                'codigo': '0207010030',
-                'descricao': 'RESSONANCIA MAGNETICA DE COLUNA CERVICAL/PESCOÇO',
-            },
-            {
-                'codigo': '0207010048',
-                'descricao': 'RESSONANCIA MAGNETICA DE COLUNA LOMBO-SACRA',
-            },
-            {
-                'codigo': '0207010056',
-                'descricao': 'RESSONANCIA MAGNETICA DE COLUNA TORACICA',
-            },
-            {
-                'codigo': '0207020027',
-                'descricao': 'RESSONANCIA MAGNETICA DE MEMBRO SUPERIOR (UNILATERAL)',
-            },
-            {
-                'codigo': '0207030022',
-                'descricao': 'RESSONANCIA MAGNETICA DE BACIA / PELVE / ABDOMEN INFERIOR',
-            },
-            {
-                'codigo': '0207030030',
-                'descricao': 'RESSONANCIA MAGNETICA DE MEMBRO INFERIOR (UNILATERAL)',
-            },
-        ],
-    },
-    '0904010015': {
-        'nome': 'OCI AVALIAÇÃO INICIAL DIAGNÓSTICA DE DÉFICIT AUDITIVO',
-        'itens_obrigatorios': [
-            {
-                'codigo': '0211070041',
-                'descricao': 'AUDIOMETRIA TONAL LIMIAR (VIA AEREA / OSSEA)',
-            },
-            {
-                'codigo': '0301010072',
-                'descricao': 'CONSULTA MEDICA EM ATENÇÃO ESPECIALIZADA',
-            },
-        ],
-        'itens_facultativos': [
-            {'codigo': '0211070203', 'descricao': 'IMITANCIOMETRIA'}
-        ],
-    },
-    '0904010023': {
-        'nome': 'OCI PROGRESSÃO DA AVALIAÇÃO DIAGNÓSTICA DE DÉFICIT AUDITIVO',
-        'itens_obrigatorios': [
-            {
-                'codigo': '0211070041',
-                'descricao': 'AUDIOMETRIA TONAL LIMIAR (VIA AEREA / OSSEA)',
-            },
-            {
-                'codigo': '0211070262',
-                'descricao': 'POTENCIAL EVOCADO AUDITIVO DE CURTA MEDIA E LONGA LATENCIA',
-            },
-            {
-                'codigo': '0301010072',
-                'descricao': 'CONSULTA MEDICA EM ATENÇÃO ESPECIALIZADA',
-            },
-        ],
-        'itens_facultativos': [
-            {
-                'codigo': '0211050113',
-                'descricao': 'POTENCIAL EVOCADO AUDITIVO',
-            },
-            {'codigo': '0211070203', 'descricao': 'IMITANCIOMETRIA'},
-        ],
-    },
-    '0904010031': {
-        'nome': 'OCI AVALIAÇÃO DIAGNÓSTICA DE NASOFARINGE E DE OROFARINGE',
-        'itens_obrigatorios': [
-            {'codigo': '0209040025', 'descricao': 'LARINGOSCOPIA'},
-            {'codigo': '0209040041', 'descricao': 'VIDEOLARINGOSCOPIA'},
-            {
-                'codigo': '0301010072',
-                'descricao': 'CONSULTA MEDICA EM ATENÇÃO ESPECIALIZADA',
-            },
-        ],
-        'itens_facultativos': [],
-    },
-    '0905010019': {
-        'nome': 'OCI AVALIAÇÃO INICIAL EM OFTALMOGIA - 0 A 8 ANOS',
-        'itens_obrigatorios': [
-            {
-                'codigo': '0211060020',
-                'descricao': 'BIOMICROSCOPIA DE FUNDO DE OLHO',
-            },
-            {'codigo': '0211060127', 'descricao': 'MAPEAMENTO DE RETINA'},
-            {'codigo': '0211060232', 'descricao': 'TESTE ORTÓPTICO'},
-            {
-                'codigo': '0301010072',
-                'descricao': 'CONSULTA MEDICA EM ATENÇÃO ESPECIALIZADA',
-            },
-        ],
-        'itens_facultativos': [],
-    },
-    '0905010027': {
-        'nome': 'OCI AVALIAÇÃO DE ESTRABISMO',
-        'itens_obrigatorios': [
-            {
-                'codigo': '0211060020',
-                'descricao': 'BIOMICROSCOPIA DE FUNDO DE OLHO',
-            },
-            {'codigo': '0211060127', 'descricao': 'MAPEAMENTO DE RETINA'},
-            {'codigo': '0211060232', 'descricao': 'TESTE ORTÓPTICO'},
-            {'codigo': '0211060259', 'descricao': 'TONOMETRIA'},
-            {
-                'codigo': '0301010072',
-                'descricao': 'CONSULTA MEDICA EM ATENÇÃO ESPECIALIZADA',
-            },
-        ],
-        'itens_facultativos': [
-            {'codigo': '0211060100', 'descricao': 'FUNDOSCOPIA'},
-            {
-                'codigo': '0211060178',
-                'descricao': 'RETINOGRAFIA COLORIDA BINOCULAR',
-            },
-        ],
-    },
-    '0905010035': {
-        'nome': 'OCI AVALIAÇÃO INICIAL EM OFTALMOLOGIA - A PARTIR DE 9 ANOS',
-        'itens_obrigatorios': [
-            {
-                'codigo': '0211060020',
-                'descricao': 'BIOMICROSCOPIA DE FUNDO DE OLHO',
-            },
-            {'codigo': '0211060127', 'descricao': 'MAPEAMENTO DE RETINA'},
-            {'codigo': '0211060259', 'descricao': 'TONOMETRIA'},
-            {
-                'codigo': '0301010072',
-                'descricao': 'CONSULTA MEDICA EM ATENÇÃO ESPECIALIZADA',
-            },
-        ],
-        'itens_facultativos': [
-            {'codigo': '0211060232', 'descricao': 'TESTE ORTÓPTICO'}
-        ],
-    },
-    '0905010043': {
-        'nome': 'OCI AVALIAÇÃO DE RETINOPATIA DIABÉTICA',
-        'itens_obrigatorios': [
-            {
-                'codigo': '0211060020',
-                'descricao': 'BIOMICROSCOPIA DE FUNDO DE OLHO',
-            },
-            {'codigo': '0211060127', 'descricao': 'MAPEAMENTO DE RETINA'},
-            {
-                'codigo': '0211060178',
-                'descricao': 'RETINOGRAFIA COLORIDA BINOCULAR',
-            },
-            {'codigo': '0211060259', 'descricao': 'TONOMETRIA'},
-            {
-                'codigo': '0301010072',
-                'descricao': 'CONSULTA MEDICA EM ATENÇÃO ESPECIALIZADA',
-            },
-        ],
-        'itens_facultativos': [],
-    },
-    '0905010051': {
-        'nome': 'OCI AVALIAÇÃO INICIAL PARA ONCOLOGIA OFTALMOLÓGICA',
-        'itens_obrigatorios': [
-            {
-                'codigo': '0205020089',
-                'descricao': 'ULTRASSONOGRAFIA DE GLOBO OCULAR / ORBITA (MONOCULAR)',
-            },
-            {
-                'codigo': '0211060020',
-                'descricao': 'BIOMICROSCOPIA DE FUNDO DE OLHO',
-            },
-            {'codigo': '0211060127', 'descricao': 'MAPEAMENTO DE RETINA'},
-            {'codigo': '0211060259', 'descricao': 'TONOMETRIA'},
-            {
-                'codigo': '0301010072',
-                'descricao': 'CONSULTA MEDICA EM ATENÇÃO ESPECIALIZADA',
-            },
-        ],
-        'itens_facultativos': [
-            {
-                'codigo': '0211060178',
-                'descricao': 'RETINOGRAFIA COLORIDA BINOCULAR',
+        )
+
+        if not df_agrupamentos.empty:
+            escrever_aba_xlsx(
+                workbook, 'Agrupamentos', df_agrupamentos, formato_cabecalho
+            )
+        if not df_nao_agrupados.empty:
+            escrever_aba_xlsx(
+                workbook,
+                'Não Agrupados',
+                df_nao_agrupados,
+                formato_cabecalho,
+            )
+        workbook.close()
+    except BaseException:
+        os.remove(caminho)
+        raise
+    return caminho
+
+
+def enviar_arquivo_temporario(caminho, nome_download, mimetype):
+    # Envia o arquivo em blocos e o remove ao final da resposta
+    def conteudo():
+        try:
+            with open(caminho, 'rb') as arquivo:
+                while True:
+                    bloco = arquivo.read(app.config['TAMANHO_BLOCO_ENVIO'])
+                    if not bloco:
+                        break
+                    yield bloco
+        finally:
+            os.remove(caminho)
+
+    return Response(
+        conteudo(),
+        mimetype=mimetype,
+        headers={
+            'Content-Disposition': f'attachment; filename={nome_download}',
+            'Content-Length': str(os.path.getsize(caminho)),
+        },
+    )
+
+
+def gerar_csv(df, compactar=False):
+    # Gera o CSV (separador ';', como os arquivos de entrada) em blocos de
+    # tamanho fixo, opcionalmente compactado com gzip, sem montar o arquivo
+    # inteiro em memória
+    tamanho_envio = app.config['TAMANHO_BLOCO_ENVIO']
+    bloco_linhas = app.config['EXPORTACAO_BLOCO_LINHAS']
+    compressor = (
+        zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        if compactar
+        else None
+    )
+    pendente = bytearray()
+
+    for inicio in range(0, max(len(df), 1), bloco_linhas):
+        bloco = formatar_tabela(df.iloc[inicio : inicio + bloco_linhas])
+        dados = bloco.to_csv(
+            sep=';', index=False, header=inicio == 0, lineterminator='\n'
+        ).encode('utf-8')
+        pendente += compressor.compress(dados) if compressor else dados
+        while len(pendente) >= tamanho_envio:
+            yield bytes(pendente[:tamanho_envio])
+            del pendente[:tamanho_envio]
+
+    if compressor:
+        pendente += compressor.flush()
+    if pendente:
+        yield bytes(pendente)
+
+
+def gerar_texto_relatorio(resultado):
+    # Texto completo do relatório, gerado em blocos sob demanda
+    tamanho_envio = app.config['TAMANHO_BLOCO_ENVIO']
+    pendente = bytearray()
+    for linha in gerar_linhas_relatorio(resultado):
+        pendente += linha.encode('utf-8') + b'\n'
+        if len(pendente) >= tamanho_envio:
+            yield bytes(pendente)
+            pendente.clear()
+    if pendente:
+        yield bytes(pendente)
+
+
+# Métricas no formato texto do Prometheus (/metrics). Cada processo
+# (workers do gunicorn e processos das análises em segundo plano) acumula
+# as suas em memória e uma thread grava um retrato em
+# METRICAS_FOLDER/<pid>_<id do processo>.pkl a cada METRICAS_INTERVALO
+# segundos, se algo mudou, e ao sair. O /metrics soma os retratos de todos
+# os processos; os de processos encerrados têm contadores e histogramas
+# incorporados ao acumulado (encerrados.pkl) e são apagados, então os
+# totais não diminuem e a pasta não cresce. Medidores só contam processos
+# vivos
+BUCKETS_SEGUNDOS = (
+    0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300,
+)
+BUCKETS_BYTES = tuple(
+    int(megabytes * 1024 * 1024)
+    for megabytes in (0.1, 1, 5, 10, 25, 50, 100, 256)
+)
+BUCKETS_LINHAS_POR_SEGUNDO = (
+    1e3, 1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 1e7,
+)
+
+# nome: (tipo, descrição, buckets dos histogramas)
+METRICAS = {
+    'oci_etapa_duracao_segundos': (
+        'histogram',
+        'Duração das etapas da análise (leitura, formatacao, analise)',
+        BUCKETS_SEGUNDOS,
+    ),
+    'oci_analise_linhas_por_segundo': (
+        'histogram',
+        'Solicitações em espera analisadas por segundo, por análise',
+        BUCKETS_LINHAS_POR_SEGUNDO,
+    ),
+    'oci_solicitacoes_analisadas_total': (
+        'counter',
+        'Solicitações em espera analisadas',
+        None,
+    ),
+    'oci_upload_bytes': (
+        'histogram',
+        'Bytes enviados por requisição de análise',
+        BUCKETS_BYTES,
+    ),
+    'oci_exportacao_duracao_segundos': (
+        'histogram',
+        'Tempo de geração dos arquivos exportados',
+        BUCKETS_SEGUNDOS,
+    ),
+    'oci_cache_consultas_total': (
+        'counter',
+        'Consultas aos caches, por resultado (acerto ou falha)',
+        None,
+    ),
+    'oci_requisicoes_total': (
+        'counter',
+        'Requisições atendidas, por rota e status',
+        None,
+    ),
+    'oci_requisicoes_em_andamento': (
+        'gauge',
+        'Requisições em andamento, por rota',
+        None,
+    ),
+}
+
+ARQUIVO_METRICAS_ENCERRADOS = 'encerrados.pkl'
+TRAVA_METRICAS = 'encerrados.trava'
+TRAVA_METRICAS_EXPIRADA = 60  # segundos; trava de um processo que morreu
+
+_metricas = {}
+_metricas_lock = threading.Lock()
+_metricas_gravacao_lock = threading.Lock()
+# Identificador do processo no nome do retrato: um PID reaproveitado não
+# sobrescreve o retrato do processo anterior
+_id_processo = uuid.uuid4().hex[:12]
+_metricas_alteradas = False
+_gravador_metricas = None
+
+
+def _reiniciar_metricas():
+    # Processo filho (pool de análise) começa sem as métricas do pai, que
+    # já estão no retrato do próprio pai, e sem a thread de gravação
+    global _metricas_lock, _metricas_gravacao_lock, _id_processo
+    global _metricas_alteradas, _gravador_metricas
+    _metricas.clear()
+    _metricas_lock = threading.Lock()
+    _metricas_gravacao_lock = threading.Lock()
+    _id_processo = uuid.uuid4().hex[:12]
+    _metricas_alteradas = False
+    _gravador_metricas = None
+
+
+os.register_at_fork(after_in_child=_reiniciar_metricas)
+
+
+def gravar_metricas_periodicamente():
+    while True:
+        sleep(app.config['METRICAS_INTERVALO'])
+        gravar_metricas()
+
+
+def registrar_metrica(nome, valor=1, **rotulos):
+    # Contador e medidor: soma valor; histograma: registra uma observação.
+    # Só altera a memória do processo; o retrato é gravado por
+    # gravar_metricas, chamada pela thread de gravação
+    global _metricas_alteradas, _gravador_metricas
+    tipo, _, buckets = METRICAS[nome]
+    chave = (nome, tuple(sorted(rotulos.items())))
+    with _metricas_lock:
+        _metricas_alteradas = True
+        if _gravador_metricas is None:
+            _gravador_metricas = threading.Thread(
+                target=gravar_metricas_periodicamente, daemon=True
+            )
+            _gravador_metricas.start()
+        if tipo == 'histogram':
+            # Contagem por bucket (o último é o +Inf) e soma no final
+            serie = _metricas.setdefault(chave, [0] * (len(buckets) + 1) + [0])
+            serie[bisect.bisect_left(buckets, valor)] += 1
+            serie[-1] += valor
+        else:
+            _metricas[chave] = _metricas.get(chave, 0) + valor
+
+
+def gravar_metricas():
+    # Grava o retrato do processo se algo mudou desde a última gravação
+    global _metricas_alteradas
+    with _metricas_gravacao_lock:
+        with _metricas_lock:
+            if not _metricas_alteradas:
+                return
+            _metricas_alteradas = False
+            retrato = {
+                chave: list(valor) if isinstance(valor, list) else valor
+                for chave, valor in _metricas.items()
             }
-        ],
-    },
-    '0905010060': {
-        'nome': 'OCI AVALIAÇÃO DIAGNÓSTICA EM NEURO OFTALMOLOGIA',
-        'itens_obrigatorios': [
-            {
-                'codigo': '0211060020',
-                'descricao': 'BIOMICROSCOPIA DE FUNDO DE OLHO',
-            },
-            {
-                'codigo': '0211060038',
-                'descricao': 'CAMPIMETRIA COMPUTADORIZADA OU MANUAL COM GRÁFICO',
-            },
-            {'codigo': '0211060127', 'descricao': 'MAPEAMENTO DE RETINA'},
-            {
-                'codigo': '0211060178',
-                'descricao': 'RETINOGRAFIA COLORIDA BINOCULAR',
-            },
-            {'codigo': '0211060224', 'descricao': 'TESTE DE VISÃO DE CORES'},
-            {'codigo': '0211060259', 'descricao': 'TONOMETRIA'},
-            {
-                'codigo': '0301010072',
-                'descricao': 'CONSULTA MEDICA EM ATENÇÃO ESPECIALIZADA',
-            },
-        ],
-        'itens_facultativos': [],
-    },
-    '0905010078': {
-        'nome': 'OCI EXAMES OFTALMOLÓGICOS SOB SEDAÇÃO',
-        'itens_obrigatorios': [
-            {'codigo': '0417010060', 'descricao': 'SEDACAO'},
-            {
-                'codigo': '0301010072',
-                'descricao': 'CONSULTA MEDICA EM ATENÇÃO ESPECIALIZADA',
-            },
-        ],
-        'itens_facultativos': [
-            {'codigo': '0211060127', 'descricao': 'MAPEAMENTO DE RETINA'},
-            {'codigo': '0211060259', 'descricao': 'TONOMETRIA'},
-        ],
-    },
+        caminho = os.path.join(
+            app.config['METRICAS_FOLDER'],
+            f'{os.getpid()}_{_id_processo}.pkl',
+        )
+        try:
+            gravar_pickle_atomico(
+                caminho, {'pid': os.getpid(), 'metricas': retrato}
+            )
+        except OSError as e:
+            app.logger.warning(f'Métricas não gravadas: {str(e)}')
+            with _metricas_lock:
+                _metricas_alteradas = True
+
+
+atexit.register(gravar_metricas)
+
+
+def processo_vivo(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def somar_metricas(totais, metricas, vivo=True):
+    for chave, valor in metricas.items():
+        definicao = METRICAS.get(chave[0])
+        if definicao is None or (definicao[0] == 'gauge' and not vivo):
+            continue
+        if isinstance(valor, list):
+            anterior = totais.get(chave)
+            if anterior is None:
+                totais[chave] = list(valor)
+            elif len(anterior) == len(valor):
+                totais[chave] = [a + b for a, b in zip(anterior, valor)]
+        else:
+            totais[chave] = totais.get(chave, 0) + valor
+
+
+def ler_retrato(caminho):
+    try:
+        with open(caminho, 'rb') as arquivo:
+            return pickle.load(arquivo)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+
+
+def travar_metricas(pasta):
+    # Trava entre processos (arquivo criado com O_EXCL) para a leitura e a
+    # incorporação dos retratos: sem ela, um retrato incorporado por outro
+    # /metrics no meio da leitura seria contado duas vezes ou nenhuma
+    caminho = os.path.join(pasta, TRAVA_METRICAS)
+    limite = time() + 5
+    while True:
+        try:
+            os.close(os.open(caminho, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            try:
+                if time() - os.stat(caminho).st_mtime > (
+                    TRAVA_METRICAS_EXPIRADA
+                ):
+                    os.remove(caminho)
+                    continue
+            except OSError:
+                continue
+        if time() >= limite:
+            return False
+        sleep(0.05)
+
+
+def agregar_metricas():
+    pasta = app.config['METRICAS_FOLDER']
+    if not os.path.isdir(pasta):
+        return {}
+
+    travado = travar_metricas(pasta)
+    try:
+        caminho_encerrados = os.path.join(pasta, ARQUIVO_METRICAS_ENCERRADOS)
+        encerrados = ler_retrato(caminho_encerrados) or {'metricas': {}}
+        totais = {}
+        somar_metricas(totais, encerrados['metricas'], vivo=False)
+
+        incorporados = []
+        for nome in os.listdir(pasta):
+            if (
+                not nome.endswith('.pkl')
+                or nome == ARQUIVO_METRICAS_ENCERRADOS
+            ):
+                continue
+            retrato = ler_retrato(os.path.join(pasta, nome))
+            if retrato is None:
+                continue
+            vivo = processo_vivo(retrato['pid'])
+            somar_metricas(totais, retrato['metricas'], vivo)
+            if not vivo:
+                somar_metricas(
+                    encerrados['metricas'], retrato['metricas'], vivo=False
+                )
+                incorporados.append(nome)
+
+        # Só incorpora com a trava: sem ela, outro /metrics poderia
+        # incorporar os mesmos retratos
+        if travado and incorporados:
+            try:
+                gravar_pickle_atomico(caminho_encerrados, encerrados)
+                for nome in incorporados:
+                    os.remove(os.path.join(pasta, nome))
+            except OSError as e:
+                app.logger.warning(
+                    f'Métricas encerradas não incorporadas: {str(e)}'
+                )
+        return totais
+    finally:
+        if travado:
+            try:
+                os.remove(os.path.join(pasta, TRAVA_METRICAS))
+            except OSError:
+                pass
+
+
+def formatar_rotulos(rotulos):
+    if not rotulos:
+        return ''
+    pares = []
+    for nome, valor in rotulos:
+        valor = (
+            str(valor)
+            .replace('\\', '\\\\')
+            .replace('"', '\\"')
+            .replace('\n', '\\n')
+        )
+        pares.append(f'{nome}="{valor}"')
+    return '{' + ','.join(pares) + '}'
+
+
+def formatar_metricas(totais):
+    linhas = []
+    for nome, (tipo, descricao, buckets) in METRICAS.items():
+        linhas.append(f'# HELP {nome} {descricao}')
+        linhas.append(f'# TYPE {nome} {tipo}')
+        series = sorted(
+            (chave[1], valor)
+            for chave, valor in totais.items()
+            if chave[0] == nome
+        )
+        for rotulos, valor in series:
+            if tipo != 'histogram':
+                linhas.append(f'{nome}{formatar_rotulos(rotulos)} {valor}')
+                continue
+            acumulado = 0
+            limites = [repr(float(limite)) for limite in buckets] + ['+Inf']
+            for limite, contagem in zip(limites, valor[:-1]):
+                acumulado += contagem
+                linhas.append(
+                    f'{nome}_bucket'
+                    f'{formatar_rotulos(rotulos + (("le", limite),))} '
+                    f'{acumulado}'
+                )
+            rotulos = formatar_rotulos(rotulos)
+            linhas.append(f'{nome}_sum{rotulos} {valor[-1]}')
+            linhas.append(f'{nome}_count{rotulos} {acumulado}')
+
+    # Taxa de acertos de cada cache, sobre todas as consultas
+    consultas = {}
+    for (nome, rotulos), valor in totais.items():
+        if nome == 'oci_cache_consultas_total':
+            rotulos = dict(rotulos)
+            acertos, total = consultas.get(rotulos['cache'], (0, 0))
+            consultas[rotulos['cache']] = (
+                acertos + (valor if rotulos['resultado'] == 'acerto' else 0),
+                total + valor,
+            )
+    linhas.append(
+        '# HELP oci_cache_taxa_acertos Fração das consultas atendidas pelo '
+        'cache'
+    )
+    linhas.append('# TYPE oci_cache_taxa_acertos gauge')
+    for cache, (acertos, total) in sorted(consultas.items()):
+        linhas.append(
+            f'oci_cache_taxa_acertos{formatar_rotulos((("cache", cache),))} '
+            f'{acertos / total if total else 0}'
+        )
+    return '\n'.join(linhas) + '\n'
+
+
+def registrar_metricas_analise(modo, tempos, solicitacoes):
+    # tempos: {etapa: segundos} de uma análise concluída
+    for etapa, segundos in tempos.items():
+        registrar_metrica(
+            'oci_etapa_duracao_segundos', segundos, etapa=etapa, modo=modo
+        )
+    total = sum(tempos.values())
+    registrar_metrica('oci_solicitacoes_analisadas_total', solicitacoes)
+    if total > 0:
+        registrar_metrica(
+            'oci_analise_linhas_por_segundo', solicitacoes / total, modo=modo
+        )
+
+
+# Armazenamento das análises no servidor. Toda análise é gravada na pasta
+# em disco, compartilhada pelos workers do gunicorn, e a memória funciona
+# como um LRU de leitura na frente dela. A pasta é limpa pela expiração
+# (TTL, contada desde o último acesso) e pelo total de bytes, com despejo
+# LRU como no cache de resultados. Sem pasta, fica só a memória
+class ArmazemAnalises:
+    def __init__(self, max_memoria, ttl, pasta=None, max_bytes=None):
+        self.max_memoria = max_memoria
+        self.ttl = ttl
+        self.pasta = pasta
+        self.max_bytes = max_bytes
+        self._itens = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _caminho(self, id_analise):
+        return os.path.join(self.pasta, f'{id_analise}.pkl')
+
+    def _guardar_memoria(self, id_analise, ultimo_acesso, resultado):
+        with self._lock:
+            self._itens[id_analise] = (ultimo_acesso, resultado)
+            self._itens.move_to_end(id_analise)
+            while len(self._itens) > self.max_memoria:
+                self._itens.popitem(last=False)
+
+    def _tocar(self, id_analise):
+        # A data de modificação do arquivo é o último acesso visto por todos
+        # os workers (expiração em obter e despejo em _despejar)
+        if not self.pasta:
+            return
+        try:
+            os.utime(self._caminho(id_analise))
+        except OSError:
+            pass
+
+    def salvar(self, resultado):
+        id_analise = uuid.uuid4().hex
+        criado_em = time()
+        if self.pasta:
+            try:
+                gravar_pickle_atomico(
+                    self._caminho(id_analise), (criado_em, resultado)
+                )
+            except OSError as e:
+                app.logger.warning(
+                    f'Análise {id_analise} não gravada em disco: {str(e)}'
+                )
+            else:
+                self._despejar()
+        self._guardar_memoria(id_analise, criado_em, resultado)
+        return id_analise
+
+    def obter(self, id_analise):
+        if not id_analise or not re.fullmatch(r'[0-9a-f]{32}', id_analise):
+            return None
+
+        agora = time()
+        resultado = None
+        with self._lock:
+            item = self._itens.get(id_analise)
+            if item is not None:
+                if agora - item[0] < self.ttl:
+                    resultado = item[1]
+                    self._itens[id_analise] = (agora, resultado)
+                    self._itens.move_to_end(id_analise)
+                else:
+                    # Expirada neste worker; outro pode tê-la acessado
+                    # depois, então a pasta decide
+                    del self._itens[id_analise]
+        if resultado is not None:
+            registrar_metrica(
+                'oci_cache_consultas_total',
+                cache='analises',
+                resultado='acerto',
+            )
+            self._tocar(id_analise)
+            return resultado
+
+        # Fora da memória deste worker (gravada por outro worker, despejada
+        # do LRU, expirada aqui ou inexistente)
+        registrar_metrica(
+            'oci_cache_consultas_total', cache='analises', resultado='falha'
+        )
+
+        if not self.pasta:
+            return None
+        caminho = self._caminho(id_analise)
+        try:
+            ultimo_acesso = os.stat(caminho).st_mtime
+            if agora - ultimo_acesso >= self.ttl:
+                os.remove(caminho)
+                return None
+            with open(caminho, 'rb') as arquivo:
+                _, resultado = pickle.load(arquivo)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        self._tocar(id_analise)
+        self._guardar_memoria(id_analise, agora, resultado)
+        return resultado
+
+    def _despejar(self):
+        # Remove as análises sem acesso há mais que o TTL e, passando de
+        # max_bytes, as de acesso mais antigo
+        limite = time() - self.ttl
+        entradas = []
+        for nome in os.listdir(self.pasta):
+            if not nome.endswith('.pkl'):
+                continue
+            caminho = os.path.join(self.pasta, nome)
+            try:
+                estado = os.stat(caminho)
+                if estado.st_mtime < limite:
+                    os.remove(caminho)
+                    continue
+            except OSError:
+                continue
+            entradas.append((estado.st_mtime, estado.st_size, nome))
+
+        if self.max_bytes is None:
+            return
+        total = sum(tamanho for _, tamanho, _ in entradas)
+        for _, tamanho, nome in sorted(entradas):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.pasta, nome))
+            except OSError:
+                pass
+            total -= tamanho
+
+
+analises = ArmazemAnalises(
+    app.config['ANALISES_MAX_MEMORIA'],
+    app.config['ANALISES_TTL'],
+    (
+        os.path.join(app.config['CACHE_FOLDER'], 'analises')
+        if app.config['ANALISES_DISCO']
+        else None
+    ),
+    app.config['ANALISES_MAX_BYTES'],
+)
+
+
+# Cache de resultados endereçado pelo conteúdo do arquivo enviado e pela
+# versão do catálogo. Fica em disco local para ser compartilhado por todos
+# os workers do gunicorn; limitado pelo total de bytes, com despejo LRU
+# (a data de modificação do arquivo marca o último acesso)
+class CacheResultados:
+    def __init__(self, pasta, max_bytes):
+        self.pasta = pasta
+        self.max_bytes = max_bytes
+
+    def _caminho(self, chave):
+        return os.path.join(self.pasta, f'{chave}.pkl')
+
+    def obter(self, chave):
+        caminho = self._caminho(chave)
+        try:
+            with open(caminho, 'rb') as arquivo:
+                resultado = pickle.load(arquivo)
+            os.utime(caminho)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            registrar_metrica(
+                'oci_cache_consultas_total',
+                cache='resultados',
+                resultado='falha',
+            )
+            return None
+        registrar_metrica(
+            'oci_cache_consultas_total', cache='resultados', resultado='acerto'
+        )
+        return resultado
+
+    def gravar(self, chave, resultado):
+        try:
+            gravar_pickle_atomico(self._caminho(chave), resultado)
+        except OSError as e:
+            app.logger.warning(f'Resultado não gravado em cache: {str(e)}')
+            return
+        self._despejar()
+
+    def _despejar(self):
+        entradas = []
+        for nome in os.listdir(self.pasta):
+            if not nome.endswith('.pkl'):
+                continue
+            try:
+                estado = os.stat(os.path.join(self.pasta, nome))
+            except OSError:
+                continue
+            entradas.append((estado.st_mtime, estado.st_size, nome))
+
+        total = sum(tamanho for _, tamanho, _ in entradas)
+        for _, tamanho, nome in sorted(entradas):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.pasta, nome))
+            except OSError:
+                pass
+            total -= tamanho
+
+
+# Versão do formato do resultado guardado em cache; alterar sempre que a
+# estrutura de analisar_dados mudar, para invalidar resultados antigos
+VERSAO_RESULTADO = '6'
+
+
+# Os arquivos recebidos são copiados em blocos para a pasta de envios, com
+# o hash do conteúdo calculado durante a cópia: o arquivo nunca fica
+# inteiro em memória e as tarefas recebem só o caminho
+def pasta_envios():
+    return os.path.join(app.config['CACHE_FOLDER'], 'envios')
+
+
+def salvar_envio(file):
+    # Retorna o caminho da cópia, o hash (sha256) do conteúdo e o tamanho
+    os.makedirs(pasta_envios(), exist_ok=True)
+    extensao = os.path.splitext(file.filename)[1].lower()
+    descritor, caminho = tempfile.mkstemp(dir=pasta_envios(), suffix=extensao)
+    hash_conteudo = hashlib.sha256()
+    tamanho = 0
+    try:
+        with os.fdopen(descritor, 'wb') as destino:
+            while True:
+                bloco = file.stream.read(
+                    app.config['TAMANHO_BLOCO_RECEBIMENTO']
+                )
+                if not bloco:
+                    break
+                hash_conteudo.update(bloco)
+                destino.write(bloco)
+                tamanho += len(bloco)
+    except BaseException:
+        remover_envio(caminho)
+        raise
+    return caminho, hash_conteudo.digest(), tamanho
+
+
+def remover_envio(caminho):
+    try:
+        os.remove(caminho)
+    except OSError:
+        pass
+
+
+def chave_cache_analise(hash_conteudo, nome_arquivo):
+    # hash_conteudo: sha256 do arquivo enviado, calculado por salvar_envio
+    hash_chave = hashlib.sha256()
+    hash_chave.update(VERSAO_RESULTADO.encode())
+    hash_chave.update(obter_catalogo()['versao'].encode())
+    hash_chave.update(nome_arquivo.rsplit('.', 1)[-1].lower().encode())
+    hash_chave.update(hash_conteudo)
+    return hash_chave.hexdigest()
+
+
+def chave_cache_arquivos(arquivos):
+    # Chave de uma análise conjunta: hash do conteúdo e nome de cada
+    # arquivo (lista de (hash, nome)), na ordem de envio (o nome entra na
+    # coluna de origem)
+    hash_chave = hashlib.sha256()
+    hash_chave.update(VERSAO_RESULTADO.encode())
+    hash_chave.update(obter_catalogo()['versao'].encode())
+    for hash_conteudo, nome in arquivos:
+        hash_chave.update(nome.encode() + b'\0')
+        hash_chave.update(hash_conteudo)
+    return hash_chave.hexdigest()
+
+
+cache_resultados = CacheResultados(
+    os.path.join(app.config['CACHE_FOLDER'], 'resultados'),
+    app.config['CACHE_RESULTADOS_MAX_BYTES'],
+)
+
+
+# Tarefas de análise assíncronas: o caminho do arquivo recebido entra na
+# fila de um pool de processos e o estado da tarefa fica em disco
+# (compartilhado entre os workers). O resultado concluído vai para o cache
+# de resultados
+_pools = {}
+_uso_pools = {}  # pool -> [envios pendentes, último uso]
+_pool_lock = threading.Lock()
+
+
+def obter_pool(chave_processos):
+    # Um pool de processos por finalidade, criado sob demanda com o número
+    # de processos da configuração indicada. O uso fica pendente até
+    # liberar_pool, e um pool com envios pendentes não é encerrado
+    with _pool_lock:
+        if chave_processos not in _pools:
+            pool = ProcessPoolExecutor(
+                max_workers=app.config[chave_processos]
+            )
+            _pools[chave_processos] = pool
+            _uso_pools[pool] = [0, time()]
+        pool = _pools[chave_processos]
+        _uso_pools[pool][0] += 1
+        _uso_pools[pool][1] = time()
+        return pool
+
+
+def liberar_pool(chave_processos, pool):
+    # Fim de um envio; sem envios pendentes, agenda a verificação de
+    # ociosidade
+    with _pool_lock:
+        uso = _uso_pools.get(pool)
+        if uso is None:
+            return
+        uso[0] -= 1
+        uso[1] = time()
+        if uso[0] > 0:
+            return
+    temporizador = threading.Timer(
+        app.config['POOL_OCIOSO_SEGUNDOS'],
+        encerrar_pool_ocioso,
+        (chave_processos, pool),
+    )
+    temporizador.daemon = True
+    temporizador.start()
+
+
+def encerrar_pool_ocioso(chave_processos, pool):
+    # Encerra o pool se continua sem envios desde a última liberação; os
+    # processos parados não ficam ocupando memória no worker
+    with _pool_lock:
+        uso = _uso_pools.get(pool)
+        if (
+            uso is None
+            or uso[0] > 0
+            or time() - uso[1] < app.config['POOL_OCIOSO_SEGUNDOS']
+        ):
+            return
+        del _uso_pools[pool]
+        if _pools.get(chave_processos) is pool:
+            del _pools[chave_processos]
+    pool.shutdown(wait=False)
+
+
+def descartar_pool(chave_processos, pool):
+    # Retira um pool quebrado (processo morto, ex.: pelo OOM killer); o
+    # próximo uso cria outro
+    with _pool_lock:
+        _uso_pools.pop(pool, None)
+        if _pools.get(chave_processos) is pool:
+            del _pools[chave_processos]
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def submeter(chave_processos, funcao, *args):
+    # Envia a função ao pool da finalidade. Se o pool está quebrado, ele é
+    # recriado e o envio é repetido uma vez; uma tarefa que termina com o
+    # pool quebrado também o descarta, para não derrubar os envios seguintes
+    for tentativa in range(2):
+        pool = obter_pool(chave_processos)
+        try:
+            futuro = pool.submit(funcao, *args)
+        except BrokenProcessPool:
+            descartar_pool(chave_processos, pool)
+            if tentativa:
+                raise
+            continue
+        except BaseException:
+            liberar_pool(chave_processos, pool)
+            raise
+
+        def verificar_pool(futuro, pool=pool):
+            if not futuro.cancelled() and isinstance(
+                futuro.exception(), BrokenProcessPool
+            ):
+                descartar_pool(chave_processos, pool)
+            else:
+                liberar_pool(chave_processos, pool)
+
+        futuro.add_done_callback(verificar_pool)
+        return futuro
+
+
+def caminho_tarefa(id_tarefa):
+    return os.path.join(
+        app.config['CACHE_FOLDER'], 'tarefas', f'{id_tarefa}.pkl'
+    )
+
+
+def gravar_estado_tarefa(id_tarefa, estado, **dados):
+    gravar_pickle_atomico(
+        caminho_tarefa(id_tarefa),
+        dict(dados, estado=estado, atualizado_em=time()),
+    )
+
+
+def ler_estado_tarefa(id_tarefa):
+    if not re.fullmatch(r'[0-9a-f]{32}', id_tarefa):
+        return None
+    try:
+        with open(caminho_tarefa(id_tarefa), 'rb') as arquivo:
+            return pickle.load(arquivo)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+
+
+# Faixa percentual de cada etapa do processamento na barra de progresso
+ETAPAS_PROGRESSO = {
+    'leitura': (0, 30),
+    'formatacao': (30, 50),
+    'casamento': (50, 70),
+    'relatorio': (70, 100),
+}
+
+
+def criar_progresso(id_tarefa):
+    # Callback de progresso usado pelas etapas do processamento; o estado
+    # gravado em disco alimenta o stream SSE de /progress/<id>
+    def progresso(etapa, processadas, total):
+        inicio, fim = ETAPAS_PROGRESSO[etapa]
+        fracao = min(processadas / total, 1) if total else 0
+        try:
+            gravar_estado_tarefa(
+                id_tarefa,
+                'processando',
+                etapa=etapa,
+                linhas_processadas=processadas,
+                linhas_total=total,
+                percentual=round(inicio + (fim - inicio) * fracao, 1),
+            )
+        except OSError as e:
+            app.logger.warning(f'Progresso não registrado: {str(e)}')
+
+    return progresso
+
+
+def executar_tarefa(id_tarefa, caminho, nome_arquivo, chave):
+    # caminho: cópia do arquivo na pasta de envios, removida ao terminar
+    gravar_estado_tarefa(id_tarefa, 'processando')
+    try:
+        resultado = processar_arquivo(
+            caminho, nome_arquivo, criar_progresso(id_tarefa)
+        )
+        cache_resultados.gravar(chave, resultado)
+        gravar_estado_tarefa(
+            id_tarefa,
+            'concluida',
+            chave=chave,
+            resumo=resultado['resumo'],
+            percentual=100,
+        )
+    except ColunasFaltando as e:
+        gravar_estado_tarefa(
+            id_tarefa, 'erro', error=str(e), missing_columns=e.colunas
+        )
+    except Exception as e:
+        app.logger.error(f'Erro na tarefa {id_tarefa}: {str(e)}')
+        gravar_estado_tarefa(
+            id_tarefa, 'erro', error=f'Erro ao processar arquivo: {str(e)}'
+        )
+    finally:
+        remover_envio(caminho)
+        gravar_metricas()
+
+
+def limpar_tarefas_antigas():
+    # Estados de tarefas e envios esquecidos (ex.: worker encerrado no meio
+    # da cópia) com mais tempo que o TTL das análises
+    limite = time() - app.config['ANALISES_TTL']
+    for pasta in (os.path.dirname(caminho_tarefa('x')), pasta_envios()):
+        if not os.path.isdir(pasta):
+            continue
+        for nome in os.listdir(pasta):
+            caminho = os.path.join(pasta, nome)
+            try:
+                if os.stat(caminho).st_mtime < limite:
+                    os.remove(caminho)
+            except OSError:
+                pass
+
+
+def criar_tarefa(caminho, nome_arquivo, chave, id_tarefa=None):
+    # A tarefa passa a ser dona do arquivo em caminho e o remove ao terminar
+    limpar_tarefas_antigas()
+    id_tarefa = id_tarefa or uuid.uuid4().hex
+    gravar_estado_tarefa(id_tarefa, 'na_fila')
+    futuro = submeter(
+        'ANALISE_PROCESSOS',
+        executar_tarefa,
+        id_tarefa,
+        caminho,
+        nome_arquivo,
+        chave,
+    )
+
+    # executar_tarefa trata os próprios erros; uma falha aqui é do processo
+    # (morto durante a análise ou tarefa cancelada com o pool) e, sem este
+    # registro, a tarefa ficaria para sempre em 'na_fila'/'processando'
+    def verificar_tarefa(futuro):
+        if futuro.cancelled():
+            erro = 'Tarefa cancelada'
+        elif futuro.exception() is not None:
+            erro = f'Erro ao processar arquivo: {str(futuro.exception())}'
+        else:
+            return
+        app.logger.error(f'Erro na tarefa {id_tarefa}: {erro}')
+        try:
+            gravar_estado_tarefa(id_tarefa, 'erro', error=erro)
+        except OSError:
+            pass
+        remover_envio(caminho)
+
+    futuro.add_done_callback(verificar_tarefa)
+    return id_tarefa
+
+
+# Tipos de conteúdo comprimidos; PDF, XLSX e CSV gzip já são binários
+# compactados e os streams (SSE, downloads) não passam por aqui
+TIPOS_COMPRIMIVEIS = {
+    'application/json',
+    'application/javascript',
+    'text/css',
+    'text/csv',
+    'text/html',
+    'text/javascript',
+    'text/plain',
 }
 
 
-def allowed_file(filename):
-    return (
-        '.' in filename
-        and filename.rsplit('.', 1)[1].lower()
-        in app.config['ALLOWED_EXTENSIONS']
-    )
+def codificacoes_disponiveis():
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
 
 
-def formatar_dados(df):
-    # Função auxiliar para aplicar zfill apenas se for número
-    def aplicar_zfill(serie, tamanho):
-        serie = serie.fillna('').astype(str)
-        return serie.where(
-            ~serie.str.match(r'^\d+$'), serie.str.zfill(tamanho)
+def comprimir(dados, codificacao):
+    if codificacao == 'br':
+        return brotli.compress(
+            dados, quality=app.config['COMPRESSAO_NIVEL_BROTLI']
         )
+    return gzip.compress(
+        dados, compresslevel=app.config['COMPRESSAO_NIVEL_GZIP'], mtime=0
+    )
 
-    # CNES - 7 dígitos
-    cnes_cols = ['CNES_SOLICITANTE', 'CNES_REGULADOR', 'CNES_EXECUTANTE']
-    for col in cnes_cols:
-        if col in df.columns:
-            df[col] = aplicar_zfill(df[col], 7)
 
-    # CODIGO_SIGTAP - 10 dígitos
-    if 'CODIGO_SIGTAP' in df.columns:
-        df['CODIGO_SIGTAP'] = aplicar_zfill(df['CODIGO_SIGTAP'], 10)
+# Arquivos estáticos comprimidos uma única vez, na inicialização:
+# nome do arquivo -> {codificação: bytes}
+estaticos_comprimidos = {}
+
+
+def precomprimir_estaticos():
+    for pasta, _, arquivos in os.walk(app.static_folder):
+        for nome in arquivos:
+            caminho = os.path.join(pasta, nome)
+            if os.path.getsize(caminho) < app.config['COMPRESSAO_MIN_BYTES']:
+                continue
+            tipo = mimetypes.guess_type(nome)[0]
+            if tipo not in TIPOS_COMPRIMIVEIS:
+                continue
+            with open(caminho, 'rb') as arquivo:
+                dados = arquivo.read()
+            relativo = os.path.relpath(caminho, app.static_folder)
+            estaticos_comprimidos[relativo.replace(os.sep, '/')] = {
+                codificacao: comprimir(dados, codificacao)
+                for codificacao in codificacoes_disponiveis()
+            }
 
-        # Formatação de datas - corrigida
-    date_cols = ['DATA_SOLICITACAO', 'DATA_AUTORIZACAO', 'DATA_EXECUCAO']
-    for col in date_cols:
-        if col in df.columns:
-            # Tenta converter para datetime
-            df[col] = pd.to_datetime(
-                df[col], errors='coerce', infer_datetime_format=True
-            )
 
-            # Formata para string no formato desejado
-            df[col] = df[col].dt.strftime('%d/%m/%Y')
-            df[col] = df[col].replace('NaT', '')
+precomprimir_estaticos()
 
-    return df
 
+@app.after_request
+def comprimir_resposta(response):
+    if (
+        response.status_code != 200
+        or 'Content-Encoding' in response.headers
+        or response.mimetype not in TIPOS_COMPRIMIVEIS
+    ):
+        return response
 
-def analisar_dados(df):
-    try:
-        # Filtra apenas registros com STATUS == 1 (Em Espera)
-        df = df[df['STATUS'] == '1'].copy()
+    response.vary.add('Accept-Encoding')
+    codificacao = request.accept_encodings.best_match(
+        codificacoes_disponiveis()
+    )
+    if codificacao is None:
+        return response
 
-        # Preenche NaN com string vazia
-        df = df.fillna('')
+    if request.endpoint == 'static':
+        comprimidos = estaticos_comprimidos.get(
+            request.view_args.get('filename')
+        )
+        if comprimidos is None:
+            return response
+        response.close()  # libera o arquivo original aberto pelo send_file
+        response.direct_passthrough = False
+        response.set_data(comprimidos[codificacao])
+        etag, fraca = response.get_etag()
+        if etag:
+            # ETag próprio por codificação, com a revalidação refeita sobre ele
+            response.set_etag(f'{etag}-{codificacao}', fraca)
+            response.make_conditional(request)
+    else:
+        if response.is_streamed:
+            return response
+        dados = response.get_data()
+        if len(dados) < app.config['COMPRESSAO_MIN_BYTES']:
+            return response
+        response.set_data(comprimir(dados, codificacao))
+
+    response.headers['Content-Encoding'] = codificacao
+    return response
+
+
+# Requisições em andamento e atendidas por rota
+@app.before_request
+def iniciar_metricas_requisicao():
+    if request.endpoint in (None, 'static', 'metrics'):
+        return
+    g.rota_metricas = request.endpoint
+    registrar_metrica('oci_requisicoes_em_andamento', rota=request.endpoint)
+
+
+@app.after_request
+def contar_requisicao(response):
+    rota = g.get('rota_metricas')
+    if rota:
+        registrar_metrica(
+            'oci_requisicoes_total', rota=rota, status=response.status_code
+        )
+    return response
 
-        total_solicitacoes = len(df)
-        relatorio = []
-        relatorio_agrupamentos = []  # Lista para dados XLSX de agrupamentos
-        relatorio_nao_agrupados = []  # Lista para dados XLSX de não agrupados
 
-        relatorio.append(
-            "*********************    FORAM ENCONTRADOS {} CONJUNTOS DE OCI'S    ***********************\n"
-        )
+@app.teardown_request
+def encerrar_metricas_requisicao(erro=None):
+    rota = g.pop('rota_metricas', None)
+    if rota:
+        registrar_metrica('oci_requisicoes_em_andamento', -1, rota=rota)
 
-        total_pacientes = len(df['DOCUMENTO_PACIENTE'].unique())
-        pacientes_em_agrupamentos = set()
-        agrupamentos_encontrados = 0
-
-        for codigo, agrupamento in agrupamentos.items():
-            codigos_obrigatorios = [
-                item['codigo'] for item in agrupamento['itens_obrigatorios']
-            ]
-            codigos_facultativos = [
-                item['codigo'] for item in agrupamento['itens_facultativos']
-            ]
-
-            pacientes_agrupados = []
-
-            for paciente, dados_paciente in df.groupby('DOCUMENTO_PACIENTE'):
-                codigos_paciente = set(dados_paciente['CODIGO_SIGTAP'])
-
-                if all(c in codigos_paciente for c in codigos_obrigatorios):
-                    pacientes_agrupados.append(paciente)
-                    pacientes_em_agrupamentos.add(paciente)
-
-            if pacientes_agrupados:
-                agrupamentos_encontrados += 1
-                relatorio.append(
-                    '_________________________________________________________________________________________'
-                )
-                relatorio.append(
-                    f"{codigo[:2]}.{codigo[2:4]}.{codigo[4:6]}.{codigo[6:]} - {agrupamento['nome']}\n"
-                )
 
-                for paciente in sorted(pacientes_agrupados):
-                    relatorio.append(f'--- {paciente}')
-
-                    # Itens obrigatórios
-                    for item in agrupamento['itens_obrigatorios']:
-                        registros = df[
-                            (df['DOCUMENTO_PACIENTE'] == paciente)
-                            & (df['CODIGO_SIGTAP'] == item['codigo'])
-                        ]
-                        for _, registro in registros.iterrows():
-                            relatorio.append(
-                                f"-------- OBG\tCNES_SOLC {registro['CNES_SOLICITANTE']}\tCID-{registro['CID10']}\tDT_SOLC-{registro['DATA_SOLICITACAO']}\t{item['codigo']} - {item['descricao']}"
-                            )
-                            relatorio_agrupamentos.append(
-                                {
-                                    'AGRUPAMENTO_OCI': f'{codigo[:2]}.{codigo[2:4]}.{codigo[4:6]}.{codigo[6:]}',
-                                    'DESCRICAO_OCI': agrupamento['nome'],
-                                    'DOCUMENTO_PACIENTE': paciente,
-                                    'DATA_SOLICITACAO': registro[
-                                        'DATA_SOLICITACAO'
-                                    ],
-                                    'CNES_SOLICITANTE': registro[
-                                        'CNES_SOLICITANTE'
-                                    ],
-                                    'ITEM OBG/FAC (X)': 'OBG',
-                                    'CID10': registro['CID10'],
-                                    'CODIGO_SIGTAP': item['codigo'],
-                                    'DESCRICAO_SIGTAP': item['descricao'],
-                                    'CBO': registro['CBO'],
-                                }
-                            )
-
-                    # Itens facultativos
-                    for item in agrupamento['itens_facultativos']:
-                        registros = df[
-                            (df['DOCUMENTO_PACIENTE'] == paciente)
-                            & (df['CODIGO_SIGTAP'] == item['codigo'])
-                        ]
-                        for _, registro in registros.iterrows():
-                            relatorio.append(
-                                f"-------- FAC\tCNES_SOLC {registro['CNES_SOLICITANTE']}\tCID-{registro['CID10']}\tDT_SOLC-{registro['DATA_SOLICITACAO']}\t{item['codigo']} - {item['descricao']}"
-                            )
-                            relatorio_agrupamentos.append(
-                                {
-                                    'AGRUPAMENTO_OCI': f'{codigo[:2]}.{codigo[2:4]}.{codigo[4:6]}.{codigo[6:]}',
-                                    'DESCRICAO_OCI': agrupamento['nome'],
-                                    'DOCUMENTO_PACIENTE': paciente,
-                                    'DATA_SOLICITACAO': registro[
-                                        'DATA_SOLICITACAO'
-                                    ],
-                                    'CNES_SOLICITANTE': registro[
-                                        'CNES_SOLICITANTE'
-                                    ],
-                                    'ITEM OBG/FAC (X)': 'FAC',
-                                    'CID10': registro['CID10'],
-                                    'CODIGO_SIGTAP': item['codigo'],
-                                    'DESCRICAO_SIGTAP': item['descricao'],
-                                    'CBO': registro['CBO'],
-                                }
-                            )
+@app.route('/metrics')
+def metrics():
+    # Métricas somadas de todos os processos, no formato do Prometheus; o
+    # retrato deste processo é gravado antes, sem esperar o intervalo
+    gravar_metricas()
+    return Response(
+        formatar_metricas(agregar_metricas()),
+        content_type='text/plain; version=0.0.4; charset=utf-8',
+    )
 
-        # Pacientes não agrupados
-        pacientes_restantes = df[
-            ~df['DOCUMENTO_PACIENTE'].isin(pacientes_em_agrupamentos)
-        ]
-        relatorio.append(
-            '\n********************    PACIENTES QUE NÃO ESTÃO EM NENHUM CONJUNTO  ***********************'
+
+# Perfilamento de requisições: com ?perfil=1 e o token de administração
+# no cabeçalho X-Perfil-Token, a rota roda sob o cProfile e o perfil é
+# gravado em PERFIS_FOLDER, com o id da análise no nome
+# (<id_analise>_<rota>_<sufixo>.prof e um resumo .json com as funções de
+# maior tempo). O nome volta no cabeçalho X-Perfil e o perfil é lido em
+# /perfis/<nome>. Sem o parâmetro, o decorador só confere a query string
+# e chama a rota, sem perfilador
+def perfil_autorizado():
+    token = app.config['PERFIL_TOKEN']
+    return bool(token) and hmac.compare_digest(
+        request.headers.get('X-Perfil-Token', '').encode(), token.encode()
+    )
+
+
+def funcoes_perfil(estatisticas, indice, quantidade):
+    # Funções com maior tempo próprio (indice 2) ou acumulado (indice 3)
+    itens = sorted(
+        estatisticas.stats.items(), key=lambda item: -item[1][indice]
+    )[:quantidade]
+    funcoes = []
+    for (arquivo, linha, nome), (_, chamadas, proprio, acumulado, _) in itens:
+        funcoes.append(
+            {
+                'funcao': f'{arquivo}:{linha}({nome})',
+                'chamadas': chamadas,
+                'tempo_proprio': round(proprio, 6),
+                'tempo_acumulado': round(acumulado, 6),
+            }
         )
-        for _, linha in pacientes_restantes.iterrows():
-            descricao = next(
-                (
-                    item['descricao']
-                    for g in agrupamentos.values()
-                    for item in g['itens_obrigatorios']
-                    + g['itens_facultativos']
-                    if item['codigo'] == linha['CODIGO_SIGTAP']
-                ),
-                'Código não faz parte de um item de OCI',
-            )
-            relatorio.append(
-                f"- CNES_SOLC {linha['CNES_SOLICITANTE']}\tCID {linha['CID10']}\tCNS/CPF_PAC {linha['DOCUMENTO_PACIENTE']}\tDT_SOLC {linha['DATA_SOLICITACAO']}\t{linha['CODIGO_SIGTAP']} - {descricao}"
-            )
-            relatorio_nao_agrupados.append(
-                {
-                    'DOCUMENTO_PACIENTE': linha['DOCUMENTO_PACIENTE'],
-                    'DATA_SOLICITACAO': linha['DATA_SOLICITACAO'],
-                    'CNES_SOLICITANTE': linha['CNES_SOLICITANTE'],
-                    'CID10': linha['CID10'],
-                    'CODIGO_SIGTAP': linha['CODIGO_SIGTAP'],
-                    'DESCRICAO_SIGTAP': descricao,
-                    'CBO': linha['CBO'],
-                }
+    return funcoes
+
+
+def gravar_perfil(perfil, nome, rota, id_analise, duracao):
+    pasta = app.config['PERFIS_FOLDER']
+    os.makedirs(pasta, exist_ok=True)
+    caminho = os.path.join(pasta, os.path.basename(nome))
+    perfil.dump_stats(f'{caminho}.prof')
+
+    estatisticas = pstats.Stats(perfil)
+    quantidade = app.config['PERFIL_FUNCOES']
+    resumo = {
+        'rota': rota,
+        'id_analise': id_analise,
+        'gerado_em': datetime.now().isoformat(timespec='seconds'),
+        'duracao_segundos': round(duracao, 4),
+        'tempo_perfilado': round(estatisticas.total_tt, 4),
+        'funcoes_tempo_acumulado': funcoes_perfil(
+            estatisticas, 3, quantidade
+        ),
+        'funcoes_tempo_proprio': funcoes_perfil(estatisticas, 2, quantidade),
+    }
+    with open(f'{caminho}.json', 'w', encoding='utf-8') as arquivo:
+        json.dump(resumo, arquivo, ensure_ascii=False, indent=2)
+
+    # Mantém apenas os perfis mais recentes
+    resumos = sorted(
+        (
+            entrada
+            for entrada in os.scandir(pasta)
+            if entrada.name.endswith('.json')
+        ),
+        key=lambda entrada: entrada.stat().st_mtime,
+    )
+    for entrada in resumos[: -app.config['PERFIS_MAX']]:
+        for extensao in ('.json', '.prof'):
+            try:
+                os.remove(entrada.path[: -len('.json')] + extensao)
+            except OSError:
+                pass
+
+
+def perfilar_iteravel(iteravel, perfil, concluir):
+    # Respostas em streaming: o perfil cobre também a geração das partes,
+    # e é gravado quando o envio termina
+    partes = iter(iteravel)
+    try:
+        while True:
+            perfil.enable()
+            try:
+                parte = next(partes)
+            except StopIteration:
+                return
+            finally:
+                perfil.disable()
+            yield parte
+    finally:
+        if hasattr(iteravel, 'close'):
+            iteravel.close()
+        concluir()
+
+
+def id_analise_perfil(resposta):
+    # Id da análise que entra no nome do perfil: o devolvido na resposta
+    # ou, se a rota respondeu sem erro (análise encontrada), o enviado na
+    # requisição. Só ids no formato gerado por ArmazemAnalises são aceitos
+    candidatos = [g.get('id_analise')]
+    if not resposta.is_streamed:
+        candidatos.append(
+            (resposta.get_json(silent=True) or {}).get('id_analise')
+        )
+    if resposta.status_code < 400:
+        candidatos.append(request.values.get('id_analise'))
+        candidatos.append(
+            (request.get_json(silent=True) or {}).get('id_analise')
+        )
+    for id_analise in candidatos:
+        if isinstance(id_analise, str) and re.fullmatch(
+            r'[0-9a-f]{32}', id_analise
+        ):
+            return id_analise
+    return None
+
+
+def perfilavel(funcao):
+    @wraps(funcao)
+    def envoltorio(*args, **kwargs):
+        if 'perfil' not in request.args:
+            return funcao(*args, **kwargs)
+        if not perfil_autorizado():
+            return jsonify({'error': 'Perfilamento não autorizado'}), 403
+
+        g.perfilando = True
+        perfil = cProfile.Profile()
+        inicio = time()
+        perfil.enable()
+        try:
+            resposta = funcao(*args, **kwargs)
+        finally:
+            perfil.disable()
+        resposta = app.make_response(resposta)
+
+        id_analise = id_analise_perfil(resposta)
+        rota = request.endpoint
+        nome = f'{id_analise or "sem_analise"}_{rota}_{uuid.uuid4().hex[:8]}'
+        resposta.headers['X-Perfil'] = nome
+
+        def concluir():
+            try:
+                gravar_perfil(perfil, nome, rota, id_analise, time() - inicio)
+            except OSError as e:
+                app.logger.warning(f'Perfil {nome} não gravado: {str(e)}')
+
+        if resposta.is_streamed:
+            resposta.response = perfilar_iteravel(
+                resposta.response, perfil, concluir
             )
+        else:
+            concluir()
+        return resposta
+
+    return envoltorio
+
+
+@app.route('/perfis/<nome>')
+def obter_perfil(nome):
+    # Resumo do perfil em JSON ou, com formato=pstats, o arquivo do cProfile
+    # (para pstats, snakeviz etc.)
+    if not perfil_autorizado():
+        return jsonify({'error': 'Perfilamento não autorizado'}), 403
+    if not re.fullmatch(r'[0-9a-z_]+', nome):
+        return jsonify({'error': 'Perfil não encontrado'}), 404
+
+    pasta = app.config['PERFIS_FOLDER']
+    if request.args.get('formato') == 'pstats':
+        if not os.path.exists(os.path.join(pasta, f'{nome}.prof')):
+            return jsonify({'error': 'Perfil não encontrado'}), 404
+        return send_from_directory(
+            os.path.abspath(pasta), f'{nome}.prof', as_attachment=True
+        )
+    caminho = os.path.join(pasta, f'{nome}.json')
+    try:
+        with open(caminho, encoding='utf-8') as arquivo:
+            return jsonify(json.load(arquivo))
+    except FileNotFoundError:
+        return jsonify({'error': 'Perfil não encontrado'}), 404
 
-        # Atualiza o cabeçalho com o número real de conjuntos
-        relatorio[0] = relatorio[0].format(agrupamentos_encontrados)
 
-        # Rodapé com data e hora
-        relatorio.append('\n{:%d/%m/%Y %H:%M:%S}'.format(datetime.now()))
+@app.route('/')
+def index():
+    return render_template('index.html')
 
-        return {
-            'relatorio': relatorio,
-            'relatorio_agrupamentos': relatorio_agrupamentos,
-            'relatorio_nao_agrupados': relatorio_nao_agrupados,
-            'total_pacientes': total_pacientes,
-            'pacientes_agrupados': len(pacientes_em_agrupamentos),
-            'agrupamentos_encontrados': agrupamentos_encontrados,
-            'total_solicitacoes': total_solicitacoes,
-        }
 
-    except Exception as e:
-        app.logger.error(f'Erro na análise de dados: {str(e)}')
-        raise e
+class ColunasFaltando(Exception):
+    def __init__(self, colunas, arquivo=None):
+        super().__init__('Colunas obrigatórias faltando no arquivo')
+        self.colunas = colunas
+        self.arquivo = arquivo
 
+    def __reduce__(self):
+        # Preserva os atributos ao voltar de um processo de leitura
+        return (ColunasFaltando, (self.colunas, self.arquivo))
 
-def gerar_pdf(relatorio, tempo_processamento):
-    buffer = io.BytesIO()
-    c = canvas.Canvas(buffer, pagesize=landscape(letter))
-    width, height = landscape(letter)
 
-    # Configurações de layout
-    margem_esquerda = 30
-    linha_altura = 12
-    max_linhas_por_pagina = 50
-    pagina_numero = 1
-    data_hora = datetime.now().strftime('%d/%m/%Y %H:%M:%S')
+def processar_arquivo(origem, nome_arquivo, progresso=None):
+    tempo_inicio = time()
+    if progresso:
+        progresso('leitura', 0, 0)
 
-    # Filtra apenas as linhas de agrupamentos
-    linhas_agrupamentos = []
-    for linha in relatorio:
-        if linha.startswith(
-            '********************    PACIENTES QUE NÃO ESTÃO EM NENHUM CONJUNTO'
-        ):
-            break
-        linhas_agrupamentos.append(linha)
+    # Lê o arquivo conforme o tipo, já filtrando as solicitações em espera
+    df = ler_arquivo(origem, nome_arquivo, progresso)
 
-    # Função para desenhar cabeçalho
-    def desenhar_cabecalho(pagina):
-        try:
-            c.drawImage(
-                'static/img/agora-tem-especialistas.png',
-                margem_esquerda,
-                height - 80,
-                width=100,
-                height=50,
-            )
-        except:
-            pass  # Ignora erro se imagem não existir
+    tempo_leitura = time()
 
-        c.setFont('Helvetica-Bold', 16)
-        c.drawString(
-            margem_esquerda + 120,
-            height - 60,
-            'Relatório de Análise de Filas OCI',
-        )
-        c.setFont('Helvetica', 10)
-        c.drawString(
-            margem_esquerda + 120, height - 80, f'Gerado em: {data_hora}'
-        )
-        c.drawString(
-            margem_esquerda + 120,
-            height - 95,
-            f'Tempo de processamento: {tempo_processamento} segundos',
-        )
-        c.drawRightString(
-            width - margem_esquerda, height - 95, f'Página {pagina}'
-        )
-        c.line(
-            margem_esquerda,
-            height - 105,
-            width - margem_esquerda,
-            height - 105,
+    # Aplica as formatações necessárias
+    df = formatar_dados(df, progresso)
+    tempo_formatacao = time()
+
+    # Realiza a análise
+    resultado = analisar_dados(df, progresso)
+    tempo_analise = time()
+
+    tempo_total = tempo_analise - tempo_inicio
+    registrar_metricas_analise(
+        'arquivo',
+        {
+            'leitura': tempo_leitura - tempo_inicio,
+            'formatacao': tempo_formatacao - tempo_leitura,
+            'analise': tempo_analise - tempo_formatacao,
+        },
+        resultado['total_solicitacoes'],
+    )
+
+    resultado['resumo'] = {
+        'total_pacientes': resultado['total_pacientes'],
+        'total_solicitacoes': resultado['total_solicitacoes'],
+        'pacientes_agrupados': resultado['pacientes_agrupados'],
+        'agrupamentos_encontrados': resultado['agrupamentos_encontrados'],
+        'tempo_processamento': round(tempo_total, 2),
+        'tempos_parciais': {
+            'leitura': round(tempo_leitura - tempo_inicio, 2),
+            'formatacao': round(tempo_formatacao - tempo_leitura, 2),
+            'analise': round(tempo_analise - tempo_formatacao, 2),
+        },
+        'datas_invalidas': df.attrs.get('datas_invalidas', {}),
+        'codigos_nao_numericos': df.attrs.get('codigos_nao_numericos', {}),
+    }
+    return resultado
+
+
+def ler_e_formatar_arquivo(origem, nome_arquivo):
+    # Leitura e normalização de um arquivo de um envio com vários arquivos;
+    # roda em um processo do pool de leitura. Cada arquivo tem seus próprios
+    # formatos de data detectados
+    try:
+        df = ler_arquivo(origem, nome_arquivo)
+    except ColunasFaltando as e:
+        raise ColunasFaltando(e.colunas, nome_arquivo)
+    return formatar_dados(df)
+
+
+def harmonizar_documentos(dfs):
+    # Se alguma tabela tem documentos que não cabem em int64, todas voltam
+    # para texto (a conversão de int64 para texto é sem perdas)
+    if all(
+        pd.api.types.is_integer_dtype(df['DOCUMENTO_PACIENTE']) for df in dfs
+    ):
+        return
+    for df in dfs:
+        df['DOCUMENTO_PACIENTE'] = (
+            df['DOCUMENTO_PACIENTE'].astype(str).astype(object)
         )
 
-    # Processamento das linhas
-    linha_index = 0
-    total_linhas = len(linhas_agrupamentos)
-
-    while linha_index < total_linhas:
-        # Configurar nova página
-        c.setPageSize(landscape(letter))
-        desenhar_cabecalho(pagina_numero)
-        y = height - 120  # Posição inicial do conteúdo
-
-        # Adicionar conteúdo da página
-        linhas_na_pagina = 0
-        while (
-            linhas_na_pagina < max_linhas_por_pagina
-            and linha_index < total_linhas
-        ):
-            linha = linhas_agrupamentos[linha_index]
 
-            # Escolher fonte apropriada
-            if linha.startswith('---') or linha.startswith('--------'):
-                c.setFont('Courier', 8)
-            else:
-                c.setFont('Helvetica-Bold', 9)
+def unir_arquivos(dfs, nomes):
+    # União das solicitações de todos os arquivos com a coluna de origem,
+    # descartando as linhas repetidas (mantém a do primeiro arquivo)
+    harmonizar_documentos(dfs)
 
-            c.drawString(
-                margem_esquerda, y, linha[:200]
-            )  # Limita para evitar overflow
+    for df, nome in zip(dfs, nomes):
+        df[COLUNA_ORIGEM] = pd.Categorical([nome] * len(df), categories=nomes)
+    df = concatenar_blocos(dfs)
 
-            y -= linha_altura
-            linha_index += 1
-            linhas_na_pagina += 1
+    duplicadas = df.duplicated(subset=REQUIRED_COLUMNS)
+    if duplicadas.any():
+        df = df[~duplicadas].reset_index(drop=True)
 
-            # Verificar se chegou ao final da página
-            if y < 50:
-                break
+    # Contagens de valores não convertidos somadas entre os arquivos
+    for atributo in ('datas_invalidas', 'codigos_nao_numericos'):
+        totais = {}
+        for parcial in dfs:
+            for col, total in parcial.attrs.get(atributo, {}).items():
+                totais[col] = totais.get(col, 0) + total
+        df.attrs[atributo] = totais
+    df.attrs['solicitacoes_duplicadas'] = int(duplicadas.sum())
+    return df
 
-        # Finalizar página e preparar próxima
-        c.showPage()
-        pagina_numero += 1
 
-    # Salvar PDF
-    c.save()
-    buffer.seek(0)
-    return buffer
+def processar_arquivos(arquivos, progresso=None):
+    # Análise conjunta de vários arquivos (lista de (origem, nome)):
+    # leitura e normalização em paralelo, união sem duplicatas e uma única
+    # passada de casamento sobre todas as solicitações
+    tempo_inicio = time()
+    nomes = [nome for _, nome in arquivos]
+    if progresso:
+        progresso('leitura', 0, len(arquivos))
 
+    if len(arquivos) > 1 and app.config['LEITURA_PROCESSOS'] > 1:
+        futuros = [
+            submeter(
+                'LEITURA_PROCESSOS', ler_e_formatar_arquivo, origem, nome
+            )
+            for origem, nome in arquivos
+        ]
+        dfs = []
+        for futuro in futuros:
+            dfs.append(futuro.result())
+            if progresso:
+                progresso('leitura', len(dfs), len(arquivos))
+    else:
+        dfs = []
+        for origem, nome in arquivos:
+            dfs.append(ler_e_formatar_arquivo(origem, nome))
+            if progresso:
+                progresso('leitura', len(dfs), len(arquivos))
+    por_arquivo = [
+        {'nome': nome, 'solicitacoes': len(df)} for nome, df in zip(nomes, dfs)
+    ]
+    tempo_leitura = time()
+
+    df = unir_arquivos(dfs, nomes)
+    if progresso:
+        progresso('formatacao', len(df), len(df))
+    tempo_formatacao = time()
+
+    resultado = analisar_dados(df, progresso)
+    tempo_analise = time()
+    registrar_metricas_analise(
+        'arquivos',
+        {
+            'leitura': tempo_leitura - tempo_inicio,
+            'formatacao': tempo_formatacao - tempo_leitura,
+            'analise': tempo_analise - tempo_formatacao,
+        },
+        resultado['total_solicitacoes'],
+    )
+
+    resultado['resumo'] = {
+        'total_pacientes': resultado['total_pacientes'],
+        'total_solicitacoes': resultado['total_solicitacoes'],
+        'pacientes_agrupados': resultado['pacientes_agrupados'],
+        'agrupamentos_encontrados': resultado['agrupamentos_encontrados'],
+        'tempo_processamento': round(tempo_analise - tempo_inicio, 2),
+        'tempos_parciais': {
+            'leitura': round(tempo_leitura - tempo_inicio, 2),
+            'formatacao': round(tempo_formatacao - tempo_leitura, 2),
+            'analise': round(tempo_analise - tempo_formatacao, 2),
+        },
+        'datas_invalidas': df.attrs['datas_invalidas'],
+        'codigos_nao_numericos': df.attrs['codigos_nao_numericos'],
+        'arquivos': por_arquivo,
+        'solicitacoes_duplicadas': df.attrs['solicitacoes_duplicadas'],
+    }
+    return resultado
+
+
+def processar_delta(anterior, origem, nome_arquivo):
+    # Reanálise de uma análise armazenada com um arquivo de alterações
+    tempo_inicio = time()
+    delta = ler_delta(origem, nome_arquivo)
+    tempo_leitura = time()
+
+    resultado = reanalisar_incremental(anterior, delta, nome_arquivo)
+    tempo_analise = time()
+    registrar_metricas_analise(
+        'alteracoes',
+        {
+            'leitura': tempo_leitura - tempo_inicio,
+            'analise': tempo_analise - tempo_leitura,
+        },
+        resultado['total_solicitacoes'],
+    )
+
+    # Contagens de valores não convertidos: análise anterior + inclusões
+    alteracoes = resultado.pop('alteracoes')
+    validacao = {}
+    for atributo in ('datas_invalidas', 'codigos_nao_numericos'):
+        totais = dict(anterior['resumo'].get(atributo, {}))
+        for col, total in alteracoes.pop(atributo).items():
+            totais[col] = totais.get(col, 0) + total
+        validacao[atributo] = totais
+
+    resultado['resumo'] = {
+        'total_pacientes': resultado['total_pacientes'],
+        'total_solicitacoes': resultado['total_solicitacoes'],
+        'pacientes_agrupados': resultado['pacientes_agrupados'],
+        'agrupamentos_encontrados': resultado['agrupamentos_encontrados'],
+        'tempo_processamento': round(tempo_analise - tempo_inicio, 2),
+        'tempos_parciais': {
+            'leitura': round(tempo_leitura - tempo_inicio, 2),
+            'analise': round(tempo_analise - tempo_leitura, 2),
+        },
+        **validacao,
+        'alteracoes': alteracoes,
+    }
+    if 'arquivos' in anterior['resumo']:
+        resultado['resumo']['arquivos'] = anterior['resumo']['arquivos']
+    return resultado
+
+
+def tabela_colunar(df):
+    # Formato colunar: uma lista por coluna, sem repetir os nomes em cada
+    # linha. As colunas de OCI e de descrição vão como dicionário (valores
+    # distintos + código de cada linha)
+    texto = formatar_tabela(df)
+    dados = {}
+    for coluna in texto.columns:
+        if coluna in COLUNAS_DICIONARIO:
+            codigos, valores = pd.factorize(texto[coluna])
+            dados[coluna] = {
+                'valores': valores.tolist(),
+                'codigos': codigos.tolist(),
+            }
+        else:
+            dados[coluna] = texto[coluna].tolist()
+    return {
+        'linhas': len(texto),
+        'colunas': list(texto.columns),
+        'dados': dados,
+    }
+
+
+def tabela_registros(df):
+    return formatar_tabela(df).to_dict('records')
+
+
+def resposta_analise(id_analise, resultado):
+    # formato=colunar pede as tabelas no formato colunar; sem o parâmetro,
+    # mantém a lista de registros original. relatorio=paginado omite as
+    # linhas do relatório e as tabelas, que passam a ser lidas sob demanda
+    # (/report_lines e downloads); só as contagens de linhas vão junto
+    colunar = request.values.get('formato') == 'colunar'
+    formatar = tabela_colunar if colunar else tabela_registros
+
+    resposta = {
+        'success': True,
+        'id_analise': id_analise,
+        'formato': 'colunar' if colunar else 'registros',
+        'linhas_agrupamentos': len(resultado['relatorio_agrupamentos']),
+        'linhas_nao_agrupados': len(resultado['relatorio_nao_agrupados']),
+        'resumo': resultado['resumo'],
+    }
+    # Id que o perfilamento usa no nome do perfil (a resposta completa é um
+    # stream, sem JSON para ler)
+    g.id_analise = id_analise
+    if request.values.get('relatorio') == 'paginado':
+        resposta['total_linhas_relatorio'] = len(mapa_relatorio(resultado)[0])
+        return jsonify(resposta)
+
+    resposta['relatorio_agrupamentos'] = formatar(
+        resultado['relatorio_agrupamentos']
+    )
+    resposta['relatorio_nao_agrupados'] = formatar(
+        resultado['relatorio_nao_agrupados']
+    )
+    return Response(
+        stream_with_context(gerar_json_relatorio(resposta, resultado)),
+        mimetype='application/json',
+    )
+
+
+def gerar_json_relatorio(resposta, resultado):
+    # JSON da resposta com a lista 'relatorio' escrita em partes, um bloco
+    # de linhas por vez, sem montar o texto inteiro em memória
+    inicio = app.json.dumps(resposta)
+    yield inicio[:-1] + ', "relatorio": ['
+    linhas = gerar_linhas_relatorio(resultado)
+    separador = ''
+    while True:
+        bloco = list(islice(linhas, app.config['EXPORTACAO_BLOCO_LINHAS']))
+        if not bloco:
+            break
+        yield separador + json.dumps(bloco)[1:-1]
+        separador = ', '
+    yield ']}'
+
+
+def resposta_colunas_faltando(colunas, arquivo=None):
+    detalhes = {'missing_columns': colunas}
+    if arquivo:
+        detalhes['arquivo'] = arquivo
+    return (
+        jsonify(
+            {
+                'message': 'Colunas obrigatórias faltando no arquivo',
+                'details': detalhes,
+            }
+        ),
+        400,
+    )
 
-@app.route('/')
-def index():
-    return render_template('index.html')
+
+def id_progresso_requisicao():
+    # Identificador opcional do canal de progresso (SSE) escolhido pelo
+    # cliente; também é usado como id da tarefa assíncrona
+    id_progresso = request.form.get('id_progresso', '')
+    if not re.fullmatch(r'[0-9a-f]{32}', id_progresso):
+        return None
+    return id_progresso
 
 
 @app.route('/analyze_file', methods=['POST'])
+@perfilavel
 def analyze_file():
     if 'file' not in request.files:
         return jsonify({'error': 'Nenhum arquivo enviado'}), 400
@@ -1293,251 +3027,554 @@ def analyze_file():
             400,
         )
 
+    id_progresso = id_progresso_requisicao()
+    caminho = None
+
     try:
         tempo_inicio = time()
-
-        # Lê o arquivo conforme o tipo
-        if file.filename.endswith('.csv'):
-            df = pd.read_csv(file, encoding='utf-8', sep=';', dtype=str)
-        else:  # XLSX
-            df = pd.read_excel(file, dtype=str)
-
-        # Preenche valores NaN com string vazia
-        df = df.fillna('')
-
-        tempo_leitura = time()
-
-        # Aplica as formatações necessárias
-        df = formatar_dados(df)
-        tempo_formatacao = time()
-
-        # Verifica colunas obrigatórias
-        missing_columns = [
-            col for col in REQUIRED_COLUMNS if col not in df.columns
-        ]
-        if missing_columns:
+        caminho, hash_conteudo, tamanho = salvar_envio(file)
+        registrar_metrica('oci_upload_bytes', tamanho, rota='analyze_file')
+
+        # Reenvio do mesmo arquivo (mesmo catálogo): devolve o resultado
+        # já calculado a partir do cache em disco
+        chave = chave_cache_analise(hash_conteudo, file.filename)
+        # Com perfilamento, a análise roda sempre nesta requisição
+        perfilando = g.get('perfilando', False)
+        resultado = None if perfilando else cache_resultados.obter(chave)
+        if resultado is not None:
+            resultado['resumo'] = dict(
+                resultado['resumo'],
+                cache=True,
+                tempo_processamento=round(time() - tempo_inicio, 2),
+            )
+        elif not perfilando and (
+            tamanho >= app.config['ANALISE_ASSINCRONA_MIN_BYTES']
+            or request.form.get('modo') == 'assincrono'
+        ):
+            # Arquivos grandes: análise em segundo plano; a tarefa remove o
+            # arquivo recebido ao terminar
+            id_tarefa = criar_tarefa(
+                caminho, file.filename, chave, id_progresso
+            )
+            caminho = None
             return (
                 jsonify(
                     {
-                        'message': 'Colunas obrigatórias faltando no arquivo',
-                        'details': {'missing_columns': missing_columns},
+                        'success': True,
+                        'id_tarefa': id_tarefa,
+                        'estado': 'na_fila',
                     }
                 ),
-                400,
+                202,
+            )
+        else:
+            resultado = processar_arquivo(
+                caminho,
+                file.filename,
+                criar_progresso(id_progresso) if id_progresso else None,
+            )
+            cache_resultados.gravar(chave, resultado)
+
+        if id_progresso:
+            gravar_estado_tarefa(
+                id_progresso,
+                'concluida',
+                chave=chave,
+                resumo=resultado['resumo'],
+                percentual=100,
             )
 
-        # Realiza a análise
-        resultado = analisar_dados(df)
-        tempo_analise = time()
+        # Mantém o resultado no servidor; os downloads usam apenas o id
+        id_analise = analises.salvar(resultado)
 
-        tempo_total = tempo_analise - tempo_inicio
+        return resposta_analise(id_analise, resultado)
 
-        return jsonify(
-            {
-                'success': True,
-                'relatorio': resultado['relatorio'],
-                'relatorio_agrupamentos': resultado['relatorio_agrupamentos'],
-                'relatorio_nao_agrupados': resultado[
-                    'relatorio_nao_agrupados'
-                ],
-                'resumo': {
-                    'total_pacientes': resultado['total_pacientes'],
-                    'total_solicitacoes': resultado['total_solicitacoes'],
-                    'pacientes_agrupados': resultado['pacientes_agrupados'],
-                    'agrupamentos_encontrados': resultado[
-                        'agrupamentos_encontrados'
-                    ],
-                    'tempo_processamento': round(tempo_total, 2),
-                    'tempos_parciais': {
-                        'leitura': round(tempo_leitura - tempo_inicio, 2),
-                        'formatacao': round(
-                            tempo_formatacao - tempo_leitura, 2
-                        ),
-                        'analise': round(tempo_analise - tempo_formatacao, 2),
-                    },
-                },
-            }
-        )
+    except ColunasFaltando as e:
+        if id_progresso:
+            gravar_estado_tarefa(id_progresso, 'erro', error=str(e))
+        return resposta_colunas_faltando(e.colunas)
 
     except Exception as e:
         app.logger.error(f'Erro ao processar arquivo: {str(e)}')
+        if id_progresso:
+            gravar_estado_tarefa(id_progresso, 'erro', error=str(e))
         return jsonify({'error': f'Erro ao processar arquivo: {str(e)}'}), 500
 
+    finally:
+        if caminho:
+            remover_envio(caminho)
+
+
+@app.route('/analyze_files', methods=['POST'])
+def analyze_files():
+    # Vários arquivos (ex.: um por município) analisados em conjunto
+    arquivos = [f for f in request.files.getlist('files') if f.filename]
+    if not arquivos:
+        return jsonify({'error': 'Nenhum arquivo enviado'}), 400
+
+    invalidos = [f.filename for f in arquivos if not allowed_file(f.filename)]
+    if invalidos:
+        return (
+            jsonify(
+                {
+                    'error': (
+                        'Tipo de arquivo não permitido. Use .csv ou .xlsx'
+                    ),
+                    'details': {'arquivos': invalidos},
+                }
+            ),
+            400,
+        )
+
+    id_progresso = id_progresso_requisicao()
+    envios = []
 
-@app.route('/download_pdf', methods=['POST'])
-def download_pdf():
     try:
-        data = request.get_json()
-        if not data:
-            return jsonify({'error': 'Dados não fornecidos'}), 400
-
-        relatorio = data.get('relatorio')
-        tempo_processamento = data.get('tempo_processamento')
-
-        if not relatorio or tempo_processamento is None:
-            return jsonify({'error': 'Parâmetros faltando'}), 400
-
-        pdf_buffer = gerar_pdf(relatorio, tempo_processamento)
-        return send_file(
-            pdf_buffer,
-            as_attachment=True,
-            download_name='relatorio_agrupamentos_oci.pdf',
-            mimetype='application/pdf',
+        tempo_inicio = time()
+
+        # Nomes repetidos ganham um sufixo para a coluna de origem
+        vistos = {}
+        for file in arquivos:
+            vistos[file.filename] = vistos.get(file.filename, 0) + 1
+            nome = file.filename
+            if vistos[nome] > 1:
+                base, extensao = os.path.splitext(nome)
+                nome = f'{base} ({vistos[nome]}){extensao}'
+            caminho, hash_conteudo, tamanho = salvar_envio(file)
+            envios.append((caminho, nome, hash_conteudo, tamanho))
+
+        registrar_metrica(
+            'oci_upload_bytes',
+            sum(envio[3] for envio in envios),
+            rota='analyze_files',
+        )
+        chave = chave_cache_arquivos(
+            [(hash_conteudo, nome) for _, nome, hash_conteudo, _ in envios]
         )
+        resultado = cache_resultados.obter(chave)
+        if resultado is not None:
+            resultado['resumo'] = dict(
+                resultado['resumo'],
+                cache=True,
+                tempo_processamento=round(time() - tempo_inicio, 2),
+            )
+        else:
+            resultado = processar_arquivos(
+                [(caminho, nome) for caminho, nome, _, _ in envios],
+                criar_progresso(id_progresso) if id_progresso else None,
+            )
+            cache_resultados.gravar(chave, resultado)
+
+        if id_progresso:
+            gravar_estado_tarefa(
+                id_progresso,
+                'concluida',
+                chave=chave,
+                resumo=resultado['resumo'],
+                percentual=100,
+            )
+
+        id_analise = analises.salvar(resultado)
+        return resposta_analise(id_analise, resultado)
+
+    except ColunasFaltando as e:
+        if id_progresso:
+            gravar_estado_tarefa(id_progresso, 'erro', error=str(e))
+        return resposta_colunas_faltando(e.colunas, e.arquivo)
+
     except Exception as e:
-        app.logger.error(f'Erro ao gerar PDF: {str(e)}')
-        return jsonify({'error': f'Erro ao gerar PDF: {str(e)}'}), 500
+        app.logger.error(f'Erro ao processar arquivos: {str(e)}')
+        if id_progresso:
+            gravar_estado_tarefa(id_progresso, 'erro', error=str(e))
+        return jsonify({'error': f'Erro ao processar arquivos: {str(e)}'}), 500
+
+    finally:
+        for envio in envios:
+            remover_envio(envio[0])
+
+
+@app.route('/analyze_delta', methods=['POST'])
+def analyze_delta():
+    # Aplica um arquivo de alterações a uma análise já feita, recalculando
+    # só os pacientes afetados; a análise anterior continua disponível
+    anterior, erro = obter_analise_requisicao()
+    if erro:
+        return erro
+    if 'base_incremental' not in anterior:
+        return (
+            jsonify(
+                {'error': 'Análise sem suporte a reanálise incremental'}
+            ),
+            400,
+        )
 
+    file = request.files.get('file')
+    if file is None or file.filename == '':
+        return jsonify({'error': 'Nenhum arquivo enviado'}), 400
+    if not allowed_file(file.filename):
+        return (
+            jsonify(
+                {'error': 'Tipo de arquivo não permitido. Use .csv ou .xlsx'}
+            ),
+            400,
+        )
 
-@app.route('/download_xlsx', methods=['POST'])
-def download_xlsx():
+    caminho = None
     try:
-        data = request.get_json()
-        if not data:
-            return jsonify({'error': 'Dados não fornecidos'}), 400
+        caminho, _, tamanho = salvar_envio(file)
+        registrar_metrica('oci_upload_bytes', tamanho, rota='analyze_delta')
+        resultado = processar_delta(anterior, caminho, file.filename)
+        id_analise = analises.salvar(resultado)
+        return resposta_analise(id_analise, resultado)
 
-        relatorio_agrupamentos = data.get('relatorio_agrupamentos', [])
-        relatorio_nao_agrupados = data.get('relatorio_nao_agrupados', [])
+    except ColunasFaltando as e:
+        return resposta_colunas_faltando(e.colunas, e.arquivo)
 
-        if not relatorio_agrupamentos and not relatorio_nao_agrupados:
-            return jsonify({'error': 'Nenhum relatório fornecido'}), 400
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-        # Ordem das colunas para agrupamentos
-        ordem_agrupamentos = [
-            'AGRUPAMENTO_OCI',
-            'DESCRICAO_OCI',
-            'DOCUMENTO_PACIENTE',
-            'DATA_SOLICITACAO',
-            'CNES_SOLICITANTE',
-            'ITEM OBG/FAC (X)',
-            'CID10',
-            'CODIGO_SIGTAP',
-            'DESCRICAO_SIGTAP',
-            'CBO',
-        ]
+    except Exception as e:
+        app.logger.error(f'Erro ao processar alterações: {str(e)}')
+        return (
+            jsonify({'error': f'Erro ao processar alterações: {str(e)}'}),
+            500,
+        )
 
-        # Ordem das colunas para não agrupados
-        ordem_nao_agrupados = [
-            'DOCUMENTO_PACIENTE',
-            'DATA_SOLICITACAO',
-            'CNES_SOLICITANTE',
-            'CID10',
-            'CODIGO_SIGTAP',
-            'DESCRICAO_SIGTAP',
-            'CBO',
-        ]
+    finally:
+        if caminho:
+            remover_envio(caminho)
+
+
+@app.route('/jobs/<id_tarefa>')
+def job_status(id_tarefa):
+    tarefa = ler_estado_tarefa(id_tarefa)
+    if tarefa is None:
+        return jsonify({'error': 'Tarefa não encontrada'}), 404
+
+    tarefa = dict(tarefa, id_tarefa=id_tarefa)
+    tarefa.pop('chave', None)
+    return jsonify(tarefa)
+
+
+@app.route('/jobs/<id_tarefa>/result')
+def job_result(id_tarefa):
+    tarefa = ler_estado_tarefa(id_tarefa)
+    if tarefa is None:
+        return jsonify({'error': 'Tarefa não encontrada'}), 404
+
+    if tarefa['estado'] == 'erro':
+        if 'missing_columns' in tarefa:
+            return resposta_colunas_faltando(tarefa['missing_columns'])
+        return jsonify({'error': tarefa['error']}), 500
+
+    if tarefa['estado'] != 'concluida':
+        return jsonify({'error': 'Tarefa ainda em andamento'}), 409
+
+    resultado = cache_resultados.obter(tarefa['chave'])
+    if resultado is None:
+        return jsonify({'error': 'Resultado da tarefa expirado'}), 410
+
+    id_analise = analises.salvar(resultado)
+    return resposta_analise(id_analise, resultado)
+
+
+@app.route('/progress/<id_tarefa>')
+def progress_stream(id_tarefa):
+    if not re.fullmatch(r'[0-9a-f]{32}', id_tarefa):
+        return jsonify({'error': 'Tarefa não encontrada'}), 404
+
+    # Server-Sent Events: envia cada mudança de estado da tarefa até ela
+    # terminar (o estado pode ainda não existir enquanto o upload chega).
+    # A conexão fecha ao fim da janela e o EventSource reconecta enviando o
+    # id do último evento (Last-Event-ID), para não repetir o estado
+    ultimo_id = request.headers.get('Last-Event-ID')
+    caminho = caminho_tarefa(id_tarefa)
+
+    def eventos():
+        yield f'retry: {app.config["PROGRESSO_RECONEXAO_MS"]}\n\n'
+        ultimo = ultimo_id
+        ultima_modificacao = None
+        ultimo_envio = time()
+        limite = time() + app.config['PROGRESSO_JANELA']
+        while time() < limite:
+            # Só relê o estado quando o arquivo muda (cada gravação troca o
+            # arquivo inteiro, então o inode muda junto)
+            try:
+                estado = os.stat(caminho)
+                modificacao = (estado.st_ino, estado.st_mtime_ns)
+            except OSError:
+                modificacao = None
+            tarefa = None
+            if modificacao is not None and modificacao != ultima_modificacao:
+                ultima_modificacao = modificacao
+                tarefa = ler_estado_tarefa(id_tarefa)
+            if tarefa is not None and repr(tarefa['atualizado_em']) != ultimo:
+                ultimo = repr(tarefa['atualizado_em'])
+                ultimo_envio = time()
+                dados = dict(tarefa, id_tarefa=id_tarefa)
+                dados.pop('chave', None)
+                yield f'id: {ultimo}\ndata: {json.dumps(dados)}\n\n'
+                if tarefa['estado'] in ('concluida', 'erro'):
+                    return
+            elif time() - ultimo_envio > 15:
+                ultimo_envio = time()
+                yield ': keep-alive\n\n'
+            sleep(0.25)
+
+    return Response(
+        stream_with_context(eventos()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
 
-        # Cria DataFrames com a ordem especificada
-        df_agrupamentos = (
-            pd.DataFrame(relatorio_agrupamentos)[ordem_agrupamentos]
-            if relatorio_agrupamentos
-            else pd.DataFrame()
-        )
-        df_nao_agrupados = (
-            pd.DataFrame(relatorio_nao_agrupados)[ordem_nao_agrupados]
-            if relatorio_nao_agrupados
-            else pd.DataFrame()
+
+def obter_analise_requisicao():
+    data = request.get_json(silent=True) or {}
+    id_analise = data.get('id_analise') or request.values.get('id_analise')
+    if not id_analise:
+        return None, (jsonify({'error': 'Análise não informada'}), 400)
+
+    resultado = analises.obter(id_analise)
+    if resultado is None:
+        return None, (
+            jsonify({'error': 'Análise não encontrada ou expirada'}),
+            404,
         )
+    return resultado, None
 
-        # Ordena os dados
-        if not df_agrupamentos.empty:
-            df_agrupamentos = df_agrupamentos.sort_values(
-                by=[
-                    'AGRUPAMENTO_OCI',
-                    'DOCUMENTO_PACIENTE',
-                    'ITEM OBG/FAC (X)',
-                    'CODIGO_SIGTAP',
-                ]
-            )
 
-        # Cria buffer Excel
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-            # Aba de agrupamentos
-            if not df_agrupamentos.empty:
-                df_agrupamentos.to_excel(
-                    writer, sheet_name='Agrupamentos', index=False
-                )
-                worksheet = writer.sheets['Agrupamentos']
+def filtrar_por_valor(serie, valor):
+    # Compara sem formatar a coluna inteira: inteiros pelo número, códigos
+    # categóricos pelo valor já normalizado
+    if pd.api.types.is_integer_dtype(serie):
+        if not re.fullmatch(r'\d{1,18}', valor):
+            return np.zeros(len(serie), dtype=bool)
+        return (serie == int(valor)).to_numpy()
+    return (serie == valor).to_numpy()
 
-                # Formatação de cabeçalho
-                header_format = writer.book.add_format(
-                    {
-                        'bold': True,
-                        'text_wrap': True,
-                        'valign': 'top',
-                        'fg_color': '#4472C4',
-                        'font_color': 'white',
-                        'border': 1,
-                    }
-                )
 
-                # Aplica formatação ao cabeçalho
-                for col_num, value in enumerate(df_agrupamentos.columns):
-                    worksheet.write(0, col_num, value, header_format)
+def linhas_filtradas(resultado, oci=None, cnes=None, paciente=None):
+    # Posições (em ordem) das linhas do relatório que atendem aos filtros.
+    # Cada item mantém o separador e o título da OCI e a linha do paciente
+    item, linha_paciente, separador, marcador, nao_agrupados = (
+        posicoes_relatorio(resultado)
+    )
+    agrupamentos = resultado['relatorio_agrupamentos']
+    restantes = resultado['relatorio_nao_agrupados']
+    if cnes and cnes.isdigit():
+        cnes = cnes.zfill(7)
+
+    selecionados = np.ones(len(agrupamentos), dtype=bool)
+    selecionados_restantes = np.ones(len(restantes), dtype=bool)
+    if oci:
+        selecionados &= filtrar_por_valor(
+            agrupamentos['AGRUPAMENTO_OCI'], formatar_codigo_oci(
+                oci.replace('.', '')
+            )
+        )
+        # Não agrupados não pertencem a nenhuma OCI
+        selecionados_restantes[:] = False
+    if cnes:
+        selecionados &= filtrar_por_valor(
+            agrupamentos['CNES_SOLICITANTE'], cnes
+        )
+        selecionados_restantes &= filtrar_por_valor(
+            restantes['CNES_SOLICITANTE'], cnes
+        )
+    if paciente:
+        selecionados &= filtrar_por_valor(
+            agrupamentos['DOCUMENTO_PACIENTE'], paciente
+        )
+        selecionados_restantes &= filtrar_por_valor(
+            restantes['DOCUMENTO_PACIENTE'], paciente
+        )
 
-                # Ajusta largura das colunas
-                for col_num, column in enumerate(df_agrupamentos.columns):
-                    max_len = max(
-                        df_agrupamentos[column].astype(str).map(len).max(),
-                        len(column),
-                    )
-                    worksheet.set_column(
-                        col_num, col_num, min(max_len + 2, 50)
-                    )
+    partes = [
+        np.array([0]),
+        separador[selecionados],
+        separador[selecionados] + 1,
+        linha_paciente[selecionados],
+        item[selecionados],
+    ]
+    if selecionados_restantes.any():
+        partes.append(np.array([marcador]))
+        partes.append(nao_agrupados[selecionados_restantes])
+    return np.unique(np.concatenate(partes))
+
+
+# Últimos mapas e filtragens do relatório, reaproveitados enquanto a
+# página rola
+_visoes_relatorio = OrderedDict()
+_visoes_lock = threading.Lock()
+
+
+def obter_visao_relatorio(chave, calcular):
+    with _visoes_lock:
+        if chave in _visoes_relatorio:
+            _visoes_relatorio.move_to_end(chave)
+            registrar_metrica(
+                'oci_cache_consultas_total',
+                cache='visoes_relatorio',
+                resultado='acerto',
+            )
+            return _visoes_relatorio[chave]
 
-                # Congela cabeçalho
-                worksheet.freeze_panes(1, 0)
+    registrar_metrica(
+        'oci_cache_consultas_total',
+        cache='visoes_relatorio',
+        resultado='falha',
+    )
+    visao = calcular()
+    with _visoes_lock:
+        _visoes_relatorio[chave] = visao
+        while len(_visoes_relatorio) > app.config['RELATORIO_VISOES_CACHE']:
+            _visoes_relatorio.popitem(last=False)
+    return visao
+
+
+@app.route('/report_lines', methods=['GET'])
+def report_lines():
+    # Janela de linhas do relatório de uma análise armazenada:
+    # offset..offset+limit, opcionalmente filtrada por OCI, CNES solicitante
+    # ou documento do paciente
+    resultado, erro = obter_analise_requisicao()
+    if erro:
+        return erro
+
+    offset = request.args.get('offset', 0, type=int)
+    limit = request.args.get(
+        'limit', app.config['RELATORIO_LINHAS_PAGINA'], type=int
+    )
+    if offset < 0 or limit < 1:
+        return jsonify({'error': 'offset/limit inválidos'}), 400
+    limit = min(limit, app.config['RELATORIO_MAX_LINHAS_PAGINA'])
+
+    filtros = [
+        request.args.get(nome, '').strip()
+        for nome in ('oci', 'cnes', 'paciente')
+    ]
+    id_analise = request.args['id_analise']
+    mapa = obter_visao_relatorio(
+        ('mapa', id_analise), lambda: mapa_relatorio(resultado)
+    )
+    if any(filtros):
+        posicoes = obter_visao_relatorio(
+            ('filtro', id_analise, *filtros),
+            lambda: linhas_filtradas(resultado, *filtros),
+        )
+    else:
+        posicoes = np.arange(len(mapa[0]))
+    total = len(posicoes)
+    linhas = linhas_relatorio(
+        resultado, posicoes[offset:offset + limit], mapa
+    )
 
-            # Aba de não agrupados
-            if not df_nao_agrupados.empty:
-                df_nao_agrupados.to_excel(
-                    writer, sheet_name='Não Agrupados', index=False
-                )
-                worksheet = writer.sheets['Não Agrupados']
+    return jsonify(
+        {'success': True, 'total': total, 'offset': offset, 'linhas': linhas}
+    )
 
-                # Formatação de cabeçalho
-                header_format = writer.book.add_format(
-                    {
-                        'bold': True,
-                        'text_wrap': True,
-                        'valign': 'top',
-                        'fg_color': '#4472C4',
-                        'font_color': 'white',
-                        'border': 1,
-                    }
-                )
 
-                # Aplica formatação ao cabeçalho
-                for col_num, value in enumerate(df_nao_agrupados.columns):
-                    worksheet.write(0, col_num, value, header_format)
+@app.route('/download_pdf', methods=['POST'])
+@perfilavel
+def download_pdf():
+    try:
+        resultado, erro = obter_analise_requisicao()
+        if erro:
+            return erro
+
+        data = request.get_json(silent=True) or {}
+        inicio = time()
+        caminho = gerar_pdf(
+            resultado, bool(data.get('incluir_nao_agrupados'))
+        )
+        registrar_metrica(
+            'oci_exportacao_duracao_segundos', time() - inicio, formato='pdf'
+        )
+        return enviar_arquivo_temporario(
+            caminho, 'relatorio_agrupamentos_oci.pdf', 'application/pdf'
+        )
+    except Exception as e:
+        app.logger.error(f'Erro ao gerar PDF: {str(e)}')
+        return jsonify({'error': f'Erro ao gerar PDF: {str(e)}'}), 500
 
-                # Ajusta largura das colunas
-                for col_num, column in enumerate(df_nao_agrupados.columns):
-                    max_len = max(
-                        df_nao_agrupados[column].astype(str).map(len).max(),
-                        len(column),
-                    )
-                    worksheet.set_column(
-                        col_num, col_num, min(max_len + 2, 50)
-                    )
 
-                # Congela cabeçalho
-                worksheet.freeze_panes(1, 0)
+@app.route('/download_xlsx', methods=['POST'])
+@perfilavel
+def download_xlsx():
+    try:
+        resultado, erro = obter_analise_requisicao()
+        if erro:
+            return erro
 
-        output.seek(0)
+        if (
+            resultado['relatorio_agrupamentos'].empty
+            and resultado['relatorio_nao_agrupados'].empty
+        ):
+            return jsonify({'error': 'Nenhum relatório disponível'}), 400
 
-        return send_file(
-            output,
-            as_attachment=True,
-            download_name=f'relatorio_oci_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx',
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        inicio = time()
+        caminho = gerar_xlsx(resultado)
+        registrar_metrica(
+            'oci_exportacao_duracao_segundos', time() - inicio, formato='xlsx'
+        )
+        return enviar_arquivo_temporario(
+            caminho,
+            f'relatorio_oci_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx',
+            'application/vnd.openxmlformats-officedocument.'
+            'spreadsheetml.sheet',
         )
     except Exception as e:
         app.logger.error(f'Erro ao gerar XLSX: {str(e)}')
         return jsonify({'error': f'Erro ao gerar XLSX: {str(e)}'}), 500
 
 
+@app.route('/download_csv', methods=['GET', 'POST'])
+@perfilavel
+def download_csv():
+    resultado, erro = obter_analise_requisicao()
+    if erro:
+        return erro
+
+    data = request.get_json(silent=True) or {}
+    tabela = data.get('tabela') or request.args.get('tabela', 'agrupamentos')
+    if tabela not in ('agrupamentos', 'nao_agrupados'):
+        return jsonify({'error': 'Tabela inválida'}), 400
+    compactar = str(
+        data.get('gzip') or request.args.get('gzip', '')
+    ).lower() in ('1', 'true', 'sim')
+
+    nome = (
+        f'relatorio_oci_{tabela}_'
+        f'{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
+    )
+    if compactar:
+        nome += '.gz'
+
+    return Response(
+        stream_with_context(
+            gerar_csv(resultado[f'relatorio_{tabela}'], compactar)
+        ),
+        mimetype='application/gzip' if compactar else 'text/csv',
+        headers={'Content-Disposition': f'attachment; filename={nome}'},
+    )
+
+
+@app.route('/download_txt', methods=['GET', 'POST'])
+@perfilavel
+def download_txt():
+    resultado, erro = obter_analise_requisicao()
+    if erro:
+        return erro
+
+    return Response(
+        stream_with_context(gerar_texto_relatorio(resultado)),
+        mimetype='text/plain',
+        headers={
+            'Content-Disposition': 'attachment; filename=relatorio_oci.txt'
+        },
+    )
+
+
 @app.route('/download-modelo')
 def download_modelo():
     return send_from_directory('DB', 'arquivo_modelo.xlsx', as_attachment=True)
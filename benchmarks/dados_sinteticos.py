@@ -0,0 +1,225 @@
+# Gerador determinístico de filas de espera sintéticas no formato do
+# arquivo de filas (REQUIRED_COLUMNS), com os códigos SIGTAP tirados do
+# catálogo de OCIs (db/agrupamentos_oci.json). A mesma semente gera sempre
+# o mesmo arquivo
+#
+# Uso: python benchmarks/dados_sinteticos.py 100000 fila.csv
+#          [--pacientes N] [--casamento 0.3] [--espera 0.9] [--semente 0]
+
+import argparse
+import io
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import REQUIRED_COLUMNS, obter_catalogo  # noqa: E402
+
+# Fração das solicitações de pacientes sem conjunto com códigos que não
+# fazem parte do catálogo
+TAXA_FORA_CATALOGO = 0.2
+# Fração dos códigos SIGTAP e CNES escritos sem os zeros à esquerda, como
+# aparece em arquivos exportados de planilhas
+TAXA_SEM_ZEROS = 0.3
+UNIDADES = 200
+CBOS = ['225125', '225142', '225265', '225270', '223505', '']
+CIDS = ['C50', 'H40', 'I10', 'E11', 'N18', 'K80', 'M54', '']
+
+
+def codigos_catalogo(catalogo):
+    # Códigos do catálogo com o peso de cada um: quantas vezes o código
+    # aparece nas OCIs (códigos comuns a vários conjuntos são mais pedidos)
+    itens = catalogo['itens']
+    contagem = itens['CODIGO_SIGTAP'].value_counts(sort=False)
+    return contagem.index.to_numpy(dtype=object), (
+        contagem.to_numpy() / contagem.sum()
+    )
+
+
+def itens_por_oci(catalogo, tipo):
+    # Códigos de um tipo (OBG/FAC) de cada OCI, concatenados, com o início
+    # e a quantidade de cada OCI
+    itens = catalogo['itens']
+    itens = itens[itens['ITEM OBG/FAC (X)'] == tipo]
+    quantidade = np.bincount(
+        itens['ORDEM_OCI'].to_numpy(), minlength=len(catalogo['ocis'])
+    )
+    inicio = np.concatenate([[0], np.cumsum(quantidade)[:-1]])
+    return itens['CODIGO_SIGTAP'].to_numpy(dtype=object), inicio, quantidade
+
+
+def expandir(escolhas, codigos, inicio, quantidade):
+    # Para cada escolha (índice de OCI), todos os códigos daquela OCI.
+    # Retorna a posição da escolha de cada linha e o código
+    repeticoes = quantidade[escolhas]
+    dono = np.repeat(np.arange(len(escolhas)), repeticoes)
+    deslocamento = np.arange(len(dono)) - np.repeat(
+        np.cumsum(repeticoes) - repeticoes, repeticoes
+    )
+    return dono, codigos[inicio[escolhas][dono] + deslocamento]
+
+
+def sem_zeros(valores, rng):
+    # Remove os zeros à esquerda de uma parte dos valores
+    valores = valores.astype(object)
+    sorteio = rng.random(len(valores)) < TAXA_SEM_ZEROS
+    valores[sorteio] = (
+        pd.Series(valores[sorteio], dtype=object).str.lstrip('0').to_numpy()
+    )
+    return valores
+
+
+def datas(quantidade, rng, inicio='2023-01-01', dias=730):
+    # Datas dd/mm/aaaa sorteadas entre os dias do período
+    textos = pd.date_range(inicio, periods=dias).strftime('%d/%m/%Y')
+    return textos.to_numpy(dtype=object)[rng.integers(0, dias, quantidade)]
+
+
+def gerar_fila(
+    linhas,
+    pacientes=None,
+    taxa_casamento=0.3,
+    taxa_espera=0.9,
+    semente=0,
+    catalogo=None,
+):
+    # linhas: total de solicitações; pacientes: total aproximado de
+    #   pacientes em espera (padrão: uma média de 4 solicitações cada)
+    # taxa_casamento: fração dos pacientes montados para completar uma OCI
+    #   (todos os itens obrigatórios e metade dos facultativos). Pacientes
+    #   com códigos sorteados também podem completar uma OCI por acaso, por
+    #   isso a fração de pacientes agrupados na análise fica um pouco acima
+    # taxa_espera: fração das solicitações com STATUS 1 (em espera)
+    rng = np.random.default_rng(semente)
+    catalogo = catalogo or obter_catalogo()
+    linhas_espera = int(round(linhas * taxa_espera))
+    pacientes = max(1, pacientes or linhas_espera // 4)
+
+    # Pacientes que completam uma OCI
+    casados = int(round(pacientes * taxa_casamento))
+    ocis = rng.integers(0, len(catalogo['ocis']), casados)
+    dono_obg, codigo_obg = expandir(ocis, *itens_por_oci(catalogo, 'OBG'))
+    dono_fac, codigo_fac = expandir(ocis, *itens_por_oci(catalogo, 'FAC'))
+    metade = rng.random(len(dono_fac)) < 0.5
+    dono = np.concatenate([dono_obg, dono_fac[metade]])
+    codigo = np.concatenate([codigo_obg, codigo_fac[metade]])
+    ordem = np.argsort(dono, kind='stable')
+    dono, codigo = dono[ordem], codigo[ordem]
+    # Se as linhas não bastam, os últimos pacientes casados ficam de fora
+    dono, codigo = dono[:linhas_espera], codigo[:linhas_espera]
+
+    # Demais pacientes: uma solicitação cada e o restante sorteado entre
+    # eles, com códigos na proporção do catálogo ou fora dele
+    restantes = linhas_espera - len(dono)
+    outros = np.arange(casados, max(pacientes, casados + 1))
+    dono_outros = np.concatenate(
+        [
+            outros[: min(restantes, len(outros))],
+            rng.choice(outros, max(0, restantes - len(outros))),
+        ]
+    )
+    codigos, pesos = codigos_catalogo(catalogo)
+    codigo_outros = rng.choice(codigos, restantes, p=pesos)
+    fora = rng.random(restantes) < TAXA_FORA_CATALOGO
+    codigo_outros[fora] = [
+        f'0{c:09d}' for c in rng.integers(201010000, 999999999, fora.sum())
+    ]
+
+    # Solicitações fora de espera (descartadas na leitura)
+    linhas_fora = linhas - linhas_espera
+    dono_fora = rng.integers(0, pacientes, linhas_fora)
+    codigo_fora = rng.choice(codigos, linhas_fora, p=pesos)
+
+    dono = np.concatenate([dono, dono_outros, dono_fora])
+    codigo = np.concatenate([codigo, codigo_outros, codigo_fora])
+    status = np.concatenate(
+        [
+            np.full(linhas_espera, '1', dtype=object),
+            rng.choice(np.array(['2', '3', '4'], dtype=object), linhas_fora),
+        ]
+    )
+
+    # Ordem do arquivo sorteada (as solicitações de um paciente não vêm
+    # juntas, como em um arquivo real ordenado por data)
+    ordem = rng.permutation(linhas)
+    dono, codigo, status = dono[ordem], codigo[ordem], status[ordem]
+
+    # CNS de 15 dígitos, distintos por paciente (7919 é primo com 10**9)
+    documentos = 700000000000000 + rng.permutation(
+        np.arange(pacientes) * 7919 % 10**9
+    )
+    unidades = np.array(
+        [f'{c:07d}' for c in rng.integers(1, 9999999, UNIDADES)],
+        dtype=object,
+    )
+    em_espera = status == '1'
+    autorizacao = np.where(em_espera, '', datas(linhas, rng))
+    execucao = np.where(
+        em_espera | (rng.random(linhas) < 0.5), '', datas(linhas, rng)
+    )
+    executante = np.where(
+        em_espera, '', sem_zeros(rng.choice(unidades, linhas), rng)
+    )
+
+    fila = pd.DataFrame(
+        {
+            'IDENTIFICADOR_LOCAL': np.arange(1, linhas + 1).astype(str),
+            'DOCUMENTO_PACIENTE': documentos[dono].astype(str),
+            'DATA_SOLICITACAO': datas(linhas, rng),
+            'CNES_SOLICITANTE': sem_zeros(rng.choice(unidades, linhas), rng),
+            'CNES_REGULADOR': rng.choice(unidades[:5], linhas),
+            'CODIGO_SIGTAP': sem_zeros(codigo, rng),
+            'CBO': rng.choice(np.array(CBOS, dtype=object), linhas),
+            'CID10': rng.choice(np.array(CIDS, dtype=object), linhas),
+            'CODIGO_MODALIDADE_ASSISTENCIAL': rng.choice(
+                np.array(['01', '02'], dtype=object), linhas
+            ),
+            'CODIGO_CARTER_SOLICITACAO': rng.choice(
+                np.array(['01', '02'], dtype=object), linhas
+            ),
+            'STATUS': status,
+            'DATA_AUTORIZACAO': autorizacao,
+            'DATA_EXECUCAO': execucao,
+            'CNES_EXECUTANTE': executante,
+        }
+    )
+    return fila[REQUIRED_COLUMNS]
+
+
+def conteudo_fila(fila, nome_arquivo):
+    # Bytes do arquivo no formato aceito pelo envio (CSV ';' ou XLSX)
+    if nome_arquivo.endswith('.xlsx'):
+        buffer = io.BytesIO()
+        fila.to_excel(buffer, index=False)
+        return buffer.getvalue()
+    return fila.to_csv(sep=';', index=False).encode('utf-8')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Gera uma fila de espera sintética'
+    )
+    parser.add_argument('linhas', type=int)
+    parser.add_argument('saida', help='arquivo .csv ou .xlsx')
+    parser.add_argument('--pacientes', type=int)
+    parser.add_argument('--casamento', type=float, default=0.3)
+    parser.add_argument('--espera', type=float, default=0.9)
+    parser.add_argument('--semente', type=int, default=0)
+    args = parser.parse_args()
+
+    fila = gerar_fila(
+        args.linhas,
+        args.pacientes,
+        args.casamento,
+        args.espera,
+        args.semente,
+    )
+    with open(args.saida, 'wb') as arquivo:
+        arquivo.write(conteudo_fila(fila, args.saida))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+# Benchmark das etapas da análise (leitura, formatação, casamento e
+# exportações PDF/XLSX) sobre filas sintéticas de 1 mil a 1 milhão de
+# solicitações. Mede o tempo (menor entre as repetições) e o pico de
+# memória de cada etapa, grava o resultado em JSON e compara com a
+# referência gravada (benchmarks/baseline.json). Sai com código 1 quando
+# alguma etapa piora além da tolerância
+#
+# Uso: python benchmarks/executar.py [--linhas 1000 10000 100000 1000000]
+#          [--etapas leitura formatacao analise pdf xlsx] [--repeticoes 3]
+#          [--saida benchmarks/resultados.json] [--baseline ARQUIVO]
+#          [--gravar-baseline] [--tolerancia 0.25]
+
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import tracemalloc
+from datetime import datetime
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+PASTA = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(PASTA))
+
+from dados_sinteticos import conteudo_fila, gerar_fila  # noqa: E402
+
+from app import (analisar_dados, formatar_dados, gerar_pdf,  # noqa: E402
+                 gerar_xlsx, ler_arquivo)
+
+TAMANHOS = [1_000, 10_000, 100_000, 1_000_000]
+BASELINE = os.path.join(PASTA, 'baseline.json')
+RESULTADOS = os.path.join(PASTA, 'resultados.json')
+# Diferenças absolutas abaixo destes valores não contam como regressão
+# (ruído de medição nas filas pequenas)
+MINIMO_SEGUNDOS = 0.05
+MINIMO_MEMORIA_MB = 2.0
+
+
+def etapa_leitura(estado):
+    estado['df'] = ler_arquivo(estado['conteudo'], 'fila.csv')
+
+
+def etapa_formatacao(estado):
+    estado['df'] = formatar_dados(estado['df'])
+
+
+def etapa_analise(estado):
+    resultado = analisar_dados(estado['df'])
+    # O cabeçalho do PDF mostra o tempo de processamento do resumo
+    resultado['resumo'] = {'tempo_processamento': 0.0}
+    estado['resultado'] = resultado
+
+
+def etapa_pdf(estado):
+    os.remove(gerar_pdf(estado['resultado']))
+
+
+def etapa_xlsx(estado):
+    os.remove(gerar_xlsx(estado['resultado']))
+
+
+# Etapas na ordem de execução, com a etapa da qual dependem
+ETAPAS = {
+    'leitura': (etapa_leitura, None),
+    'formatacao': (etapa_formatacao, 'leitura'),
+    'analise': (etapa_analise, 'formatacao'),
+    'pdf': (etapa_pdf, 'analise'),
+    'xlsx': (etapa_xlsx, 'analise'),
+}
+
+
+def etapas_necessarias(escolhidas):
+    necessarias = set()
+    for etapa in escolhidas:
+        while etapa and etapa not in necessarias:
+            necessarias.add(etapa)
+            etapa = ETAPAS[etapa][1]
+    return [etapa for etapa in ETAPAS if etapa in necessarias]
+
+
+def executar_cadeia(conteudo, etapas, medir_memoria=False):
+    # Executa as etapas em sequência sobre o mesmo arquivo. Retorna o tempo
+    # de cada etapa ou, com medir_memoria, o pico de memória alocada
+    # durante a etapa além do que já estava alocado no início
+    estado = {'conteudo': conteudo}
+    medidas = {}
+    for etapa in etapas:
+        funcao = ETAPAS[etapa][0]
+        gc.collect()
+        if medir_memoria:
+            tracemalloc.reset_peak()
+            inicio = tracemalloc.get_traced_memory()[0]
+            funcao(estado)
+            medidas[etapa] = (tracemalloc.get_traced_memory()[1] - inicio) / (
+                1024 * 1024
+            )
+        else:
+            inicio = perf_counter()
+            funcao(estado)
+            medidas[etapa] = perf_counter() - inicio
+    return medidas, estado
+
+
+def medir(linhas, etapas, repeticoes, parametros):
+    fila = gerar_fila(
+        linhas,
+        taxa_casamento=parametros['casamento'],
+        taxa_espera=parametros['espera'],
+        semente=parametros['semente'],
+    )
+    conteudo = conteudo_fila(fila, 'fila.csv')
+    del fila
+
+    tempos = []
+    for _ in range(repeticoes):
+        medidas, estado = executar_cadeia(conteudo, etapas)
+        tempos.append(medidas)
+
+    # Memória em uma execução à parte: o tracemalloc deixa tudo mais lento.
+    # Não inclui as partes do PDF desenhadas em outros processos
+    tracemalloc.start()
+    try:
+        memoria, _ = executar_cadeia(conteudo, etapas, medir_memoria=True)
+    finally:
+        tracemalloc.stop()
+
+    resultado = estado.get('resultado')
+    contexto = {
+        'linhas': linhas,
+        'bytes_arquivo': len(conteudo),
+        'solicitacoes_em_espera': (
+            resultado['total_solicitacoes'] if resultado else None
+        ),
+        'pacientes_agrupados': (
+            int(resultado['pacientes_agrupados']) if resultado else None
+        ),
+    }
+    medicoes = []
+    for etapa in etapas:
+        segundos = min(medidas[etapa] for medidas in tempos)
+        medicoes.append(
+            dict(
+                contexto,
+                etapa=etapa,
+                segundos=round(segundos, 4),
+                segundos_mediana=round(
+                    float(np.median([medidas[etapa] for medidas in tempos])),
+                    4,
+                ),
+                linhas_por_segundo=round(linhas / max(segundos, 1e-9)),
+                pico_memoria_mb=round(memoria[etapa], 1),
+            )
+        )
+    return medicoes
+
+
+def comparar(medicoes, baseline, tolerancia):
+    # Razão entre a medição atual e a da referência para cada (linhas,
+    # etapa) presente nas duas; regressão quando a razão passa de
+    # 1 + tolerancia e a diferença absoluta passa do mínimo
+    anteriores = {
+        (medicao['linhas'], medicao['etapa']): medicao
+        for medicao in baseline['resultados']
+    }
+    regressoes = []
+    for medicao in medicoes:
+        anterior = anteriores.get((medicao['linhas'], medicao['etapa']))
+        if anterior is None:
+            continue
+        for medida, minimo in (
+            ('segundos', MINIMO_SEGUNDOS),
+            ('pico_memoria_mb', MINIMO_MEMORIA_MB),
+        ):
+            razao = medicao[medida] / max(anterior[medida], 1e-9)
+            medicao[f'razao_{medida}'] = round(razao, 3)
+            if (
+                razao > 1 + tolerancia
+                and medicao[medida] - anterior[medida] > minimo
+            ):
+                regressoes.append(
+                    {
+                        'linhas': medicao['linhas'],
+                        'etapa': medicao['etapa'],
+                        'medida': medida,
+                        'baseline': anterior[medida],
+                        'atual': medicao[medida],
+                        'razao': round(razao, 3),
+                    }
+                )
+    return regressoes
+
+
+def ambiente():
+    return {
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'plataforma': platform.platform(),
+        'processadores': os.cpu_count(),
+    }
+
+
+def imprimir(medicoes):
+    print(
+        f'{"linhas":>10} {"etapa":<11} {"segundos":>9} {"linhas/s":>11} '
+        f'{"memória MB":>11} {"x baseline":>10}'
+    )
+    for medicao in medicoes:
+        razao = medicao.get('razao_segundos')
+        print(
+            f'{medicao["linhas"]:>10} {medicao["etapa"]:<11} '
+            f'{medicao["segundos"]:>9.3f} {medicao["linhas_por_segundo"]:>11} '
+            f'{medicao["pico_memoria_mb"]:>11.1f} '
+            f'{"" if razao is None else f"{razao:.2f}":>10}'
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark das etapas da análise'
+    )
+    parser.add_argument('--linhas', type=int, nargs='+', default=TAMANHOS)
+    parser.add_argument(
+        '--etapas', nargs='+', choices=list(ETAPAS), default=list(ETAPAS)
+    )
+    parser.add_argument('--repeticoes', type=int, default=3)
+    parser.add_argument('--casamento', type=float, default=0.3)
+    parser.add_argument('--espera', type=float, default=0.9)
+    parser.add_argument('--semente', type=int, default=0)
+    parser.add_argument('--saida', default=RESULTADOS)
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument(
+        '--gravar-baseline',
+        action='store_true',
+        help='grava as medições como nova referência',
+    )
+    parser.add_argument(
+        '--tolerancia',
+        type=float,
+        default=0.25,
+        help='piora relativa aceita antes de acusar regressão',
+    )
+    args = parser.parse_args()
+
+    parametros = {
+        'casamento': args.casamento,
+        'espera': args.espera,
+        'semente': args.semente,
+    }
+    etapas = etapas_necessarias(args.etapas)
+    medicoes = []
+    for linhas in args.linhas:
+        print(f'Medindo {linhas} linhas...', file=sys.stderr)
+        medicoes.extend(
+            medir(linhas, etapas, max(1, args.repeticoes), parametros)
+        )
+
+    relatorio = {
+        'gerado_em': datetime.now().isoformat(timespec='seconds'),
+        'ambiente': ambiente(),
+        'parametros': parametros,
+        'repeticoes': args.repeticoes,
+        'resultados': medicoes,
+    }
+
+    regressoes = []
+    if not args.gravar_baseline and os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as arquivo:
+            baseline = json.load(arquivo)
+        if baseline.get('parametros') != parametros:
+            print(
+                'Aviso: fila gerada com parâmetros diferentes dos da '
+                'referência',
+                file=sys.stderr,
+            )
+        regressoes = comparar(medicoes, baseline, args.tolerancia)
+        relatorio['baseline'] = {
+            'arquivo': args.baseline,
+            'gerado_em': baseline.get('gerado_em'),
+            'ambiente': baseline.get('ambiente'),
+            'tolerancia': args.tolerancia,
+        }
+        relatorio['regressoes'] = regressoes
+
+    destino = args.baseline if args.gravar_baseline else args.saida
+    with open(destino, 'w', encoding='utf-8') as arquivo:
+        json.dump(relatorio, arquivo, indent=2, ensure_ascii=False)
+        arquivo.write('\n')
+
+    imprimir(medicoes)
+    for regressao in regressoes:
+        print(
+            f'REGRESSÃO {regressao["etapa"]} ({regressao["linhas"]} linhas): '
+            f'{regressao["medida"]} {regressao["baseline"]} -> '
+            f'{regressao["atual"]} ({regressao["razao"]:.2f}x)',
+            file=sys.stderr,
+        )
+    return 1 if regressoes else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
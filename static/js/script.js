@@ -13,6 +13,26 @@ $(document).ready(function () {
     const summaryResults = $('#summaryResults');
     const downloadPdfButton = $('#downloadPdfButton');
     const downloadXlsxButton = $('#downloadXlsxButton');
+    const downloadCsvButton = $('#downloadCsvButton');
+    const downloadCsvNaoAgrupadosButton = $('#downloadCsvNaoAgrupadosButton');
+    const downloadTxtButton = $('#downloadTxtButton');
+    const csvGzipOption = $('#csvGzipOption');
+    const pdfNaoAgrupadosOption = $('#pdfNaoAgrupadosOption');
+    const applyDeltaButton = $('#applyDeltaButton');
+    const deltaFileInput = $('#deltaFileInput');
+
+    // Relatório paginado
+    const reportFilters = $('#reportFilters');
+    const reportViewer = $('#reportViewer');
+    const reportSpacer = reportViewer.find('.report-viewer-spacer');
+    const reportWindow = reportViewer.find('.report-viewer-window');
+    const reportLineCount = $('#reportLineCount');
+    const filterOci = $('#filterOci');
+    const filterCnes = $('#filterCnes');
+    const filterPaciente = $('#filterPaciente');
+    const applyFiltersButton = $('#applyFiltersButton');
+    const REPORT_LINE_HEIGHT = 17; // px, igual ao .report-line
+    const REPORT_PAGE_SIZE = 200; // linhas por requisição
 
     // Elementos do Modal
     const modelModal = $('#modelModal');
@@ -25,12 +45,12 @@ $(document).ready(function () {
     const progressBarProcessInner = $('#progressBarProcessInner');
     const progressText = $('#progressText');
 
-    let uploadedFile = null;
-    let currentReport = null;
-    let currentProcessingTime = 0;
-    let currentAgrupamentosXlsx = null;
-    let currentNaoAgrupadosXlsx = null;
+    let uploadedFiles = [];
+    let reportView = null;
+    let currentAnalysisId = null;
+    let currentTableRows = 0;
     let dropTimeout = null;
+    let progressSource = null;
 
     // Modo Escuro
     function applyDarkMode(isDark) {
@@ -122,19 +142,25 @@ $(document).ready(function () {
     });
 
     function handleFiles(files) {
-        uploadedFile = null;
+        uploadedFiles = [];
         uploadMessage.removeClass('success error').text('');
-        currentReport = null;
-        currentAgrupamentosXlsx = null;
-        currentNaoAgrupadosXlsx = null;
+        currentAnalysisId = null;
+        currentTableRows = 0;
+        closeReportViewer();
 
         if (files.length > 0) {
-            const file = files[0];
-            const fileExtension = file.name.split('.').pop().toLowerCase();
-
-            if (fileExtension === 'csv' || fileExtension === 'xlsx') {
-                uploadedFile = file;
-                fileNameDisplay.text(`Arquivo selecionado: ${file.name}`);
+            // Vários arquivos (ex.: um por município) são analisados em conjunto
+            const selected = Array.from(files);
+            const allValid = selected.every(function (file) {
+                const fileExtension = file.name.split('.').pop().toLowerCase();
+                return fileExtension === 'csv' || fileExtension === 'xlsx';
+            });
+
+            if (allValid) {
+                uploadedFiles = selected;
+                fileNameDisplay.text(selected.length === 1
+                    ? `Arquivo selecionado: ${selected[0].name}`
+                    : `${selected.length} arquivos selecionados: ${selected.map(file => file.name).join(', ')}`);
                 analyzeButton.prop('disabled', false);
 
                 // Efeito visual de confirmação
@@ -162,14 +188,78 @@ $(document).ready(function () {
     }
 
     // Função para atualizar o progresso
-    function updateProgress(progress) {
+    const stageLabels = {
+        leitura: 'Lendo arquivo',
+        formatacao: 'Formatando dados',
+        casamento: 'Identificando conjuntos de OCI',
+        relatorio: 'Montando relatório'
+    };
+
+    function updateProgress(progress, detail) {
         progressBarProcessInner.css('width', progress + '%');
-        progressText.text('Processando... ' + progress + '%');
+        progressText.text('Processando... ' + progress + '%' + (detail ? ' - ' + detail : ''));
+    }
+
+    // Progresso real do processamento via Server-Sent Events
+    function newProgressId() {
+        if (window.crypto && window.crypto.randomUUID) {
+            return window.crypto.randomUUID().replace(/-/g, '');
+        }
+        let id = '';
+        for (let i = 0; i < 32; i++) {
+            id += Math.floor(Math.random() * 16).toString(16);
+        }
+        return id;
+    }
+
+    function openProgressStream(progressId, onFinished) {
+        closeProgressStream();
+        if (!window.EventSource) {
+            return false;
+        }
+        let startedAt = null;
+        // O servidor fecha cada conexão após uma janela curta; o EventSource
+        // reconecta sozinho (retry) e continua do último evento recebido
+        progressSource = new EventSource('/progress/' + progressId);
+        progressSource.onmessage = function (event) {
+            const job = JSON.parse(event.data);
+            if (job.estado === 'concluida' || job.estado === 'erro') {
+                closeProgressStream();
+                updateProgress(100);
+                if (onFinished) {
+                    onFinished(job);
+                }
+                return;
+            }
+            if (job.percentual === undefined) {
+                return;
+            }
+            startedAt = startedAt || Date.now();
+            const elapsed = (Date.now() - startedAt) / 1000;
+            const percent = job.percentual;
+            let detail = stageLabels[job.etapa] || '';
+            if (job.linhas_total) {
+                detail += ` (${job.linhas_processadas.toLocaleString('pt-BR')} de ${job.linhas_total.toLocaleString('pt-BR')} linhas)`;
+            }
+            if (percent > 0 && elapsed > 1) {
+                const eta = Math.round(elapsed * (100 - percent) / percent);
+                detail += ` - restam ~${eta}s`;
+            }
+            updateProgress(percent, detail);
+        };
+        return true;
+    }
+
+    function closeProgressStream() {
+        if (progressSource) {
+            progressSource.close();
+            progressSource = null;
+        }
     }
 
     // Análise do arquivo
     analyzeButton.on('click', function () {
-        if (!uploadedFile) {
+        if (uploadedFiles.length === 0) {
             uploadMessage.addClass('error').text('Nenhum arquivo selecionado para análise.');
             return;
         }
@@ -184,14 +274,24 @@ $(document).ready(function () {
         progressBarProcessInner.css('width', '0%');
         progressText.text('Processando... 0%');
 
+        closeReportViewer();
         jsonResults.text('Processando dados...');
         resultsSection.hide();
 
+        const progressId = newProgressId();
         const formData = new FormData();
-        formData.append('file', uploadedFile);
+        if (uploadedFiles.length === 1) {
+            formData.append('file', uploadedFiles[0]);
+        } else {
+            uploadedFiles.forEach(function (file) {
+                formData.append('files', file);
+            });
+        }
+        formData.append('id_progresso', progressId);
+        formData.append('relatorio', 'paginado');
 
         $.ajax({
-            url: '/analyze_file',
+            url: uploadedFiles.length === 1 ? '/analyze_file' : '/analyze_files',
             type: 'POST',
             data: formData,
             processData: false,
@@ -207,74 +307,272 @@ $(document).ready(function () {
                     }
                 });
 
-                // Progresso do processamento (simulado)
-                let progress = 50;
-                const progressInterval = setInterval(function () {
-                    progress += Math.random() * 5;
-                    if (progress >= 100) {
-                        clearInterval(progressInterval);
-                        progress = 100;
-                    }
-                    updateProgress(progress);
-                }, 500);
+                // Progresso do processamento (etapas reais do servidor)
+                xhr.upload.addEventListener('load', function () {
+                    progressBar.css('width', '50%');
+                    openProgressStream(progressId);
+                });
 
                 return xhr;
             },
             success: function (response) {
-                progressContainer.hide();
-                progressBarProcess.hide();
-                analyzeButton.prop('disabled', false).text('Analisar Arquivo');
-
-                if (response.error) {
-                    uploadMessage.addClass('error').text(response.error);
-                    jsonResults.text('Erro na análise: ' + response.error);
-                    resultsSection.show();
-                } else if (response.success) {
-                    uploadMessage.addClass('success').text('Análise concluída com sucesso!');
-                    currentReport = response.relatorio;
-                    currentAgrupamentosXlsx = response.relatorio_agrupamentos || [];
-                    currentNaoAgrupadosXlsx = response.relatorio_nao_agrupados || [];
-                    currentProcessingTime = response.resumo.tempo_processamento;
-
-                    // Exibe o resumo
-                    const resumo = response.resumo;
-                    summaryResults.html(`
-                        <p>Total de pacientes: ${resumo.total_pacientes}</p>
-                        <p>Total de solicitações com status PENDENTE: ${resumo.total_solicitacoes}</p>
-                        <p>Pacientes em agrupamentos: ${resumo.pacientes_agrupados}</p>
-                        <p>Agrupamentos encontrados: ${resumo.agrupamentos_encontrados}</p>
-                        <p>Tempo total de processamento: ${resumo.tempo_processamento} segundos</p>
-                        <details>
-                            <summary>Detalhes do tempo</summary>
-                            <p>Leitura do arquivo: ${resumo.tempos_parciais.leitura} segundos</p>
-                            <p>Formatação dos dados: ${resumo.tempos_parciais.formatacao} segundos</p>
-                            <p>Análise dos dados: ${resumo.tempos_parciais.analise} segundos</p>
-                        </details>
-                    `);
-
-                    // Exibe o relatório completo
-                    jsonResults.text(response.relatorio.join('\n'));
-                    resultsSection.show();
-                } else if (response.message) {
-                    uploadMessage.addClass('error').text(response.message);
-                    jsonResults.text('Detalhes: ' + JSON.stringify(response.details || {}, null, 2));
-                    resultsSection.show();
+                if (response.id_tarefa) {
+                    // Arquivo grande: análise em segundo plano
+                    uploadMessage.removeClass('success error').text('Arquivo na fila de análise...');
+                    const streaming = openProgressStream(response.id_tarefa, function () {
+                        $.getJSON('/jobs/' + response.id_tarefa + '/result', { relatorio: 'paginado' })
+                            .done(showAnalysisResponse)
+                            .fail(showAnalysisError);
+                    });
+                    if (!streaming) {
+                        pollJob(response.id_tarefa);
+                    }
+                    return;
                 }
+                closeProgressStream();
+                showAnalysisResponse(response);
             },
             error: function (jqXHR, textStatus, errorThrown) {
-                progressContainer.hide();
-                progressBarProcess.hide();
-                analyzeButton.prop('disabled', false).text('Analisar Arquivo');
-                uploadMessage.addClass('error').text('Erro ao enviar arquivo: ' + textStatus + '. Detalhes: ' + errorThrown);
-                jsonResults.text('Falha na comunicação com o servidor.');
-                resultsSection.show();
+                closeProgressStream();
+                showAnalysisError(jqXHR, textStatus, errorThrown);
             }
         });
     });
 
+    // Acompanha a tarefa assíncrona até a conclusão
+    function pollJob(jobId) {
+        $.getJSON('/jobs/' + jobId)
+            .done(function (job) {
+                if (job.estado === 'concluida' || job.estado === 'erro') {
+                    $.getJSON('/jobs/' + jobId + '/result', { relatorio: 'paginado' })
+                        .done(showAnalysisResponse)
+                        .fail(showAnalysisError);
+                } else {
+                    uploadMessage.text(job.estado === 'processando'
+                        ? 'Analisando arquivo no servidor...'
+                        : 'Arquivo na fila de análise...');
+                    setTimeout(function () { pollJob(jobId); }, 1000);
+                }
+            })
+            .fail(showAnalysisError);
+    }
+
+    function showAnalysisResponse(response) {
+        progressContainer.hide();
+        progressBarProcess.hide();
+        analyzeButton.prop('disabled', false).text('Analisar Arquivo');
+
+        if (response.error) {
+            uploadMessage.addClass('error').text(response.error);
+            jsonResults.text('Erro na análise: ' + response.error);
+            resultsSection.show();
+        } else if (response.success) {
+            uploadMessage.removeClass('error').addClass('success').text('Análise concluída com sucesso!');
+            currentAnalysisId = response.id_analise;
+            // Só as contagens: as tabelas ficam no servidor (relatorio=paginado)
+            currentTableRows = response.linhas_agrupamentos + response.linhas_nao_agrupados;
+
+            // Exibe o resumo
+            const resumo = response.resumo;
+            summaryResults.html(`
+                <p>Total de pacientes: ${resumo.total_pacientes}</p>
+                <p>Total de solicitações com status PENDENTE: ${resumo.total_solicitacoes}</p>
+                <p>Pacientes em agrupamentos: ${resumo.pacientes_agrupados}</p>
+                <p>Agrupamentos encontrados: ${resumo.agrupamentos_encontrados}</p>
+                <p>Tempo total de processamento: ${resumo.tempo_processamento} segundos</p>
+                <details>
+                    <summary>Detalhes do tempo</summary>
+                    <p>Leitura do arquivo: ${resumo.tempos_parciais.leitura} segundos</p>
+                    ${resumo.tempos_parciais.formatacao !== undefined
+                        ? `<p>Formatação dos dados: ${resumo.tempos_parciais.formatacao} segundos</p>` : ''}
+                    <p>Análise dos dados: ${resumo.tempos_parciais.analise} segundos</p>
+                </details>
+                ${formatFiles(resumo)}
+                ${formatChanges(resumo)}
+                ${formatInvalidValues('Datas não reconhecidas', resumo.datas_invalidas)}
+                ${formatInvalidValues('Códigos não numéricos', resumo.codigos_nao_numericos)}
+            `);
+
+            // Exibe o relatório: em janelas buscadas sob demanda ou, se a
+            // resposta trouxe as linhas, completo
+            if (response.relatorio) {
+                jsonResults.text(response.relatorio.join('\n'));
+            } else {
+                jsonResults.hide();
+                openReportViewer();
+            }
+            resultsSection.show();
+        } else if (response.message) {
+            uploadMessage.addClass('error').text(response.message);
+            jsonResults.text('Detalhes: ' + JSON.stringify(response.details || {}, null, 2));
+            resultsSection.show();
+        }
+    }
+
+    // Escapa textos vindos do arquivo enviado (nomes de arquivo e de
+    // coluna) antes de interpolá-los no HTML do resumo
+    function escapeHtml(text) {
+        return $('<div>').text(String(text)).html();
+    }
+
+    // Solicitações por arquivo na análise conjunta de vários arquivos
+    function formatFiles(resumo) {
+        if (!resumo.arquivos) {
+            return '';
+        }
+        const items = resumo.arquivos
+            .map(file => `<p>${escapeHtml(file.nome)}: ${file.solicitacoes}</p>`)
+            .join('');
+        return `<details><summary>Arquivos analisados (${resumo.arquivos.length})</summary>${items}`
+            + `<p>Solicitações repetidas entre arquivos: ${resumo.solicitacoes_duplicadas}</p></details>`;
+    }
+
+    // Resumo do arquivo de alterações aplicado (reanálise incremental)
+    function formatChanges(resumo) {
+        const changes = resumo.alteracoes;
+        if (!changes) {
+            return '';
+        }
+        return `<details><summary>Alterações aplicadas</summary>`
+            + `<p>Solicitações incluídas: ${changes.incluidas}</p>`
+            + `<p>Solicitações removidas: ${changes.removidas}</p>`
+            + `<p>Pacientes recalculados: ${changes.pacientes_recalculados}</p></details>`;
+    }
+
+    // Aviso de valores que não puderam ser convertidos, por coluna
+    function formatInvalidValues(title, invalidValues) {
+        const columns = Object.entries(invalidValues || {}).filter(([, total]) => total > 0);
+        if (columns.length === 0) {
+            return '';
+        }
+        const items = columns.map(([column, total]) => `<p>${escapeHtml(column)}: ${total}</p>`).join('');
+        return `<details><summary>${title}</summary>${items}</details>`;
+    }
+
+    // Visualização virtual do relatório: só a janela visível é buscada em
+    // /report_lines (em páginas de REPORT_PAGE_SIZE linhas) e desenhada
+    function openReportViewer() {
+        reportView = {
+            id: currentAnalysisId,
+            filters: {
+                oci: filterOci.val().trim(),
+                cnes: filterCnes.val().trim(),
+                paciente: filterPaciente.val().trim()
+            },
+            total: null,
+            pages: {},
+            pending: {}
+        };
+        reportSpacer.css('height', 0);
+        reportWindow.empty();
+        reportLineCount.text('');
+        reportViewer.scrollTop(0);
+        reportFilters.show();
+        reportViewer.show();
+        renderReportWindow();
+    }
+
+    function closeReportViewer() {
+        reportView = null;
+        reportFilters.hide();
+        reportViewer.hide();
+        reportWindow.empty();
+        jsonResults.show();
+    }
+
+    function fetchReportPage(page) {
+        const view = reportView;
+        if (view.pages[page] || view.pending[page]) {
+            return;
+        }
+        view.pending[page] = true;
+        const params = $.extend({
+            id_analise: view.id,
+            offset: page * REPORT_PAGE_SIZE,
+            limit: REPORT_PAGE_SIZE
+        }, view.filters);
+        $.getJSON('/report_lines', params)
+            .done(function (response) {
+                if (reportView !== view) {
+                    return; // filtros ou análise mudaram nesse meio tempo
+                }
+                delete view.pending[page];
+                view.pages[page] = response.linhas;
+                if (view.total !== response.total) {
+                    view.total = response.total;
+                    reportSpacer.css('height', view.total * REPORT_LINE_HEIGHT + 'px');
+                    reportLineCount.text(view.total + ' linhas');
+                }
+                renderReportWindow();
+            })
+            .fail(function (jqXHR) {
+                delete view.pending[page];
+                const error = jqXHR.responseJSON && jqXHR.responseJSON.error;
+                reportLineCount.text('Erro ao carregar o relatório' + (error ? ': ' + error : ''));
+            });
+    }
+
+    function renderReportWindow() {
+        const view = reportView;
+        if (!view) {
+            return;
+        }
+        const first = Math.floor(reportViewer.scrollTop() / REPORT_LINE_HEIGHT);
+        const visible = Math.ceil(reportViewer.innerHeight() / REPORT_LINE_HEIGHT) + 1;
+        const last = view.total === null ? first + visible : Math.min(first + visible, view.total);
+
+        // Busca as páginas que cobrem a janela visível
+        const firstPage = Math.floor(first / REPORT_PAGE_SIZE);
+        const lastPage = Math.floor(Math.max(last - 1, first) / REPORT_PAGE_SIZE);
+        for (let page = firstPage; page <= lastPage; page++) {
+            fetchReportPage(page);
+        }
+
+        const fragment = document.createDocumentFragment();
+        for (let index = first; index < last; index++) {
+            const lines = view.pages[Math.floor(index / REPORT_PAGE_SIZE)];
+            const div = document.createElement('div');
+            div.className = 'report-line';
+            div.textContent = lines ? (lines[index % REPORT_PAGE_SIZE] || '').replace(/\n/g, '') : '';
+            fragment.appendChild(div);
+        }
+        reportWindow.css('top', first * REPORT_LINE_HEIGHT + 'px');
+        reportWindow.empty().append(fragment);
+    }
+
+    reportViewer.on('scroll', function () {
+        window.requestAnimationFrame(renderReportWindow);
+    });
+
+    applyFiltersButton.on('click', function () {
+        if (currentAnalysisId) {
+            openReportViewer();
+        }
+    });
+
+    reportFilters.find('input').on('keydown', function (e) {
+        if (e.key === 'Enter' && currentAnalysisId) {
+            openReportViewer();
+        }
+    });
+
+    function showAnalysisError(jqXHR, textStatus, errorThrown) {
+        // Respostas de erro com corpo JSON (colunas faltando, erro da tarefa)
+        if (jqXHR.responseJSON && (jqXHR.responseJSON.error || jqXHR.responseJSON.message)) {
+            showAnalysisResponse(jqXHR.responseJSON);
+            return;
+        }
+        progressContainer.hide();
+        progressBarProcess.hide();
+        analyzeButton.prop('disabled', false).text('Analisar Arquivo');
+        uploadMessage.addClass('error').text('Erro ao enviar arquivo: ' + textStatus + '. Detalhes: ' + errorThrown);
+        jsonResults.text('Falha na comunicação com o servidor.');
+        resultsSection.show();
+    }
+
     // Download do PDF
     downloadPdfButton.on('click', function () {
-        if (!currentReport) {
+        if (!currentAnalysisId) {
             uploadMessage.addClass('error').text('Nenhum relatório disponível para download.');
             return;
         }
@@ -286,9 +584,12 @@ $(document).ready(function () {
             type: 'POST',
             contentType: 'application/json',
             data: JSON.stringify({
-                relatorio: currentReport,
-                tempo_processamento: currentProcessingTime
+                id_analise: currentAnalysisId,
+                incluir_nao_agrupados: pdfNaoAgrupadosOption.is(':checked')
             }),
+            xhrFields: {
+                responseType: 'blob'
+            },
             success: function (response, status, xhr) {
                 // Cria um link temporário para forçar o download
                 const blob = new Blob([response], { type: 'application/pdf' });
@@ -312,7 +613,7 @@ $(document).ready(function () {
 
     // Download do XLSX
     downloadXlsxButton.on('click', function () {
-        if (!currentAgrupamentosXlsx || currentAgrupamentosXlsx.length === 0) {
+        if (!currentAnalysisId || currentTableRows === 0) {
             uploadMessage.addClass('error').text('Nenhum relatório disponível para download.');
             return;
         }
@@ -324,8 +625,7 @@ $(document).ready(function () {
             type: 'POST',
             contentType: 'application/json',
             data: JSON.stringify({
-                relatorio_agrupamentos: currentAgrupamentosXlsx,
-                relatorio_nao_agrupados: currentNaoAgrupadosXlsx
+                id_analise: currentAnalysisId
             }),
             xhrFields: {
                 responseType: 'blob'
@@ -353,6 +653,78 @@ $(document).ready(function () {
         });
     });
 
+    // Download do CSV: link direto, o servidor envia o arquivo em blocos e
+    // o navegador começa a baixar imediatamente
+    function downloadCsv(tabela) {
+        if (!currentAnalysisId) {
+            uploadMessage.addClass('error').text('Nenhum relatório disponível para download.');
+            return;
+        }
+        const params = $.param({
+            id_analise: currentAnalysisId,
+            tabela: tabela,
+            gzip: csvGzipOption.is(':checked') ? 1 : 0
+        });
+        window.location.href = '/download_csv?' + params;
+    }
+
+    downloadCsvButton.on('click', function () {
+        downloadCsv('agrupamentos');
+    });
+
+    downloadCsvNaoAgrupadosButton.on('click', function () {
+        downloadCsv('nao_agrupados');
+    });
+
+    // Download do relatório em texto, gerado pelo servidor sob demanda
+    downloadTxtButton.on('click', function () {
+        if (!currentAnalysisId) {
+            uploadMessage.addClass('error').text('Nenhum relatório disponível para download.');
+            return;
+        }
+        window.location.href = '/download_txt?' + $.param({ id_analise: currentAnalysisId });
+    });
+
+    // Reanálise incremental: aplica um arquivo de alterações (INCLUIR,
+    // EXCLUIR, STATUS) à análise exibida
+    applyDeltaButton.on('click', function () {
+        if (!currentAnalysisId) {
+            uploadMessage.addClass('error').text('Nenhuma análise disponível para atualizar.');
+            return;
+        }
+        deltaFileInput.val('');
+        deltaFileInput.trigger('click');
+    });
+
+    deltaFileInput.on('change', function () {
+        const file = this.files[0];
+        if (!file) {
+            return;
+        }
+        const formData = new FormData();
+        formData.append('id_analise', currentAnalysisId);
+        formData.append('file', file);
+        formData.append('relatorio', 'paginado');
+
+        uploadMessage.removeClass('success error').text('Aplicando alterações...');
+        applyDeltaButton.prop('disabled', true);
+        $.ajax({
+            url: '/analyze_delta',
+            type: 'POST',
+            data: formData,
+            processData: false,
+            contentType: false,
+            success: function (response) {
+                closeReportViewer();
+                showAnalysisResponse(response);
+            },
+            error: showAnalysisError,
+            complete: function () {
+                applyDeltaButton.prop('disabled', false);
+            }
+        });
+    });
+
     // Adiciona o modal de processamento
     const processingModal = `
 <div id="processingModal" class="modal" style="display: none;">